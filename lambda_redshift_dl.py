@@ -13,12 +13,11 @@
 
 import botocore.session as s
 from botocore.exceptions import ClientError
-from botocore.exceptions import WaiterError
-from botocore.waiter import WaiterModel
-from botocore.waiter import create_waiter_with_client
 import boto3
 import boto3.session
 
+import base64
+import hashlib
 import json
 import time
 import os
@@ -27,6 +26,175 @@ import datetime
 import operator
 import logging
 
+def build_unload_query(schema, table, unload_path, iam_role):
+    """Builds the UNLOAD statement that exports the table as gzipped CSV shards with a header."""
+    return f"unload('select * from {schema}.{table};') to '{unload_path}' iam_role '{iam_role}' format as CSV header ALLOWOVERWRITE GZIP"
+
+
+def unload_table(client_redshift, database, secret_arn, cluster_identifier, schema, table, unload_path, iam_role):
+    """Submits the UNLOAD through the Redshift Data API and returns the statement id.
+
+    The client is passed in so that the local pipeline runner can use a stand-in Data API.
+    """
+    query_str = build_unload_query(schema, table, unload_path, iam_role)
+    print("Unloading string: " + query_str)
+
+    res = client_redshift.execute_statement(Database=database, SecretArn=secret_arn, Sql=query_str,
+                                            ClusterIdentifier=cluster_identifier)
+    print("Redshift Data API execution started ...")
+    return res["Id"]
+
+
+def wait_for_unload(client_redshift, statement_id, timeout, delay=2.0, max_delay=20.0, sleep=time.sleep):
+    """Polls the UNLOAD until it finished, with exponential backoff.
+
+    The UNLOAD overwrites the files of the previous extraction in place, so until it
+    finished the prefix holds old or partly new data, which must never be digested.
+
+    Args:
+        client_redshift: the redshift-data client
+        statement_id: the Id of the UNLOAD statement
+        timeout: the seconds after which to stop waiting
+        delay: the seconds before the first poll, doubled after every poll
+        max_delay: the maximum seconds between polls
+        sleep: called with the seconds to wait
+
+    Returns:
+        the describe_statement response of the finished statement
+
+    Raises:
+        RuntimeError: if the UNLOAD failed, was aborted or did not finish in time
+    """
+    waited = 0.0
+    while True:
+        response = client_redshift.describe_statement(Id=statement_id)
+        status = response["Status"]
+        if status == "FINISHED":
+            return response
+        if status in ("FAILED", "ABORTED"):
+            raise RuntimeError(f"UNLOAD {statement_id} {status.lower()}: {response.get('Error', '')}")
+        if waited >= timeout:
+            raise RuntimeError(f"UNLOAD {statement_id} still {status} after {waited:.0f}s")
+        sleep(delay)
+        waited += delay
+        delay = min(delay * 2, max_delay)
+
+
+def manifest_digest(s3, bucket, prefix):
+    """Returns a sha256 digest over the key, ETag and size of every object under the prefix.
+
+    The digest only changes when the unloaded data changes, so the pipeline uses it to key
+    step caching of everything downstream of the UNLOAD.
+    """
+    sha = hashlib.sha256()
+    kwargs = {"Bucket": bucket, "Prefix": prefix}
+    while True:
+        response = s3.list_objects_v2(**kwargs)
+        for obj in sorted(response.get("Contents", []), key=operator.itemgetter("Key")):
+            sha.update(f"{obj['Key']}:{obj['ETag']}:{obj['Size']}\n".encode("utf-8"))
+        if not response.get("IsTruncated"):
+            return sha.hexdigest()
+        kwargs["ContinuationToken"] = response["NextContinuationToken"]
+
+
+SNAPSHOT_PREFIX = "bankdm/snapshots"
+# Written last by the preprocessing job, a snapshot without it is incomplete
+SNAPSHOT_MARKER = "snapshot/snapshot.json"
+SNAPSHOT_LAST_USED = "_last_used"
+
+
+def snapshot_fingerprint(manifest_digest, preprocess_digest, train_shards):
+    """Returns the key of the feature snapshot of an extraction.
+
+    It changes with the unloaded data, the preprocessing code and its parameters and the
+    number of train shards, i.e. whenever the preprocessing would write other splits.
+    """
+    payload = f"{manifest_digest}:{preprocess_digest}:{train_shards}"
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _list_objects(s3, bucket, prefix):
+    kwargs = {"Bucket": bucket, "Prefix": prefix}
+    while True:
+        response = s3.list_objects_v2(**kwargs)
+        yield from response.get("Contents", [])
+        if not response.get("IsTruncated"):
+            return
+        kwargs["ContinuationToken"] = response["NextContinuationToken"]
+
+
+def list_snapshots(s3, bucket, prefix=SNAPSHOT_PREFIX):
+    """Lists the feature snapshots under the prefix.
+
+    Snapshots are named <fingerprint[:16]>-<creation time>, so a snapshot evicted and built
+    again gets another name and thus other step arguments, which defeats a stale step cache.
+
+    Returns:
+        a dict of snapshot name to a dict with its fingerprint prefix, whether it is
+        complete, the time it was last used and its keys
+    """
+    snapshots = {}
+    for obj in _list_objects(s3, bucket, f"{prefix}/"):
+        name, _, rest = obj["Key"][len(prefix) + 1:].partition("/")
+        snapshot = snapshots.setdefault(
+            name, {"fingerprint": name.split("-")[0], "complete": False, "last_used": obj["LastModified"], "keys": []}
+        )
+        snapshot["keys"].append(obj["Key"])
+        snapshot["complete"] = snapshot["complete"] or rest == SNAPSHOT_MARKER
+        snapshot["last_used"] = max(snapshot["last_used"], obj["LastModified"])
+    return snapshots
+
+
+def lookup_snapshot(s3, bucket, fingerprint, now=None, prefix=SNAPSHOT_PREFIX):
+    """Finds the complete snapshot of a fingerprint, marking it as used.
+
+    Returns:
+        a tuple of the s3:// uri of the snapshot, or of the one to publish if there is
+        none, and whether it exists
+    """
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    complete = sorted(
+        name for name, snapshot in list_snapshots(s3, bucket, prefix).items()
+        if snapshot["fingerprint"] == fingerprint[:16] and snapshot["complete"]
+    )
+    if complete:
+        name = complete[-1]
+        s3.put_object(Bucket=bucket, Key=f"{prefix}/{name}/{SNAPSHOT_LAST_USED}", Body=now.isoformat())
+        return f"s3://{bucket}/{prefix}/{name}", True
+    return f"s3://{bucket}/{prefix}/{fingerprint[:16]}-{now:%Y%m%dT%H%M%SZ}", False
+
+
+def evict_snapshots(s3, bucket, keep=5, max_age_days=30, now=None, protect=(), prefix=SNAPSHOT_PREFIX):
+    """Deletes the snapshots beyond the keep most recently used or unused for max_age_days.
+
+    Args:
+        s3: the S3 client
+        bucket: the bucket of the snapshots
+        keep: the number of most recently used snapshots to keep
+        max_age_days: the days after which an unused snapshot is deleted, which should
+            not be less than the expiry of the pipeline step cache
+        now: the current time, an aware datetime
+        protect: the s3:// uris of snapshots never to delete, e.g. the one in use
+        prefix: the prefix of the snapshots
+
+    Returns:
+        the names of the deleted snapshots
+    """
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    snapshots = list_snapshots(s3, bucket, prefix)
+    protected = {uri.rstrip("/").rsplit("/", 1)[-1] for uri in protect}
+    ranked = sorted(snapshots, key=lambda name: snapshots[name]["last_used"], reverse=True)
+    evicted = [
+        name for rank, name in enumerate(ranked)
+        if name not in protected
+        and (rank >= keep or now - snapshots[name]["last_used"] > datetime.timedelta(days=max_age_days))
+    ]
+    keys = [key for name in evicted for key in snapshots[name]["keys"]]
+    for start in range(0, len(keys), 1000):
+        s3.delete_objects(Bucket=bucket, Delete={"Objects": [{"Key": key} for key in keys[start:start + 1000]]})
+    return evicted
+
+
 def lambda_handler(event, context):
     logger = logging.getLogger()
     logger.setLevel(logging.INFO)
@@ -56,45 +224,6 @@ def lambda_handler(event, context):
     client = boto3.client('sagemaker')
     s3 = boto3.client('s3', region_name=region)
     
-    # Create custom waiter for the Redshift Data API to wait for finish execution of current SQL statement
-    waiter_name = 'DataAPIExecution'
-    
-    delay=2
-    max_attempts=3
-    
-    #Configure the waiter settings
-    waiter_config = {
-      'version': 2,
-      'waiters': {
-        'DataAPIExecution': {
-          'operation': 'DescribeStatement',
-          'delay': delay,
-          'maxAttempts': max_attempts,
-          'acceptors': [
-            {
-              "matcher": "path",
-              "expected": "FINISHED",
-              "argument": "Status",
-              "state": "success"
-            },
-            {
-              "matcher": "pathAny",
-              "expected": ["PICKED","STARTED","SUBMITTED"],
-              "argument": "Status",
-              "state": "retry"
-            },
-            {
-              "matcher": "pathAny",
-              "expected": ["FAILED","ABORTED"],
-              "argument": "Status",
-              "state": "failure"
-            }
-          ],
-        },
-      },
-    }
-    
-    
     # Need the IAM role to unload data from RedShift
     redshift_iam_role = f'arn:aws:iam::{accountID}:role/BankDM-RedShift'
     
@@ -133,11 +262,6 @@ def lambda_handler(event, context):
     
     # Setup the RedShift client
     client_redshift = session.client("redshift-data")
-
-    
-    waiter_model = WaiterModel(waiter_config)
-    custom_waiter = create_waiter_with_client(waiter_name, waiter_model, client_redshift)
-    
     print("Data API client successfully loaded")
 
     # Set the RedShift unload S3 path
@@ -145,28 +269,29 @@ def lambda_handler(event, context):
     logger.info("S3 filepath is %s" %redshift_unload_path)
     
     # Unload the data from RedShift to S3
-    query_str = f"unload('select * from {schema_redshift}.{table_name_redshift};') to '{redshift_unload_path}' iam_role '{redshift_iam_role}' format as CSV header ALLOWOVERWRITE GZIP"
-    print("Unloading string: " + query_str)
-    
-    res = client_redshift.execute_statement(Database= database_name_redshift, SecretArn= secret_arn, Sql= query_str, ClusterIdentifier= redshift_cluster_identifier)
-    print("Redshift Data API execution started ...")
-    id = res["Id"]
+    id = unload_table(client_redshift, database_name_redshift, secret_arn, redshift_cluster_identifier,
+                      schema_redshift, table_name_redshift, redshift_unload_path, redshift_iam_role)
     
-    # Reset the 'delay' attribute of the waiter to 20 seconds for the UNLOAD to finish.
-    waiter_config["waiters"]["DataAPIExecution"]["delay"] = 20
-    waiter_model = WaiterModel(waiter_config)
-    custom_waiter = create_waiter_with_client(waiter_name, waiter_model, client_redshift)
-    
-    # Waiter in try block and wait for DATA API to return
-    try:
-        custom_waiter.wait(Id=id)
-        print("Done waiting to finish Data API.")
-    except WaiterError as e:
-        print (e)
-        
+    # Wait for the UNLOAD to finish, failing the step otherwise, keeping a minute of the
+    # lambda's run time to digest the data and look up its snapshot
+    timeout = context.get_remaining_time_in_millis() / 1000.0 - 60 if context else 540
+    wait_for_unload(client_redshift, id, timeout)
     print("Query execution complete")
-    
+
+    digest = manifest_digest(s3, bucket, f"{prefix}/unload/")
+    logger.info("Manifest digest of the unloaded data: %s", digest)
+
+    # Point the preprocessing at the feature snapshot of this extraction, and apply the
+    # retention policy to the others
+    fingerprint = snapshot_fingerprint(digest, event.get("preprocess_digest", ""), event.get("train_shards", 1))
+    snapshot_uri, snapshot_hit = lookup_snapshot(s3, bucket, fingerprint)
+    evicted = evict_snapshots(s3, bucket, int(event.get("snapshot_keep", 5)),
+                              float(event.get("snapshot_max_age_days", 30)), protect=[snapshot_uri])
+    logger.info("Feature snapshot %s (hit: %s), evicted %s", snapshot_uri, snapshot_hit, evicted)
+
     return {
         "statusCode": 200,
-        "body": json.dumps("Done")
+        "body": json.dumps("Done"),
+        "manifest_digest": digest,
+        "snapshot_uri": snapshot_uri,
     }
\ No newline at end of file
@@ -14,6 +14,15 @@
 from __future__ import absolute_import
 
 import ast
+import hashlib
+import itertools
+import json
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+TERMINAL_STATUSES = ("Succeeded", "Failed", "Stopped")
 
 
 def get_pipeline_driver(module_name, passed_args=None):
@@ -33,9 +42,80 @@ def get_pipeline_driver(module_name, passed_args=None):
     return _imports.get_pipeline(**kwargs)
 
 
+def get_local_pipeline_driver(module_name, work_dir, passed_args=None):
+    """Runs your pipeline offline against a local working directory.
+
+    Pipeline modules must define a run_local_pipeline(work_dir, **kwargs) module-level method.
+
+    Args:
+        module_name: The module name of your pipeline.
+        work_dir: The directory standing in for S3 and the processing/training volumes.
+        passed_args: Optional passed arguments that your local run may be templated by.
+
+    Returns:
+        The result of the local run.
+    """
+    _imports = __import__(module_name, fromlist=["run_local_pipeline"])
+    kwargs = convert_struct(passed_args)
+    return _imports.run_local_pipeline(work_dir, **kwargs)
+
+
 def convert_struct(str_struct=None):
+    if isinstance(str_struct, (dict, list)):
+        return str_struct
     return ast.literal_eval(str_struct) if str_struct else {}
 
+
+def expand_kwargs(passed_args=None):
+    """Expands --kwargs into the keyword arguments of each pipeline variant.
+
+    --kwargs is a dict, or a list of dicts, one per variant. A dict may hold a "grid" of
+    argument name to list of values, which expands into one variant per combination of
+    values, each merged into the other arguments of the dict.
+
+    Args:
+        passed_args: The --kwargs literal, or the already converted struct.
+
+    Returns:
+        A list with the keyword arguments of each variant.
+
+    Raises:
+        ValueError: if --kwargs expands into no variant, e.g. an empty list or grid values
+    """
+    struct = convert_struct(passed_args)
+    variants = []
+    for kwargs in struct if isinstance(struct, list) else [struct]:
+        kwargs = dict(kwargs)
+        grid = kwargs.pop("grid", {})
+        names = sorted(grid)
+        for values in itertools.product(*(grid[name] for name in names)):
+            variants.append(dict(kwargs, **dict(zip(names, values))))
+    if not variants:
+        raise ValueError(f"--kwargs {passed_args} expands into no pipeline variant")
+    return variants
+
+
+def get_pipeline_drivers(module_name, variants):
+    """Builds the pipeline of each variant, one after the other.
+
+    The variants share the cached boto3 session of their region, from which clients
+    cannot safely be created concurrently. Building a definition is cheap, and the
+    round trips to SageMaker are run concurrently by run_variants.
+
+    Args:
+        module_name: The module name of your pipeline.
+        variants: The keyword arguments of each variant, see expand_kwargs.
+
+    Returns:
+        The SageMaker Workflow pipelines, in the order of the variants.
+    """
+    pipelines = [get_pipeline_driver(module_name, kwargs) for kwargs in variants]
+    names = [pipeline.name for pipeline in pipelines]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Pipeline variants must have distinct pipeline names, got {duplicates} more than once")
+    return pipelines
+
 def get_pipeline_custom_tags(module_name, args, tags):
     """Gets the custom tags for pipeline
 
@@ -49,3 +129,216 @@ def get_pipeline_custom_tags(module_name, args, tags):
     except Exception as e:
         print(f"Error getting project tags: {e}")
     return tags
+
+
+def format_step_summary(steps):
+    """Formats the steps of a pipeline execution with their status and cache result.
+
+    Args:
+        steps: The step summaries as returned by list_pipeline_execution_steps.
+
+    Returns:
+        A table with one row per step, marking steps whose cached result was reused.
+    """
+    rows = []
+    for step in reversed(steps):
+        cache_hit = step.get("CacheHitResult", {}).get("SourcePipelineExecutionArn")
+        rows.append(
+            (
+                step["StepName"],
+                step.get("StepStatus", ""),
+                f"hit ({cache_hit.split('/')[-1]})" if cache_hit else "miss",
+            )
+        )
+    width = max([len(name) for name, _, _ in rows] + [len("Step")])
+    lines = [f"{'Step':<{width}}  {'Status':<10}  Cache"]
+    lines += [f"{name:<{width}}  {status:<10}  {cache}" for name, status, cache in rows]
+    return "\n".join(lines)
+
+
+def definition_digest(definition):
+    """Computes the sha256 of a pipeline definition, independent of its JSON formatting.
+
+    Args:
+        definition: The pipeline definition as a JSON string.
+
+    Returns:
+        The hex digest of the definition with sorted keys and no whitespace.
+    """
+    canonical = json.dumps(json.loads(definition), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def deployed_definition_digest(sagemaker_client, pipeline_name):
+    """Gets the digest of the definition of a deployed pipeline.
+
+    Args:
+        sagemaker_client: A SageMaker client.
+        pipeline_name: The name of the pipeline.
+
+    Returns:
+        The digest of the deployed definition, or None if the pipeline does not exist.
+    """
+    try:
+        response = sagemaker_client.describe_pipeline(PipelineName=pipeline_name)
+    except Exception as e:  # pylint: disable=W0703
+        if getattr(e, "response", {}).get("Error", {}).get("Code") == "ResourceNotFound":
+            return None
+        raise
+    return definition_digest(response["PipelineDefinition"])
+
+
+def upsert_if_changed(pipeline, role_arn, description=None, tags=None, sagemaker_client=None):
+    """Creates or updates the pipeline unless the deployed definition is the same.
+
+    Args:
+        pipeline: The SageMaker Workflow pipeline.
+        role_arn: The role arn for the pipeline service execution role.
+        description: The description of the pipeline.
+        tags: The tags of the pipeline.
+        sagemaker_client: The SageMaker client to describe the deployed pipeline with,
+            defaults to that of the pipeline's session.
+
+    Returns:
+        A tuple of the upsert response, None if skipped, and the definition digest.
+    """
+    if sagemaker_client is None:
+        sagemaker_client = pipeline.sagemaker_session.sagemaker_client
+    digest = definition_digest(pipeline.definition())
+    if deployed_definition_digest(sagemaker_client, pipeline.name) == digest:
+        return None, digest
+    return pipeline.upsert(role_arn=role_arn, description=description, tags=tags), digest
+
+
+def _list_execution_steps(sagemaker_client, execution_arn):
+    steps, kwargs = [], {}
+    while True:
+        response = sagemaker_client.list_pipeline_execution_steps(PipelineExecutionArn=execution_arn, **kwargs)
+        steps += response["PipelineExecutionSteps"]
+        if not response.get("NextToken"):
+            return steps
+        kwargs["NextToken"] = response["NextToken"]
+
+
+def _step_duration(step):
+    if step.get("StartTime") and step.get("EndTime"):
+        return (step["EndTime"] - step["StartTime"]).total_seconds()
+    return None
+
+
+def monitor_execution(sagemaker_client, execution_arn, poll_interval=30, out=print, sleep=time.sleep):
+    """Polls a pipeline execution until it ends, reporting every step status transition.
+
+    Args:
+        sagemaker_client: A SageMaker client.
+        execution_arn: The arn of the pipeline execution.
+        poll_interval: The seconds between polls.
+        out: Called with each line of the report.
+        sleep: Called with poll_interval between polls.
+
+    Returns:
+        A tuple of the final execution status and the step summaries.
+    """
+    start = time.monotonic()
+    seen = {}
+    while True:
+        status = sagemaker_client.describe_pipeline_execution(PipelineExecutionArn=execution_arn)[
+            "PipelineExecutionStatus"
+        ]
+        steps = _list_execution_steps(sagemaker_client, execution_arn)
+        for step in reversed(steps):
+            name, step_status = step["StepName"], step.get("StepStatus", "")
+            if seen.get(name) == step_status:
+                continue
+            seen[name] = step_status
+            line = f"[{time.monotonic() - start:8.1f}s] {name}: {step_status}"
+            duration = _step_duration(step)
+            if step_status in TERMINAL_STATUSES and duration is not None:
+                line += f" in {duration:.1f}s"
+            if step.get("CacheHitResult"):
+                line += " (cache hit)"
+            if step.get("FailureReason"):
+                line += f" - {step['FailureReason']}"
+            out(line)
+        if status in TERMINAL_STATUSES:
+            return status, steps
+        sleep(poll_interval)
+
+
+def failed_steps(steps):
+    """Returns the steps that failed or were stopped, with their failure reasons."""
+    return [step for step in steps if step.get("StepStatus") in ("Failed", "Stopped")]
+
+
+def run_variants(pipelines, role_arn, description=None, tags=None, max_concurrency=4, poll_interval=30,
+                 out=print, sleep=time.sleep):
+    """Upserts, starts and monitors several pipelines, at most max_concurrency at a time.
+
+    Each variant runs in its own thread and prefixes its monitor lines with its pipeline
+    name. An error in one variant is recorded in its result and does not stop the others.
+
+    Args:
+        pipelines: The SageMaker Workflow pipelines.
+        role_arn: The role arn for the pipeline service execution role.
+        description: The description of the pipelines.
+        tags: The tags of each pipeline, in the order of the pipelines, or None.
+        max_concurrency: The number of variants upserted, started and monitored at a time.
+        poll_interval: The seconds between polls of each execution.
+        out: Called with each line of the report, from several threads.
+        sleep: Called with poll_interval between polls.
+
+    Returns:
+        A dict per variant with its name, execution arn, status, steps and error.
+    """
+    lock = threading.Lock()
+    tags = tags or [None] * len(pipelines)
+
+    def locked_out(line):
+        with lock:
+            out(line)
+
+    def run(pipeline, pipeline_tags):
+        result = {"name": pipeline.name, "arn": None, "status": "Error", "steps": [], "error": None}
+        start = time.monotonic()
+        try:
+            response, digest = upsert_if_changed(pipeline, role_arn, description, pipeline_tags)
+            action = "skipped upsert, definition unchanged" if response is None else "created/updated"
+            locked_out(f"[{pipeline.name}] {action} (sha256 {digest[:12]})")
+            execution = pipeline.start()
+            result["arn"] = execution.arn
+            locked_out(f"[{pipeline.name}] execution started: {execution.arn}")
+            result["status"], result["steps"] = monitor_execution(
+                pipeline.sagemaker_session.sagemaker_client,
+                execution.arn,
+                poll_interval=poll_interval,
+                out=lambda line: locked_out(f"[{pipeline.name}] {line}"),
+                sleep=sleep,
+            )
+        except Exception as e:  # pylint: disable=W0703
+            result["error"] = str(e)
+            locked_out(f"[{pipeline.name}] Exception: {e}")
+        result["seconds"] = time.monotonic() - start
+        return result
+
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as pool:
+        return list(pool.map(run, pipelines, tags))
+
+
+def format_variant_summary(results):
+    """Formats one row per pipeline variant with its status, duration and failed steps.
+
+    Args:
+        results: The results of run_variants.
+
+    Returns:
+        A table with one row per variant.
+    """
+    width = max([len(result["name"]) for result in results] + [len("Pipeline")])
+    lines = [f"{'Pipeline':<{width}}  {'Status':<10}  {'Seconds':>9}  Failed"]
+    for result in results:
+        failed = ", ".join(step["StepName"] for step in failed_steps(result["steps"]))
+        lines.append(
+            f"{result['name']:<{width}}  {result['status']:<10}  {result.get('seconds', 0):>9.1f}  "
+            f"{result['error'] or failed}"
+        )
+    return "\n".join(lines)
@@ -0,0 +1,223 @@
+# Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+"""Drift check script comparing the profile of a new extraction with a reference profile.
+
+The reference is the profile.json registered with the latest approved model of the model
+package group. Only the model input columns of features.json and the label are compared,
+from the sketches of the two profiles rather than the data:
+
+- numeric columns on the deciles of the reference, as fixed bins, with the population
+  stability index (PSI) and the Kolmogorov-Smirnov distance of the two distributions
+- categorical columns on the frequencies of their levels with a chi-square test and
+  Cramér's V, which unlike the p-value does not grow with the number of rows
+
+drift.json reports every column and whether any of them drifted beyond the thresholds,
+in which case, or without a reference, the pipeline retrains.
+"""
+import argparse
+import json
+import logging
+import os
+
+import numpy as np
+
+from scipy import stats
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+logger.addHandler(logging.StreamHandler())
+
+THRESHOLDS = {"psi": 0.2, "ks": 0.1, "cramers_v": 0.1}
+BINS = 10
+# Floor of the bin proportions, so that an empty bin does not make the PSI infinite
+EPSILON = 1e-4
+
+
+def _cdf(sketch, x):
+    """Evaluates the cumulative distribution of a profile sketch at the points x."""
+    values = np.asarray(sketch["values"], dtype=np.float64)
+    cumulative = np.cumsum(sketch["weights"]) / np.sum(sketch["weights"])
+    index = np.searchsorted(values, x, side="right")
+    return np.where(index > 0, cumulative[np.maximum(index - 1, 0)], 0.0)
+
+
+def psi(expected, actual):
+    """Returns the population stability index of two arrays of bin proportions."""
+    expected = np.clip(expected, EPSILON, None)
+    actual = np.clip(actual, EPSILON, None)
+    return float(np.sum((actual - expected) * np.log(actual / expected)))
+
+
+def numeric_drift(reference, current, bins=BINS):
+    """Compares two numeric column profiles on the quantile bins of the reference.
+
+    Returns:
+        a dict with the PSI, the KS distance and the number of bins
+    """
+    ref, cur = reference["sketch"], current["sketch"]
+    if not ref["values"] or not cur["values"]:
+        return {"psi": 0.0, "ks": 0.0, "bins": 0}
+    cumulative = np.cumsum(ref["weights"]) / np.sum(ref["weights"])
+    ranks = np.searchsorted(cumulative, np.arange(1, bins) / bins, side="left")
+    edges = np.unique(np.asarray(ref["values"])[np.minimum(ranks, len(cumulative) - 1)])
+    ref_p = np.diff(np.concatenate([[0.0], _cdf(ref, edges), [1.0]]))
+    cur_p = np.diff(np.concatenate([[0.0], _cdf(cur, edges), [1.0]]))
+    grid = np.union1d(ref["values"], cur["values"])
+    ks = float(np.max(np.abs(_cdf(ref, grid) - _cdf(cur, grid))))
+    return {"psi": psi(ref_p, cur_p), "ks": ks, "bins": len(edges) + 1}
+
+
+def _level_counts(profile, levels):
+    counts = {item["value"]: item["count"] for item in profile["top"]}
+    observed = np.array([counts.get(level, 0) for level in levels], dtype=np.float64)
+    other = profile["count"] - profile["nulls"] - observed.sum()
+    return np.append(observed, max(other, 0.0))
+
+
+def categorical_drift(reference, current):
+    """Compares the level frequencies of two categorical column profiles.
+
+    Levels beyond the top levels of the profiles are pooled into one other level.
+
+    Returns:
+        a dict with the chi-square statistic, its p-value, Cramér's V and the PSI
+    """
+    levels = sorted({item["value"] for item in reference["top"]} | {item["value"] for item in current["top"]})
+    ref_counts, cur_counts = _level_counts(reference, levels), _level_counts(current, levels)
+    keep = (ref_counts + cur_counts) > 0
+    ref_counts, cur_counts = ref_counts[keep], cur_counts[keep]
+    total = cur_counts.sum()
+    if len(ref_counts) < 2 or total == 0 or ref_counts.sum() == 0:
+        return {"chi2": 0.0, "p_value": 1.0, "cramers_v": 0.0, "psi": 0.0}
+    # Add-one smoothing of the reference, so that a new level is a large but finite shift
+    expected_p = (ref_counts + 1.0) / (ref_counts.sum() + len(ref_counts))
+    chi2 = float(np.sum((cur_counts - total * expected_p) ** 2 / (total * expected_p)))
+    dof = len(ref_counts) - 1
+    return {
+        "chi2": chi2,
+        "p_value": float(stats.chi2.sf(chi2, dof)),
+        "cramers_v": float(np.sqrt(chi2 / (total * dof))),
+        "psi": psi(ref_counts / ref_counts.sum(), cur_counts / total),
+    }
+
+
+def detect_drift(reference, current, columns, thresholds=None):
+    """Compares the columns of two profiles.
+
+    Args:
+        reference: the reference profile
+        current: the profile of the new extraction
+        columns: the columns to compare
+        thresholds: the PSI, KS and Cramér's V above which a column drifted
+
+    Returns:
+        the drift report, with drift.detected true if any column drifted
+    """
+    thresholds = dict(THRESHOLDS, **(thresholds or {}))
+    report = {}
+    for column in columns:
+        ref, cur = reference["columns"].get(column), current["columns"].get(column)
+        if ref is None or cur is None or ref["kind"] != cur["kind"]:
+            report[column] = {"drifted": True, "reason": "missing or of another kind"}
+            continue
+        if ref["kind"] == "numeric":
+            result = numeric_drift(ref, cur)
+            drifted = result["psi"] > thresholds["psi"] or result["ks"] > thresholds["ks"]
+        else:
+            result = categorical_drift(ref, cur)
+            drifted = result["psi"] > thresholds["psi"] or result["cramers_v"] > thresholds["cramers_v"]
+        report[column] = dict(result, drifted=bool(drifted))
+    drifted = sorted(c for c, r in report.items() if r["drifted"])
+    return {
+        "drift": {"detected": bool(drifted), "columns": drifted, "thresholds": thresholds},
+        "columns": report,
+    }
+
+
+def monitored_columns(features, label="y"):
+    """Returns the raw columns the model reads, from features.json, and the label."""
+    derived = set(features.get("derived", []))
+    return [c for c in features["numeric"] if c not in derived] + list(features["categorical"]) + [label]
+
+
+def download_reference_profile(model_package_group_name, region, path):
+    """Downloads the profile registered with the latest approved model of the group.
+
+    Returns:
+        the path written, or None if no approved model has a registered profile
+    """
+    import boto3
+
+    sagemaker = boto3.client("sagemaker", region_name=region)
+    packages = sagemaker.list_model_packages(
+        ModelPackageGroupName=model_package_group_name,
+        ModelApprovalStatus="Approved",
+        SortBy="CreationTime",
+        SortOrder="Descending",
+        MaxResults=1,
+    )["ModelPackageSummaryList"]
+    if not packages:
+        return None
+    package = sagemaker.describe_model_package(ModelPackageName=packages[0]["ModelPackageArn"])
+    uri = package.get("ModelMetrics", {}).get("ModelDataQuality", {}).get("Statistics", {}).get("S3Uri")
+    if not uri:
+        return None
+    bucket, key = uri[len("s3://"):].split("/", 1)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    boto3.client("s3", region_name=region).download_file(bucket, key, path)
+    logger.info("Reference profile of %s: %s", packages[0]["ModelPackageArn"], uri)
+    return path
+
+
+def main(base_dir, model_package_group_name=None, region=None, thresholds=None):
+    """Writes base_dir/drift/drift.json comparing base_dir/profile with the reference.
+
+    The reference is base_dir/reference/profile.json if present, else it is looked up in
+    the model registry when a model package group is given.
+    """
+    with open(f"{base_dir}/profile/profile.json") as f:
+        current = json.load(f)
+    with open(f"{base_dir}/features/features.json") as f:
+        columns = monitored_columns(json.load(f))
+
+    reference_path = f"{base_dir}/reference/profile.json"
+    if not os.path.exists(reference_path) and model_package_group_name:
+        reference_path = download_reference_profile(model_package_group_name, region, reference_path)
+    if reference_path and os.path.exists(reference_path):
+        with open(reference_path) as f:
+            report = detect_drift(json.load(f), current, columns, thresholds)
+    else:
+        report = {"drift": {"detected": True, "columns": [], "reason": "no reference profile"}, "columns": {}}
+    logger.info("Drift detected: %s %s", report["drift"]["detected"], report["drift"]["columns"])
+
+    os.makedirs(f"{base_dir}/drift", exist_ok=True)
+    with open(f"{base_dir}/drift/drift.json", "w") as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--base-dir", type=str, default="/opt/ml/processing")
+    parser.add_argument("--model-package-group-name", type=str, default=None)
+    parser.add_argument("--region", type=str, default=None)
+    parser.add_argument("--psi-threshold", type=float, default=THRESHOLDS["psi"])
+    parser.add_argument("--ks-threshold", type=float, default=THRESHOLDS["ks"])
+    parser.add_argument("--cramers-v-threshold", type=float, default=THRESHOLDS["cramers_v"])
+    args, _ = parser.parse_known_args()
+    main(
+        args.base_dir,
+        args.model_package_group_name,
+        args.region,
+        {"psi": args.psi_threshold, "ks": args.ks_threshold, "cramers_v": args.cramers_v_threshold},
+    )
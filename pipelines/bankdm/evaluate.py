@@ -11,8 +11,10 @@
 # ANY KIND, either express or implied. See the License for the specific
 # language governing permissions and limitations under the License.
 """Evaluation script for measuring mean squared error."""
+import argparse
 import json
 import logging
+import os
 import pathlib
 import pickle
 import tarfile
@@ -28,54 +30,82 @@ logger.setLevel(logging.INFO)
 logger.addHandler(logging.StreamHandler())
 
 
+def is_within_directory(directory, target):
+    """Checks that target resolves to a path inside directory."""
+    abs_directory = os.path.abspath(directory)
+    abs_target = os.path.abspath(target)
 
-if __name__ == "__main__":
-    logger.debug("Starting evaluation.")
-    model_path = "/opt/ml/processing/model/model.tar.gz"
+    prefix = os.path.commonprefix([abs_directory, abs_target])
+
+    return prefix == abs_directory
+
+
+def safe_extract(tar, path=".", members=None, *, numeric_owner=False):
+    """Extracts the tar file after rejecting members that would escape path."""
+    for member in tar.getmembers():
+        member_path = os.path.join(path, member.name)
+        if not is_within_directory(path, member_path):
+            raise Exception("Attempted Path Traversal in Tar File")
+
+    tar.extractall(path, members, numeric_owner=numeric_owner)
+
+
+def load_model(model_path, extract_dir="."):
+    """Extracts model.tar.gz and unpickles the xgboost booster."""
     with tarfile.open(model_path) as tar:
-        
-        import os
-        
-        def is_within_directory(directory, target):
-            
-            abs_directory = os.path.abspath(directory)
-            abs_target = os.path.abspath(target)
-        
-            prefix = os.path.commonprefix([abs_directory, abs_target])
-            
-            return prefix == abs_directory
-        
-        def safe_extract(tar, path=".", members=None, *, numeric_owner=False):
-        
-            for member in tar.getmembers():
-                member_path = os.path.join(path, member.name)
-                if not is_within_directory(path, member_path):
-                    raise Exception("Attempted Path Traversal in Tar File")
-        
-            tar.extractall(path, members, numeric_owner=numeric_owner) 
-            
-        
-        safe_extract(tar, path=".")
+        safe_extract(tar, path=extract_dir)
 
     logger.debug("Loading xgboost model.")
-    model = pickle.load(open("xgboost-model", "rb"))
+    with open(os.path.join(extract_dir, "xgboost-model"), "rb") as f:
+        return pickle.load(f)
 
-    logger.debug("Reading test data.")
-    test_path = "/opt/ml/processing/test/test.csv"
-    df = pd.read_csv(test_path, header=None)
 
-    logger.debug("Reading test data.")
+def find_test_data(test_dir):
+    """Returns the path of the test split, written as test.csv or gzipped as test.csv.gz."""
+    for name in ("test.csv", "test.csv.gz"):
+        if os.path.exists(os.path.join(test_dir, name)):
+            return os.path.join(test_dir, name)
+    raise FileNotFoundError(f"No test split found in {test_dir}")
+
+
+def read_test_data(test_path):
+    """Reads the test split and returns the labels and the feature array."""
+    df = pd.read_csv(test_path, header=None, compression="gzip" if test_path.endswith(".gz") else None)
+
     y_test = df.iloc[:, 0].to_numpy()
     df.drop(df.columns[0], axis=1, inplace=True)
-    X_test = xgboost.DMatrix(df.values)
+    return y_test, df.values
 
-    logger.info("Performing predictions against test data.")
-    predictions = model.predict(X_test)
 
-    logger.debug("Calculating mean squared error.")
+def find_test_arrays(test_dir):
+    """Returns the paths of the test features and labels arrays, or None if not written."""
+    paths = [os.path.join(test_dir, "test_features.npy"), os.path.join(test_dir, "test_labels.npy")]
+    return paths if all(os.path.exists(p) for p in paths) else None
+
+
+def read_test_arrays(features_path, labels_path):
+    """Memory-maps the test arrays and returns the float64 labels and the float32 features."""
+    # Only the labels are copied, as float64 for the metrics
+    return np.load(labels_path).astype(np.float64), np.load(features_path, mmap_mode="r")
+
+
+def predict(model, features):
+    """Predicts a 2-d array in place if the xgboost version supports it.
+
+    In place prediction reads the array, memory-mapped or not, as it is without building
+    a DMatrix, which xgboost before 1.1 falls back to. The evaluation image of the
+    pipeline has 1.1 or later, see XGBOOST_VERSION in pipeline.py.
+    """
+    if hasattr(model, "inplace_predict"):
+        return model.inplace_predict(features)
+    return model.predict(xgboost.DMatrix(np.asarray(features)))
+
+
+def build_report(y_test, predictions):
+    """Calculates the mean squared error report read by the condition step."""
     mse = mean_squared_error(y_test, predictions)
     std = np.std(y_test - predictions)
-    report_dict = {
+    return {
         "regression_metrics": {
             "mse": {
                 "value": mse,
@@ -84,10 +114,39 @@ if __name__ == "__main__":
         },
     }
 
-    output_dir = "/opt/ml/processing/evaluation"
+
+def main(base_dir):
+    """Evaluates the model against the processing job directory layout under base_dir."""
+    logger.debug("Starting evaluation.")
+    model = load_model(f"{base_dir}/model/model.tar.gz")
+
+    logger.debug("Reading test data.")
+    arrays = find_test_arrays(f"{base_dir}/test")
+    if arrays:
+        y_test, X_test = read_test_arrays(*arrays)
+    else:
+        y_test, X_test = read_test_data(find_test_data(f"{base_dir}/test"))
+
+    logger.info("Performing predictions against test data.")
+    predictions = predict(model, X_test)
+
+    logger.debug("Calculating mean squared error.")
+    report_dict = build_report(y_test, predictions)
+
+    output_dir = f"{base_dir}/evaluation"
     pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
 
-    logger.info("Writing out evaluation report with mse: %f", mse)
+    logger.info("Writing out evaluation report with mse: %f", report_dict["regression_metrics"]["mse"]["value"])
     evaluation_path = f"{output_dir}/evaluation.json"
     with open(evaluation_path, "w") as f:
         f.write(json.dumps(report_dict))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--base-dir", type=str, default="/opt/ml/processing")
+    # Digests passed by the pipeline so that step caching is keyed on the code and data
+    parser.add_argument("--code-digest", type=str, default=None)
+    args, _ = parser.parse_known_args()
+    logger.info("Code digest: %s", args.code_digest)
+    main(args.base_dir)
@@ -0,0 +1,166 @@
+# Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+"""The fitted feature transform of preprocess.py, applied to raw rows.
+
+preprocess.py writes features.json describing the numeric columns, the levels of every
+categorical column and the model input columns. FeatureSchema encodes raw rows, with the
+column names of the RedShift table, into the float32 matrix the model was trained on,
+without refitting pd.get_dummies on the rows being scored. Categorical levels unseen at
+training time encode as all zeros, as get_dummies on the training data would have.
+
+RecordEncoder encodes one record at a time for online scoring: the column index of
+every categorical level is looked up in a precomputed table and written into a reused
+float32 buffer, without pandas, in a few microseconds per record.
+"""
+import json
+
+import numpy as np
+import pandas as pd
+
+NOT_WORKING_JOBS = ("student", "retired", "unemployed")
+
+# The indicator variables added by preprocess.engineer_features, on a DataFrame
+DERIVED = {
+    "no_previous_contact": lambda data: data["pdays"].to_numpy() == 999,
+    "not_working": lambda data: np.isin(data["job"].to_numpy(), NOT_WORKING_JOBS),
+}
+
+# The same indicator variables, on a single record
+DERIVED_RECORD = {
+    "no_previous_contact": lambda record: record["pdays"] == 999,
+    "not_working": lambda record: record["job"] in NOT_WORKING_JOBS,
+}
+
+# The same indicator variables, as SQL predicates on the quoted columns of the table
+DERIVED_SQL = {
+    "no_previous_contact": lambda quote: f"{quote('pdays')} = 999",
+    "not_working": lambda quote: f"{quote('job')} IN ({', '.join(repr(job) for job in NOT_WORKING_JOBS)})",
+}
+
+
+class FeatureSchema:
+    """Encodes raw rows into model inputs, see the module docstring."""
+
+    def __init__(self, numeric, categorical, columns, derived=()):
+        """Creates the schema.
+
+        Args:
+            numeric: the numeric columns kept as they are, derived ones included
+            categorical: a dict of categorical column to its levels
+            columns: the model input columns in order, numeric columns and <column>_<level>
+            derived: the numeric columns computed from other columns, see DERIVED
+        """
+        unknown = sorted(set(derived) - set(DERIVED))
+        if unknown:
+            raise ValueError(f"Unknown derived columns {unknown}")
+        self.numeric = list(numeric)
+        self.categorical = {column: list(levels) for column, levels in categorical.items()}
+        self.columns = list(columns)
+        self.derived = list(derived)
+
+        index = {name: i for i, name in enumerate(self.columns)}
+        missing = [c for c in self.numeric if c not in index]
+        if missing:
+            raise ValueError(f"Numeric columns {missing} are not model input columns")
+        self.numeric_index = np.array([index[c] for c in self.numeric], dtype=np.intp)
+        # For every categorical column, the model input column of each level, -1 if the
+        # level is not an input column
+        self.level_index = {
+            column: np.array([index.get(f"{column}_{level}", -1) for level in levels], dtype=np.intp)
+            for column, levels in self.categorical.items()
+        }
+
+    @classmethod
+    def from_dict(cls, schema):
+        """Creates the schema from the dict written to features.json."""
+        return cls(schema["numeric"], schema["categorical"], schema["columns"], schema.get("derived", ()))
+
+    @classmethod
+    def load(cls, path):
+        """Loads the schema from features.json."""
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+    def to_dict(self):
+        """Returns the schema as written to features.json."""
+        return {
+            "numeric": self.numeric,
+            "derived": self.derived,
+            "categorical": self.categorical,
+            "columns": self.columns,
+        }
+
+    def transform(self, data):
+        """Encodes a DataFrame of raw rows.
+
+        Args:
+            data: the rows, with at least the numeric and categorical columns the derived
+                ones are not computed from
+
+        Returns:
+            a float32 array with one row per input row and one column per model input
+        """
+        out = np.zeros((len(data), len(self.columns)), dtype=np.float32)
+        for i, column in zip(self.numeric_index, self.numeric):
+            values = DERIVED[column](data) if column in self.derived else data[column].to_numpy()
+            out[:, i] = values
+        rows = np.arange(len(data))
+        for column, levels in self.categorical.items():
+            codes = pd.Index(levels).get_indexer(data[column].astype(str))
+            targets = np.where(codes >= 0, self.level_index[column][codes], -1)
+            known = targets >= 0
+            out[rows[known], targets[known]] = 1.0
+        return out
+
+
+class RecordEncoder:
+    """Encodes single records into a reused buffer, see the module docstring.
+
+    The buffer is overwritten by every call, so an encoder must not be shared between
+    threads and callers keeping an encoded record must copy it.
+    """
+
+    def __init__(self, schema):
+        """Creates the encoder.
+
+        Args:
+            schema: the FeatureSchema to encode with
+        """
+        self.schema = schema
+        self.buffer = np.zeros(len(schema.columns), dtype=np.float32)
+        plain = [(i, c) for i, c in zip(schema.numeric_index, schema.numeric) if c not in schema.derived]
+        derived = [(i, c) for i, c in zip(schema.numeric_index, schema.numeric) if c in schema.derived]
+        self._plain_columns = [c for _, c in plain]
+        self._derived = [DERIVED_RECORD[c] for _, c in derived]
+        self._value_index = np.array([i for i, _ in plain + derived], dtype=np.intp)
+        # For every categorical column, the model input column of each level that is one
+        self._tables = [
+            (column, {level: int(i) for level, i in zip(levels, schema.level_index[column]) if i >= 0})
+            for column, levels in schema.categorical.items()
+        ]
+
+    def encode(self, record):
+        """Encodes one record.
+
+        Args:
+            record: a mapping of the raw columns to their values, categorical values as str
+
+        Returns:
+            the float32 buffer holding the encoded record, overwritten by the next call
+        """
+        out = self.buffer
+        out.fill(0.0)
+        out[self._value_index] = [record[c] for c in self._plain_columns] + [f(record) for f in self._derived]
+        hot = [i for i in (table.get(record[c], -1) for c, table in self._tables) if i >= 0]
+        out[hot] = 1.0
+        return out
@@ -0,0 +1,458 @@
+# Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+"""Runs the BankDM pipeline offline against a local directory.
+
+    Lambda-RedShift-dl -> Step-PreProcess -> (Step-DriftCheck) -> Step-Train -> Step-Eval -> Step-AccuracyCond
+                       -> Step-Profile                                                   -> Step-BatchTransform
+
+The Lambda runs the same UNLOAD against a SQLite-backed Redshift Data API, the
+processing scripts run as subprocesses with their directories re-rooted under the work
+directory and training uses the local stand-in for the built-in XGBoost container.
+
+Like step caching in SageMaker Pipelines, each step runs in a job directory named by the
+fingerprint of its code, parameters and upstream data, and is skipped when a previous run
+of the same fingerprint succeeded. Step-PreProcess publishes its splits as a feature
+snapshot on the local S3, which the Lambda looks up and evicts as it does on S3, and is
+skipped when the snapshot of the extraction exists.
+"""
+import importlib.util
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+from contextlib import contextmanager
+
+from pipelines.fingerprint import file_digest, step_fingerprint
+from pipelines.local_services import LocalRedshiftDataClient, LocalS3
+from pipelines.bankdm import train as local_train
+from pipelines.bankdm import transform as local_transform
+from pipelines.bankdm import tuning as local_tuning
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.realpath(__file__))
+REPO_DIR = os.path.dirname(os.path.dirname(BASE_DIR))
+DEFAULT_DATA_PATH = os.path.join(REPO_DIR, "bank-additional", "bank-additional.csv")
+LAMBDA_PATH = os.path.join(REPO_DIR, "lambda_redshift_dl.py")
+
+# Mirrors the secret created in notebook 01
+DATABASE = "bankdm"
+SCHEMA = "dm"
+TABLE = "data"
+BUCKET = "local-bucket"
+
+
+class StageTimer:
+    """Collects the wall-clock duration of each pipeline stage."""
+
+    def __init__(self):
+        """Creates an empty timer."""
+        self.timings = []
+        self.cache = {}
+
+    @contextmanager
+    def stage(self, name):
+        """Times the enclosed block as the stage with the given name."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings.append((name, time.perf_counter() - start))
+
+    def report(self):
+        """Formats the per-stage timing breakdown as a table."""
+        total = sum(seconds for _, seconds in self.timings)
+        width = max([len(name) for name, _ in self.timings] + [len("Total")])
+        lines = [f"{'Stage':<{width}}  {'Seconds':>9}  {'Share':>6}  Cache"]
+        for name, seconds in self.timings:
+            share = seconds / total if total else 0.0
+            lines.append(f"{name:<{width}}  {seconds:>9.3f}  {share:>6.1%}  {self.cache.get(name, '-')}")
+        lines.append(f"{'Total':<{width}}  {total:>9.3f}  {1:>6.1%}")
+        return "\n".join(lines)
+
+
+def _load_lambda_module():
+    spec = importlib.util.spec_from_file_location("lambda_redshift_dl", LAMBDA_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _run_script(script, base_dir, cwd, *args):
+    subprocess.run(
+        [sys.executable, os.path.join(BASE_DIR, script), "--base-dir", base_dir, *args],
+        check=True,
+        cwd=cwd,
+    )
+
+
+def _job_dir(work_dir, step_name, fingerprint, *channels):
+    job_dir = os.path.join(work_dir, "jobs", step_name, fingerprint[:16])
+    if os.path.exists(job_dir):
+        shutil.rmtree(job_dir)
+    for channel in channels:
+        os.makedirs(os.path.join(job_dir, channel))
+    return job_dir
+
+
+@contextmanager
+def _cached_step(timer, work_dir, step_name, fingerprint, use_cache):
+    """Runs the enclosed step unless a previous run with the same fingerprint succeeded.
+
+    Yields the job directory of the step, or None when the cached result is reused.
+    """
+    job_dir = os.path.join(work_dir, "jobs", step_name, fingerprint[:16])
+    marker = os.path.join(job_dir, "_SUCCESS")
+    with timer.stage(step_name):
+        if use_cache and os.path.exists(marker):
+            timer.cache[step_name] = "hit"
+            yield None
+            return
+        timer.cache[step_name] = "miss"
+        yield job_dir
+        with open(marker, "w") as f:
+            f.write(fingerprint)
+
+
+def run_local_pipeline(
+    work_dir,
+    data_path=DEFAULT_DATA_PATH,
+    hyperparameters=None,
+    mse_threshold=None,
+    model_package_group_name="BankDM-Group",
+    use_cache=True,
+    training_instance_count=1,
+    training_input_mode=None,
+    enable_tuning=False,
+    tuning_max_jobs=27,
+    tuning_max_parallel_jobs=4,
+    enable_batch_transform=False,
+    transform_instance_count=2,
+    transform_max_payload=6,
+    score_shards=16,
+    key_column="row_id",
+    enable_drift_check=False,
+    negative_fraction=1.0,
+    snapshot_keep=5,
+    snapshot_max_age_days=30,
+    split_gzip_level=0,
+    test_arrays=False,
+):
+    """Runs the pipeline steps in-process or in subprocesses against work_dir.
+
+    Args:
+        work_dir: the directory holding the local S3, job directories and model registry
+        data_path: the csv file loaded into the stand-in Redshift table
+        hyperparameters: the training hyperparameters, defaults to those of the pipeline
+        mse_threshold: the registration threshold, defaults to that of the pipeline
+        model_package_group_name: the local model registry group to register to
+        use_cache: skip steps whose code, parameters and upstream data are unchanged
+        training_instance_count: the number of training workers, the train split is
+            written as one shard per worker
+        training_input_mode: the input mode of the training channels, File, Pipe or FastFile,
+            by default Pipe with gzipped splits and File otherwise
+        enable_tuning: replace Step-Train with Step-Tune, which tunes the hyperparameters
+            by successive halving and passes its best model on to Step-Eval
+        tuning_max_jobs: the number of candidates of the tuning step
+        tuning_max_parallel_jobs: the number of candidates trained at the same time
+        enable_batch_transform: score the whole table with the registered model and
+            write key and prediction per row to the job's output directory
+        transform_instance_count: the number of batch transform workers
+        transform_max_payload: the maximum size in MB of a mini-batch of records
+        score_shards: the number of files the table is scored in
+        key_column: the key column the stand-in table is created with, numbering its rows
+            from 1, and which the predictions of the batch transform are keyed by
+        enable_drift_check: compare the profile with that of the latest registered
+            model and skip training, evaluation and registration if nothing drifted
+        negative_fraction: the fraction of negative rows the train split keeps, the kept
+            ones weighted by 1 / fraction, all rows if 1
+        snapshot_keep: the number of most recently used feature snapshots to retain
+        snapshot_max_age_days: the days after which an unused feature snapshot is deleted
+        split_gzip_level: write the train, validation and test splits gzipped at this
+            level and read the training channels in Pipe mode, 0 for plain csv
+        test_arrays: also write the test split as float32 arrays, memory-mapped by Step-Eval
+
+    Returns:
+        a dict with the stage timings, the evaluation report and the registered model path
+    """
+    from pipelines.bankdm.pipeline import HYPERPARAMETERS, MSE_THRESHOLD, TUNING_RANGES, TUNING_REDUCTION_FACTOR
+
+    hyperparameters = HYPERPARAMETERS if hyperparameters is None else hyperparameters
+    if negative_fraction < 1:
+        hyperparameters = dict(hyperparameters, csv_weights=1)
+    mse_threshold = MSE_THRESHOLD if mse_threshold is None else mse_threshold
+    if split_gzip_level > 0:
+        # As the container, which decompresses a Gzip channel only in Pipe mode
+        if training_input_mode not in (None, "Pipe"):
+            raise ValueError(f"Gzipped splits are read in Pipe mode, not {training_input_mode}")
+        training_input_mode = "Pipe"
+    training_input_mode = training_input_mode or "File"
+    work_dir = os.path.abspath(work_dir)
+    s3 = LocalS3(os.path.join(work_dir, "s3"))
+    redshift = LocalRedshiftDataClient(s3)
+    timer = StageTimer()
+
+    with timer.stage("Load-RedShift-table"):
+        rows = redshift.load_csv(data_path, SCHEMA, TABLE, key_column=key_column)
+        logger.info("Loaded %d rows into %s.%s", rows, SCHEMA, TABLE)
+
+    with timer.stage("Lambda-RedShift-dl"):
+        lambda_module = _load_lambda_module()
+        unload_uri = f"s3://{BUCKET}/bankdm/unload/"
+        statement_id = lambda_module.unload_table(
+            redshift, DATABASE, "local-secret", "local-cluster", SCHEMA, TABLE, unload_uri,
+            "arn:aws:iam::000000000000:role/BankDM-RedShift",
+        )
+        lambda_module.wait_for_unload(redshift, statement_id, timeout=60)
+        manifest = lambda_module.manifest_digest(s3, BUCKET, "bankdm/unload/")
+        score_shards = score_shards if enable_batch_transform else 0
+        preprocess_digest = step_fingerprint(
+            file_digest(os.path.join(BASE_DIR, "preprocess.py")),
+            {
+                "score_shards": score_shards,
+                "negative_fraction": negative_fraction,
+                "gzip_level": split_gzip_level,
+                "test_arrays": test_arrays,
+                "key_column": key_column,
+            },
+        )
+        process_fp = lambda_module.snapshot_fingerprint(manifest, preprocess_digest, training_instance_count)
+        snapshot_uri, snapshot_hit = lambda_module.lookup_snapshot(s3, BUCKET, process_fp)
+        lambda_module.evict_snapshots(s3, BUCKET, snapshot_keep, snapshot_max_age_days, protect=[snapshot_uri])
+
+    # The splits are read from the snapshot, as the later steps read the published outputs
+    process_dir = s3.path(snapshot_uri)
+    channels = ("train", "validation", "test", "score", "features", "snapshot")
+    with timer.stage("Step-PreProcess"):
+        if use_cache and snapshot_hit:
+            timer.cache["Step-PreProcess"] = "hit"
+        else:
+            timer.cache["Step-PreProcess"] = "miss"
+            job_dir = _job_dir(work_dir, "Step-PreProcess", process_fp, "raw", *channels)
+            for uri in s3.list(unload_uri):
+                shutil.copy(s3.path(uri), os.path.join(job_dir, "raw"))
+            _run_script(
+                "preprocess.py",
+                job_dir,
+                job_dir,
+                "--train-shards",
+                str(training_instance_count),
+                "--score-shards",
+                str(score_shards),
+                "--negative-fraction",
+                str(negative_fraction),
+                "--gzip-level",
+                str(split_gzip_level),
+                *(["--test-arrays"] if test_arrays else []),
+                "--key-column",
+                key_column,
+                "--manifest-digest",
+                manifest,
+                "--code-digest",
+                file_digest(os.path.join(BASE_DIR, "preprocess.py")),
+            )
+            # Published channel by channel, the snapshot marker last
+            shutil.rmtree(process_dir, ignore_errors=True)
+            for channel in channels:
+                shutil.copytree(os.path.join(job_dir, channel), os.path.join(process_dir, channel))
+
+    profile_fp = step_fingerprint(file_digest(os.path.join(BASE_DIR, "profiling.py")), upstream=[manifest])
+    profile_dir = os.path.join(work_dir, "jobs", "Step-Profile", profile_fp[:16])
+    with _cached_step(timer, work_dir, "Step-Profile", profile_fp, use_cache) as job_dir:
+        if job_dir:
+            _job_dir(work_dir, "Step-Profile", profile_fp, "raw", "profile")
+            for uri in s3.list(unload_uri):
+                shutil.copy(s3.path(uri), os.path.join(profile_dir, "raw"))
+            _run_script("profiling.py", profile_dir, profile_dir)
+
+    drift = None
+    if enable_drift_check:
+        reference = latest_registered_profile(work_dir, model_package_group_name)
+        drift_fp = step_fingerprint(
+            file_digest(os.path.join(BASE_DIR, "drift.py")),
+            upstream=[profile_fp, process_fp, file_digest(reference) if reference else "no-reference"],
+        )
+        drift_dir = os.path.join(work_dir, "jobs", "Step-DriftCheck", drift_fp[:16])
+        with _cached_step(timer, work_dir, "Step-DriftCheck", drift_fp, use_cache) as job_dir:
+            if job_dir:
+                _job_dir(work_dir, "Step-DriftCheck", drift_fp, "profile", "features", "reference")
+                shutil.copy(os.path.join(profile_dir, "profile", "profile.json"), os.path.join(drift_dir, "profile"))
+                shutil.copy(os.path.join(process_dir, "features", "features.json"), os.path.join(drift_dir, "features"))
+                if reference:
+                    shutil.copy(reference, os.path.join(drift_dir, "reference"))
+                _run_script("drift.py", drift_dir, drift_dir)
+        with open(os.path.join(drift_dir, "drift", "drift.json")) as f:
+            drift = json.load(f)
+        if not drift["drift"]["detected"]:
+            logger.info("No drift against the latest registered model, skipping training.")
+            return {
+                "timings": timer.timings,
+                "cache": timer.cache,
+                "report": timer.report(),
+                "evaluation": None,
+                "registered": None,
+                "tuning": None,
+                "transform": None,
+                "model": None,
+                "features": os.path.join(process_dir, "features", "features.json"),
+                "snapshot": snapshot_uri,
+                "profile": os.path.join(profile_dir, "profile", "profile.json"),
+                "drift": drift,
+            }
+
+    train_step = "Step-Tune" if enable_tuning else "Step-Train"
+    train_params = dict(hyperparameters, instance_count=training_instance_count)
+    if enable_tuning:
+        train_params = dict(hyperparameters, ranges=TUNING_RANGES, max_jobs=tuning_max_jobs)
+    train_fp = step_fingerprint(
+        file_digest(os.path.join(BASE_DIR, "tuning.py" if enable_tuning else "train.py")),
+        train_params,
+        upstream=[process_fp],
+    )
+    train_dir = os.path.join(work_dir, "jobs", train_step, train_fp[:16])
+    model_path = os.path.join(train_dir, "output", "model.tar.gz")
+    tuning_path = os.path.join(train_dir, "output", "tuning.json")
+    with _cached_step(timer, work_dir, train_step, train_fp, use_cache) as job_dir:
+        if job_dir and enable_tuning:
+            _job_dir(work_dir, train_step, train_fp)
+            tuning = local_tuning.tune(
+                os.path.join(process_dir, "train"),
+                os.path.join(process_dir, "validation"),
+                os.path.dirname(model_path),
+                hyperparameters,
+                TUNING_RANGES,
+                max_jobs=tuning_max_jobs,
+                max_parallel_jobs=tuning_max_parallel_jobs,
+                reduction_factor=TUNING_REDUCTION_FACTOR,
+            )
+            with open(tuning_path, "w") as f:
+                json.dump(tuning, f, indent=2)
+        elif job_dir:
+            _job_dir(work_dir, train_step, train_fp)
+            local_train.train(
+                os.path.join(process_dir, "train"),
+                os.path.join(process_dir, "validation"),
+                os.path.dirname(model_path),
+                hyperparameters,
+                instance_count=training_instance_count,
+                input_mode=training_input_mode,
+                # Outside the job directory, so that a rerun after a failure resumes
+                checkpoint_dir=os.path.join(work_dir, "checkpoints", train_step, train_fp[:16]),
+            )
+    tuning = None
+    if enable_tuning:
+        with open(tuning_path) as f:
+            tuning = json.load(f)
+
+    eval_fp = step_fingerprint(
+        file_digest(os.path.join(BASE_DIR, "evaluate.py")), upstream=[train_fp, process_fp]
+    )
+    eval_dir = os.path.join(work_dir, "jobs", "Step-Eval", eval_fp[:16])
+    with _cached_step(timer, work_dir, "Step-Eval", eval_fp, use_cache) as job_dir:
+        if job_dir:
+            _job_dir(work_dir, "Step-Eval", eval_fp, "model", "test")
+            shutil.copy(model_path, os.path.join(eval_dir, "model"))
+            for name in os.listdir(os.path.join(process_dir, "test")):
+                shutil.copy(os.path.join(process_dir, "test", name), os.path.join(eval_dir, "test"))
+            _run_script("evaluate.py", eval_dir, eval_dir)
+    with open(os.path.join(eval_dir, "evaluation", "evaluation.json")) as f:
+        report = json.load(f)
+
+    registered = None
+    with timer.stage("Step-AccuracyCond"):
+        if report["regression_metrics"]["mse"]["value"] <= mse_threshold:
+            registered = register_model(
+                work_dir, model_package_group_name, model_path, report,
+                os.path.join(profile_dir, "profile", "profile.json"),
+            )
+
+    transform = None
+    if enable_batch_transform and registered:
+        transform_fp = step_fingerprint(
+            file_digest(os.path.join(BASE_DIR, "transform.py")),
+            {"instance_count": transform_instance_count, "max_payload": transform_max_payload},
+            upstream=[train_fp, process_fp],
+        )
+        transform_dir = os.path.join(work_dir, "jobs", "Step-BatchTransform", transform_fp[:16])
+        with _cached_step(timer, work_dir, "Step-BatchTransform", transform_fp, use_cache) as job_dir:
+            if job_dir:
+                _job_dir(work_dir, "Step-BatchTransform", transform_fp)
+                transform = local_transform.batch_transform(
+                    model_path,
+                    os.path.join(process_dir, "score"),
+                    os.path.join(transform_dir, "output"),
+                    instance_count=transform_instance_count,
+                    max_payload=transform_max_payload,
+                )
+                with open(os.path.join(transform_dir, "transform.json"), "w") as f:
+                    json.dump(transform, f)
+        with open(os.path.join(transform_dir, "transform.json")) as f:
+            transform = dict(json.load(f), output_dir=os.path.join(transform_dir, "output"))
+
+    return {
+        "timings": timer.timings,
+        "cache": timer.cache,
+        "report": timer.report(),
+        "evaluation": report,
+        "registered": registered,
+        "tuning": tuning,
+        "transform": transform,
+        "model": model_path,
+        "features": os.path.join(process_dir, "features", "features.json"),
+        "snapshot": snapshot_uri,
+        "profile": os.path.join(profile_dir, "profile", "profile.json"),
+        "drift": drift,
+    }
+
+
+def register_model(work_dir, model_package_group_name, model_path, report, profile_path=None):
+    """Registers the model as the next version of a group in the local model registry.
+
+    Args:
+        work_dir: the directory holding the registry
+        model_package_group_name: the group to register to
+        model_path: the model.tar.gz
+        report: the evaluation report
+        profile_path: the profile.json of the training data, kept with the model as the
+            reference of later drift checks
+
+    Returns:
+        the directory of the new model package version
+    """
+    group_dir = os.path.join(work_dir, "registry", model_package_group_name)
+    os.makedirs(group_dir, exist_ok=True)
+    version = 1 + max([int(v) for v in os.listdir(group_dir) if v.isdigit()] + [0])
+    package_dir = os.path.join(group_dir, str(version))
+    os.makedirs(package_dir)
+    shutil.copy(model_path, package_dir)
+    with open(os.path.join(package_dir, "evaluation.json"), "w") as f:
+        json.dump(report, f)
+    if profile_path:
+        shutil.copy(profile_path, package_dir)
+    return package_dir
+
+
+def latest_registered_profile(work_dir, model_package_group_name):
+    """Returns the profile.json of the latest version of a group, None if there is none."""
+    group_dir = os.path.join(work_dir, "registry", model_package_group_name)
+    if not os.path.isdir(group_dir):
+        return None
+    for version in sorted((int(v) for v in os.listdir(group_dir) if v.isdigit()), reverse=True):
+        path = os.path.join(group_dir, str(version), "profile.json")
+        if os.path.exists(path):
+            return path
+    return None
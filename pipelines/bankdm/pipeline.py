@@ -17,55 +17,65 @@
                                               .
                                                . -(stop)
 Implements a get_pipeline(**kwargs) method.
+
+The SageMaker SDK and boto3 take seconds to import, so they are imported inside the
+functions that need them. The CLIs can then parse arguments, print --help and convert
+tags without loading them.
 """
 
+import functools
+import json
 import os
 
-import boto3
-import sagemaker
-import sagemaker.session
+from pipelines.fingerprint import file_digest, step_fingerprint
 
-from sagemaker.estimator import Estimator
-from sagemaker.inputs import TrainingInput
-from sagemaker.processing import (
-    ProcessingInput,
-    ProcessingOutput,
-    ScriptProcessor,
-)
-from sagemaker.sklearn.processing import SKLearnProcessor
-from sagemaker.workflow.conditions import (
-    ConditionLessThanOrEqualTo,
-)
-from sagemaker.workflow.condition_step import (
-    ConditionStep,
-    JsonGet,
-)
-from sagemaker.model_metrics import (
-    MetricsSource,
-    ModelMetrics,
-)
-from sagemaker.workflow.parameters import (
-    ParameterInteger,
-    ParameterString,
-)
-from sagemaker.workflow.pipeline import Pipeline
-from sagemaker.workflow.properties import PropertyFile
-from sagemaker.workflow.steps import (
-    ProcessingStep,
-    TrainingStep,
+BASE_DIR = os.path.dirname(os.path.realpath(__file__))
+
+# https://github.com/dmlc/xgboost/blob/master/doc/parameter.rst
+# Shared with the local pipeline runner so that both train the same model.
+HYPERPARAMETERS = dict(
+    objective="reg:squarederror",
+    num_round=50,
+    max_depth=6, # default
+    eta=0.3, # default
+    gamma=0, # default
+    min_child_weight=1, # default
+    subsample=0.7,
+    silent=0,
 )
-from sagemaker.workflow.step_collections import RegisterModel
 
-from boto3.session import Session
+# Models with a test mse above this threshold are not registered
+MSE_THRESHOLD = 10.0
+
+# The built-in XGBoost container training, evaluating and serving the model. Evaluation
+# predicts the test split in place, which needs xgboost 1.1 or later.
+XGBOOST_VERSION = "1.2-1"
 
-from sagemaker.workflow.lambda_step import (
-    LambdaStep,
-    LambdaOutput,
-    LambdaOutputTypeEnum,
+# Search space of the tuning stage as (type, min, max), shared with the local tuner
+TUNING_RANGES = dict(
+    max_depth=("Integer", 3, 10),
+    eta=("Continuous", 0.05, 0.5),
+    gamma=("Continuous", 0, 5),
+    min_child_weight=("Continuous", 1, 10),
+    subsample=("Continuous", 0.5, 1.0),
 )
-from sagemaker.lambda_helper import Lambda
+# Successive halving keeps the best 1/TUNING_REDUCTION_FACTOR of the trials of each rung
+TUNING_REDUCTION_FACTOR = 3
 
-BASE_DIR = os.path.dirname(os.path.realpath(__file__))
+
+@functools.lru_cache(maxsize=None)
+def get_boto_session(region):
+    """Gets the boto3 session for the region, shared by every client of the pipeline build.
+
+    Args:
+        region: the aws region to start the session
+
+    Returns:
+        `boto3.Session` instance
+    """
+    import boto3
+
+    return boto3.Session(region_name=region)
 
 
 def get_sagemaker_client(region):
@@ -73,16 +83,16 @@ def get_sagemaker_client(region):
 
         Args:
             region: the aws region to start the session
-            default_bucket: the bucket to use for storing the artifacts
 
         Returns:
-            `sagemaker.session.Session instance
+            the sagemaker boto3 client
         """
-     boto_session = boto3.Session(region_name=region)
+     boto_session = get_boto_session(region)
      sagemaker_client = boto_session.client("sagemaker")
      return sagemaker_client
 
 
+@functools.lru_cache(maxsize=None)
 def get_session(region, default_bucket):
     """Gets the sagemaker session based on the region.
 
@@ -93,8 +103,9 @@ def get_session(region, default_bucket):
     Returns:
         `sagemaker.session.Session instance
     """
+    import sagemaker.session
 
-    boto_session = boto3.Session(region_name=region)
+    boto_session = get_boto_session(region)
 
     sagemaker_client = boto_session.client("sagemaker")
     runtime_client = boto_session.client("sagemaker-runtime")
@@ -118,6 +129,99 @@ def get_pipeline_custom_tags(new_tags, region, sagemaker_project_arn=None):
     return new_tags
 
 
+def resolve_environment(
+    region,
+    sagemaker_session,
+    role=None,
+    account_id=None,
+    image_uri=None,
+    default_bucket=None,
+    offline=False,
+    env_cache=None,
+):
+    """Resolves the account, role, training image and bucket the definition is built for.
+
+    Values passed as arguments win, then those of the region in the env_cache file. Any
+    still missing are looked up from AWS and written back to env_cache, unless offline.
+
+    Args:
+        region: the aws region of the pipeline
+        sagemaker_session: the session used for the AWS lookups
+        role: IAM role to create and run steps and pipeline
+        account_id: the AWS account id hosting the lambda
+        image_uri: the XGBoost image of the XGBOOST_VERSION container
+        default_bucket: the bucket to use for storing the artifacts
+        offline: fail instead of calling AWS for values that are not given or cached
+        env_cache: optional path of a JSON file caching the values per region
+
+    Returns:
+        a dict with the account_id, role, image_uri and default_bucket
+    """
+    import sagemaker.image_uris
+    import sagemaker.session
+
+    cache = {}
+    if env_cache and os.path.exists(env_cache):
+        with open(env_cache) as f:
+            cache = json.load(f)
+    given = dict(account_id=account_id, role=role, image_uri=image_uri, default_bucket=default_bucket)
+    env = {k: v if v is not None else cache.get(region, {}).get(k) for k, v in given.items()}
+
+    missing = [k for k, v in env.items() if v is None]
+    if missing and offline:
+        raise ValueError(f"Offline definition needs {', '.join(missing)} as arguments or in the env cache")
+    if env["account_id"] is None:
+        env["account_id"] = get_boto_session(region).client("sts").get_caller_identity()["Account"]
+    if env["role"] is None:
+        env["role"] = sagemaker.session.get_execution_role(sagemaker_session)
+    if env["image_uri"] is None:
+        env["image_uri"] = sagemaker.image_uris.retrieve(
+            framework="xgboost",  # we are using the Sagemaker built in xgboost algorithm
+            region=region,
+            version=XGBOOST_VERSION,
+            py_version="py3",
+            instance_type="ml.m5.xlarge",
+        )
+    if env["default_bucket"] is None:
+        env["default_bucket"] = sagemaker_session.default_bucket()
+
+    if missing and env_cache:
+        cache[region] = env
+        with open(env_cache, "w") as f:
+            json.dump(cache, f, indent=2, sort_keys=True)
+    return env
+
+
+def get_code_uri(sagemaker_session, bucket, base_job_prefix, script, offline=False):
+    """Gets the content-addressed S3 uri of a processing script, uploading it unless offline.
+
+    The uri only changes with the script, so that definitions built offline and online
+    are identical and step caching is not defeated by a new upload location.
+    """
+    from sagemaker.s3 import S3Uploader
+
+    path = os.path.join(BASE_DIR, script)
+    code_dir = f"s3://{bucket}/{base_job_prefix}/code/{file_digest(path)[:16]}"
+    if not offline:
+        S3Uploader.upload(path, code_dir, sagemaker_session=sagemaker_session)
+    return f"{code_dir}/{script}"
+
+
+def run_local_pipeline(work_dir, **kwargs):
+    """Runs the pipeline offline with local stand-ins for the AWS services.
+
+    Args:
+        work_dir: the directory standing in for S3 and the job volumes
+        kwargs: see pipelines.bankdm.local_pipeline.run_local_pipeline
+
+    Returns:
+        the result of the local run including the per-stage timings
+    """
+    from pipelines.bankdm.local_pipeline import run_local_pipeline as _run_local_pipeline
+
+    return _run_local_pipeline(work_dir, **kwargs)
+
+
 def get_pipeline(
     region,
     sagemaker_project_arn=None,
@@ -126,18 +230,151 @@ def get_pipeline(
     model_package_group_name="BankDM-Group",  # Choose any name
     pipeline_name="BankDM-Pipeline",  # You can find your pipeline name in the Studio UI (project -> Pipelines -> name)
     base_job_prefix="BankDM-",  # Choose any name
+    enable_step_cache=True,
+    cache_expire_after="P30D",
+    account_id=None,
+    image_uri=None,
+    offline=False,
+    env_cache=None,
+    enable_tuning=False,
+    tuning_max_jobs=27,
+    use_spot_instances=False,
+    max_run=24 * 60 * 60,
+    max_wait=None,
+    enable_batch_transform=False,
+    transform_max_payload=6,
+    score_shards=16,
+    key_column=None,
+    enable_drift_check=False,
+    negative_fraction=1.0,
+    snapshot_keep=5,
+    snapshot_max_age_days=30,
+    split_gzip_level=0,
+    test_arrays=False,
 ):
     """Gets a SageMaker ML Pipeline instance.
     Args:
         region: AWS region to create and run the pipeline.
         role: IAM role to create and run steps and pipeline.
         default_bucket: the bucket to use for storing the artifacts
+        enable_step_cache: reuse the results of steps whose code, hyperparameters and
+            upstream data are unchanged since a previous successful execution
+        cache_expire_after: ISO 8601 duration for which cached step results are reused
+        account_id: the AWS account id hosting the lambda, looked up with STS if not given
+        image_uri: the XGBoost training image, looked up in the SDK if not given
+        offline: build the definition without calling AWS, see resolve_environment
+        env_cache: optional JSON file caching the account, role, image and bucket
+        enable_tuning: replace the training step with a Hyperband tuning step over
+            TUNING_RANGES, whose best model is evaluated and registered
+        tuning_max_jobs: the number of training jobs the tuning step may launch
+        use_spot_instances: train on managed spot capacity, resuming interrupted jobs
+            from their last checkpoint
+        max_run: the maximum training time in seconds
+        max_wait: the maximum time in seconds to wait for spot capacity and train,
+            defaults to max_run
+        enable_batch_transform: score the features of the whole table with a batch
+            transform of the registered model, writing key and prediction per row
+        transform_max_payload: the maximum size in MB of a mini-batch of records sent to
+            the model, larger batches amortise the per-request overhead
+        score_shards: the number of files the table is scored in, which the transform
+            distributes across its instances
+        key_column: the key column of the table, required by the batch transform to
+            join the predictions back to the rows; it is not a model input
+        enable_drift_check: compare the profile of the unloaded data with the profile
+            registered with the latest approved model, and only train, evaluate and
+            register when the data drifted
+        negative_fraction: the fraction of negative rows the train split keeps, the kept
+            ones weighted by 1 / fraction through csv_weights, all rows if 1
+        snapshot_keep: the number of most recently used feature snapshots to retain
+        snapshot_max_age_days: the days after which an unused feature snapshot is
+            deleted, at least the cache expiry so that cached steps find their snapshot
+        split_gzip_level: write the train, validation and test splits as gzip files of
+            this level, compressed in parallel, and read the training channels in Pipe
+            mode, the only mode in which the container decompresses them, and thus the
+            only value the TrainingInputMode parameter then accepts; 0 for plain csv
+        test_arrays: also write the test split as memory-mappable float32 arrays, which
+            the evaluation predicts on without parsing csv or building a DMatrix
     Returns:
         an instance of a pipeline
     """
+    if enable_batch_transform and not key_column:
+        raise ValueError("The batch transform needs the key_column of the table to join the predictions on")
+    from sagemaker.estimator import Estimator
+    from sagemaker.tuner import (
+        ContinuousParameter,
+        HyperbandStrategyConfig,
+        HyperparameterTuner,
+        IntegerParameter,
+        StrategyConfig,
+    )
+    from sagemaker.inputs import CreateModelInput, TrainingInput, TransformInput
+    from sagemaker.model import Model
+    from sagemaker.transformer import Transformer
+    from sagemaker.processing import (
+        ProcessingInput,
+        ProcessingOutput,
+        ScriptProcessor,
+    )
+    from sagemaker.sklearn.processing import SKLearnProcessor
+    from sagemaker.workflow.conditions import (
+        ConditionEquals,
+        ConditionLessThanOrEqualTo,
+    )
+    from sagemaker.workflow.condition_step import (
+        ConditionStep,
+        JsonGet,
+    )
+    from sagemaker.model_metrics import (
+        MetricsSource,
+        ModelMetrics,
+    )
+    from sagemaker.workflow.functions import Join
+    from sagemaker.workflow.execution_variables import ExecutionVariables
+    from sagemaker.workflow.parameters import (
+        ParameterInteger,
+        ParameterString,
+    )
+    from sagemaker.workflow.pipeline import Pipeline
+    from sagemaker.workflow.properties import PropertyFile
+    from sagemaker.workflow.steps import (
+        CacheConfig,
+        CreateModelStep,
+        ProcessingStep,
+        TrainingStep,
+        TransformStep,
+        TuningStep,
+    )
+    from sagemaker.workflow.step_collections import RegisterModel
+    from sagemaker.workflow.lambda_step import (
+        LambdaStep,
+        LambdaOutput,
+        LambdaOutputTypeEnum,
+    )
+    from sagemaker.lambda_helper import Lambda
+
     sagemaker_session = get_session(region, default_bucket)
-    if role is None:
-        role = sagemaker.session.get_execution_role(sagemaker_session)
+    env = resolve_environment(
+        region,
+        sagemaker_session,
+        role=role,
+        account_id=account_id,
+        image_uri=image_uri,
+        default_bucket=default_bucket,
+        offline=offline,
+        env_cache=env_cache,
+    )
+    role = env["role"]
+    accountID = env["account_id"]
+    default_bucket = env["default_bucket"]
+
+    def step_output(step_name, output_name):
+        # The layout the SDK gives outputs without a destination, spelled out so that
+        # building the definition never looks up or creates the default bucket
+        return Join(
+            on="/",
+            values=["s3:/", default_bucket, pipeline_name, ExecutionVariables.PIPELINE_EXECUTION_ID, step_name,
+                    "output", output_name],
+        )
 
     # Parameters for pipeline execution
     # Some parameters are passed in from codebuild-buildspec.yml
@@ -150,6 +387,28 @@ def get_pipeline(
     training_instance_type = ParameterString(
         name="TrainingInstanceType", default_value="ml.m5.xlarge"
     )
+    # The train split is written as one shard per training instance
+    training_instance_count = ParameterInteger(
+        name="TrainingInstanceCount", default_value=1
+    )
+    # Pipe and FastFile stream the channels instead of copying them to the volume first,
+    # so that the first boosting round does not wait on the size of the data. Gzipped
+    # splits are only decompressed by the container in Pipe mode, so with a gzip level
+    # Pipe is the only value accepted and an execution passing another one is rejected.
+    training_input_mode = ParameterString(
+        name="TrainingInputMode",
+        default_value="Pipe" if split_gzip_level > 0 else "File",
+        enum_values=["Pipe"] if split_gzip_level > 0 else ["File", "Pipe", "FastFile"],
+    )
+    transform_instance_count = ParameterInteger(
+        name="TransformInstanceCount", default_value=2
+    )
+    transform_instance_type = ParameterString(
+        name="TransformInstanceType", default_value="ml.m5.large"
+    )
+    tuning_max_parallel_jobs = ParameterInteger(
+        name="TuningMaxParallelJobs", default_value=4
+    )
     model_approval_status = ParameterString(
         name="ModelApprovalStatus",
         default_value="Approved"
@@ -159,20 +418,42 @@ def get_pipeline(
         name="InputDataUrl",
         default_value=default_bucket, 
     )
-    
-    sts = boto3.client('sts')
-    accountID = sts.get_caller_identity()["Account"]  
+
+
+    # Step arguments are the cache key, so the processing steps are also passed the digest
+    # of their code and of the unloaded data. Only steps whose inputs changed re-execute.
+    cache_config = CacheConfig(enable_caching=enable_step_cache, expire_after=cache_expire_after)
 
     #---
     # Use a pre-created lambda to download data from RedShift to S3
     step_redshift_download = LambdaStep(
         name="Lambda-RedShift-dl",
         lambda_func=Lambda(
-          function_arn=f"arn:aws:lambda:{region}:{accountID}:function:bankdm-redshift-dl"
+          function_arn=f"arn:aws:lambda:{region}:{accountID}:function:bankdm-redshift-dl",
+          session=sagemaker_session,
         ),
         inputs={
-            "bucket": s3bucket
+            "bucket": s3bucket,
+            # The lambda looks up the feature snapshot of the extraction by these and the
+            # manifest digest, and evicts old snapshots
+            "preprocess_digest": step_fingerprint(
+                file_digest(os.path.join(BASE_DIR, "preprocess.py")),
+                {
+                    "score_shards": score_shards if enable_batch_transform else 0,
+                    "negative_fraction": negative_fraction,
+                    "gzip_level": split_gzip_level,
+                    "test_arrays": test_arrays,
+                    "key_column": key_column,
+                },
+            ),
+            "train_shards": training_instance_count,
+            "snapshot_keep": snapshot_keep,
+            "snapshot_max_age_days": snapshot_max_age_days,
         },
+        outputs=[
+            LambdaOutput(output_name="manifest_digest", output_type=LambdaOutputTypeEnum.String),
+            LambdaOutput(output_name="snapshot_uri", output_type=LambdaOutputTypeEnum.String),
+        ],
     )
 
     # Another way is to use SageMaker Pipelines to create a lambda function. 
@@ -203,81 +484,200 @@ def get_pipeline(
         role=role,
     )
         
+    # The splits are published as the feature snapshot of the extraction the lambda points
+    # to. On a snapshot hit the step arguments are those of the execution that built it, so
+    # the step cache reuses its outputs instead of preprocessing again.
     step_process = ProcessingStep(
         name="Step-PreProcess",  
         processor=sklearn_processor,
         inputs=[
             ProcessingInput(
-                source=f's3://{s3bucket}/bankdm/unload/',
+                source=Join(on="/", values=["s3:/", s3bucket, "bankdm", "unload/"]),
                 destination="/opt/ml/processing/raw",
             )
         ],
         outputs=[
-            ProcessingOutput(output_name="train", source="/opt/ml/processing/train"),
-            ProcessingOutput(output_name="validation", source="/opt/ml/processing/validation"),
-            ProcessingOutput(output_name="test", source="/opt/ml/processing/test"),
+            ProcessingOutput(
+                output_name=name,
+                source=f"/opt/ml/processing/{name}",
+                destination=Join(on="/", values=[step_redshift_download.properties.Outputs["snapshot_uri"], name]),
+            )
+            # features is the fitted feature transform, for scoring raw rows offline, and
+            # snapshot the marker of a complete feature snapshot
+            for name in ["train", "validation", "test", "features"]
+            + (["score"] if enable_batch_transform else [])
+            + ["snapshot"]
         ],
-        code=os.path.join(BASE_DIR, "preprocess.py"),
+        code=get_code_uri(sagemaker_session, default_bucket, base_job_prefix, "preprocess.py", offline),
+        job_arguments=[
+            "--manifest-digest",
+            step_redshift_download.properties.Outputs["manifest_digest"],
+            "--code-digest",
+            file_digest(os.path.join(BASE_DIR, "preprocess.py")),
+            "--train-shards",
+            training_instance_count.to_string(),
+            "--score-shards",
+            str(score_shards if enable_batch_transform else 0),
+        ] + (["--negative-fraction", str(negative_fraction)] if negative_fraction < 1 else [])
+        + (["--gzip-level", str(split_gzip_level)] if split_gzip_level > 0 else [])
+        + (["--test-arrays"] if test_arrays else [])
+        + (["--key-column", key_column] if key_column else []),
+        cache_config=cache_config,
     )
     
     step_process.add_depends_on([step_redshift_download])
     #---
 
     #---
-    # Training step for generating model artifacts
-    model_path = f"s3://{sagemaker_session.default_bucket()}/{base_job_prefix}/Train"
-    image_uri = sagemaker.image_uris.retrieve(
-        framework="xgboost",  # we are using the Sagemaker built in xgboost algorithm
-        region=region,
-        version="1.0-1",
-        py_version="py3",
-        instance_type=training_instance_type,
+    # Processing step profiling the unloaded shards in one streaming pass, in parallel with
+    # the preprocessing. A single instance, as its processes merge the partial profiles.
+    profile_processor = SKLearnProcessor(
+        framework_version="0.23-1",
+        instance_type=processing_instance_type,
+        instance_count=1,
+        base_job_name=f"{base_job_prefix}/sklearn-profile",
+        sagemaker_session=sagemaker_session,
+        role=role,
+    )
+    step_profile = ProcessingStep(
+        name="Step-Profile",
+        processor=profile_processor,
+        inputs=[
+            ProcessingInput(
+                source=Join(on="/", values=["s3:/", s3bucket, "bankdm", "unload/"]),
+                destination="/opt/ml/processing/raw",
+            )
+        ],
+        outputs=[
+            ProcessingOutput(
+                output_name="profile",
+                source="/opt/ml/processing/profile",
+                destination=step_output("Step-Profile", "profile"),
+            )
+        ],
+        code=get_code_uri(sagemaker_session, default_bucket, base_job_prefix, "profiling.py", offline),
+        job_arguments=[
+            "--manifest-digest",
+            step_redshift_download.properties.Outputs["manifest_digest"],
+            "--code-digest",
+            file_digest(os.path.join(BASE_DIR, "profiling.py")),
+        ],
+        cache_config=cache_config,
     )
+    #---
+
+    #---
+    # Training step for generating model artifacts
+    model_path = f"s3://{default_bucket}/{base_job_prefix}/Train"
+    image_uri = env["image_uri"]
     
-    save_interval = 5 
+    # A downsampled train split carries instance weights after the label
+    hyperparameters = dict(HYPERPARAMETERS, csv_weights=1) if negative_fraction < 1 else HYPERPARAMETERS
+
+    # The built-in container checkpoints the booster to checkpoint_s3_uri and resumes from
+    # it when a (spot) job restarts. The prefix is keyed on the data, the preprocessing code,
+    # the hyperparameters and the instance count, so a job only resumes from checkpoints of
+    # the same training run, while identical runs keep identical arguments for step caching.
+    # Tuning trials would share the prefix, so they are not checkpointed.
+    checkpoint_s3_uri = None
+    if not enable_tuning:
+        checkpoint_key = step_fingerprint(
+            file_digest(os.path.join(BASE_DIR, "preprocess.py")),
+            {"hyperparameters": hyperparameters, "image_uri": image_uri},
+        )
+        checkpoint_s3_uri = Join(
+            on="/",
+            values=[
+                "s3:/",
+                default_bucket,
+                f"{base_job_prefix}/checkpoints",
+                step_redshift_download.properties.Outputs["manifest_digest"],
+                checkpoint_key[:16],
+                training_instance_count.to_string(),
+            ],
+        )
     # https://sagemaker.readthedocs.io/en/stable/api/training/estimators.html#sagemaker.estimator.Estimator
     xgb_train = Estimator(
         image_uri=image_uri,
         instance_type=training_instance_type,
-        instance_count=1,
+        instance_count=training_instance_count,
         output_path=model_path,
         base_job_name=f"{base_job_prefix}/Train",
         sagemaker_session=sagemaker_session,
         role=role,
-
-    )
-    xgb_train.set_hyperparameters(
-        # https://github.com/dmlc/xgboost/blob/master/doc/parameter.rst
-        objective="reg:squarederror",
-        num_round=50,
-        max_depth=6, # default
-        eta=0.3, # default
-        gamma=0, # default
-        min_child_weight=1, # default
-        subsample=0.7,
-        silent=0,
-            
+        # The default profiler rule carries a timestamp, which would defeat step caching
+        disable_profiler=True,
+        checkpoint_s3_uri=checkpoint_s3_uri,
+        use_spot_instances=use_spot_instances,
+        max_run=max_run,
+        max_wait=(max_wait or max_run) if use_spot_instances else None,
     )
+    xgb_train.set_hyperparameters(**hyperparameters)
     
-    # Outputs model automatically
-    step_train = TrainingStep(
-        name="Step-Train",
-        estimator=xgb_train,
-        inputs={
-            "train": TrainingInput(
-                s3_data=step_process.properties.ProcessingOutputConfig.Outputs[
-                    "train"
-                ].S3Output.S3Uri,
-                content_type="text/csv",
-            ),
-            "validation": TrainingInput(
-                s3_data=step_process.properties.ProcessingOutputConfig.Outputs[
-                    "validation"
-                ].S3Output.S3Uri,
-                content_type="text/csv",
+    # Pipe mode, the only TrainingInputMode then accepted, decompresses gzipped channels
+    channel_options = {"input_mode": training_input_mode}
+    if split_gzip_level > 0:
+        channel_options["compression"] = "Gzip"
+    training_inputs = {
+        "train": TrainingInput(
+            s3_data=step_process.properties.ProcessingOutputConfig.Outputs[
+                "train"
+            ].S3Output.S3Uri,
+            content_type="text/csv",
+            # Every instance downloads only its own shards of the train split
+            distribution="ShardedByS3Key",
+            **channel_options,
+        ),
+        "validation": TrainingInput(
+            s3_data=step_process.properties.ProcessingOutputConfig.Outputs[
+                "validation"
+            ].S3Output.S3Uri,
+            content_type="text/csv",
+            **channel_options,
+        ),
+    }
+
+    if not enable_tuning:
+        # Outputs model automatically
+        step_train = TrainingStep(
+            name="Step-Train",
+            estimator=xgb_train,
+            inputs=training_inputs,
+            cache_config=cache_config,
+        )
+        model_data = step_train.properties.ModelArtifacts.S3ModelArtifacts
+    else:
+        # Hyperband runs the trials in parallel, stops trials whose validation rmse lags
+        # behind after a few rounds and only lets the best ones train for all num_round
+        parameter_types = {"Integer": IntegerParameter, "Continuous": ContinuousParameter}
+        tuner = HyperparameterTuner(
+            estimator=xgb_train,
+            objective_metric_name="validation:rmse",
+            objective_type="Minimize",
+            hyperparameter_ranges={
+                name: parameter_types[kind](low, high) for name, (kind, low, high) in TUNING_RANGES.items()
+            },
+            strategy="Hyperband",
+            strategy_config=StrategyConfig(
+                hyperband_strategy_config=HyperbandStrategyConfig(
+                    min_resource=max(1, HYPERPARAMETERS["num_round"] // TUNING_REDUCTION_FACTOR ** 2),
+                    max_resource=HYPERPARAMETERS["num_round"],
+                )
             ),
-        },
-    )
+            max_jobs=tuning_max_jobs,
+            max_parallel_jobs=tuning_max_parallel_jobs,
+            base_tuning_job_name=f"{base_job_prefix}/Tune",
+        )
+        step_train = TuningStep(
+            name="Step-Tune",
+            tuner=tuner,
+            inputs=training_inputs,
+            cache_config=cache_config,
+        )
+        # The best training job of the tuning job, see output_path of the estimator
+        model_data = step_train.get_top_model_s3_uri(
+            top_k=0, s3_bucket=default_bucket, prefix=f"{base_job_prefix}/Train"
+        )
     #---
 
     #---
@@ -304,7 +704,7 @@ def get_pipeline(
         # Takes in the model and test data
         inputs=[
             ProcessingInput(
-                source=step_train.properties.ModelArtifacts.S3ModelArtifacts,
+                source=model_data,
                 destination="/opt/ml/processing/model",
             ),
             ProcessingInput(
@@ -316,12 +716,15 @@ def get_pipeline(
         ],
         outputs=[
             ProcessingOutput(
-                output_name="evaluation", source="/opt/ml/processing/evaluation"
+                output_name="evaluation",
+                source="/opt/ml/processing/evaluation",
+                destination=step_output("Step-Eval", "evaluation"),
             ),
         ],
-        code=os.path.join(BASE_DIR, "evaluate.py"),
+        code=get_code_uri(sagemaker_session, default_bucket, base_job_prefix, "evaluate.py", offline),
+        job_arguments=["--code-digest", file_digest(os.path.join(BASE_DIR, "evaluate.py"))],
         property_files=[evaluation_report],
-        
+        cache_config=cache_config,
     )
     #---
     
@@ -329,9 +732,26 @@ def get_pipeline(
     #---
     # Metric data
     model_metrics = ModelMetrics(
+        # The profile of the training data, the reference of later drift checks
+        model_data_statistics=MetricsSource(
+            s3_uri=Join(
+                on="/",
+                values=[
+                    step_profile.properties.ProcessingOutputConfig.Outputs["profile"].S3Output.S3Uri,
+                    "profile.json",
+                ],
+            ),
+            content_type="application/json",
+        ),
         model_statistics=MetricsSource(
-            s3_uri="{}/evaluation.json".format(
-                step_eval.arguments["ProcessingOutputConfig"]["Outputs"][0]["S3Output"]["S3Uri"]
+            # A property reference rather than the resolved output uri, which holds the
+            # timestamped job name and would change the definition on every build
+            s3_uri=Join(
+                on="/",
+                values=[
+                    step_eval.properties.ProcessingOutputConfig.Outputs["evaluation"].S3Output.S3Uri,
+                    "evaluation.json",
+                ],
             ),
             content_type="application/json",
         )
@@ -344,7 +764,7 @@ def get_pipeline(
             property_file=evaluation_report,
             json_path="regression_metrics.mse.value",  # This should follow the structure of your report_dict defined in the evaluate.py file.
         ),
-        right=10.0,  # You can change the threshold here
+        right=MSE_THRESHOLD,  # You can change the threshold here
     )
     #---
 
@@ -353,7 +773,7 @@ def get_pipeline(
     step_register = RegisterModel(
         name="Step-RegisterModel",
         estimator=xgb_train,
-        model_data=step_train.properties.ModelArtifacts.S3ModelArtifacts,
+        model_data=model_data,
         content_types=["text/csv"],
         response_types=["text/csv"],
         inference_instances=["ml.m5.large"],
@@ -363,15 +783,100 @@ def get_pipeline(
         model_metrics=model_metrics,
     )
     
+    if_steps = [step_register]
+    if enable_batch_transform:
+        # Scores the whole table with the model that passed the condition. MultiRecord sends
+        # as many lines as fit in max_payload per request, and the input and output filters
+        # keep the key out of the model input but join it to the prediction.
+        step_create_model = CreateModelStep(
+            name="Step-CreateModel",
+            model=Model(
+                image_uri=image_uri,
+                model_data=model_data,
+                sagemaker_session=sagemaker_session,
+                role=role,
+            ),
+            inputs=CreateModelInput(instance_type=transform_instance_type),
+        )
+        transformer = Transformer(
+            model_name=step_create_model.properties.ModelName,
+            instance_count=transform_instance_count,
+            instance_type=transform_instance_type,
+            strategy="MultiRecord",
+            assemble_with="Line",
+            accept="text/csv",
+            max_payload=transform_max_payload,
+            output_path=f"s3://{default_bucket}/{base_job_prefix}/Transform",
+            base_transform_job_name=f"{base_job_prefix}/Transform",
+            sagemaker_session=sagemaker_session,
+        )
+        step_transform = TransformStep(
+            name="Step-BatchTransform",
+            transformer=transformer,
+            inputs=TransformInput(
+                data=step_process.properties.ProcessingOutputConfig.Outputs["score"].S3Output.S3Uri,
+                content_type="text/csv",
+                split_type="Line",
+                input_filter="$[1:]",
+                join_source="Input",
+                output_filter="$[0,-1]",
+            ),
+            cache_config=cache_config,
+        )
+        if_steps += [step_create_model, step_transform]
+
     # Register model step that will be conditionally executed
     step_cond = ConditionStep(
         name="Step-AccuracyCond",
         conditions=[cond_lte],
-        if_steps=[step_register],
+        if_steps=if_steps,
         else_steps=[],
     )
     #---
-    
+
+    steps = [step_redshift_download, step_process, step_profile, step_train, step_eval, step_cond]
+    if enable_drift_check:
+        # Not cached: the reference changes whenever another model is approved
+        drift_report = PropertyFile(name="DriftReport", output_name="drift", path="drift.json")
+        step_drift = ProcessingStep(
+            name="Step-DriftCheck",
+            processor=profile_processor,
+            inputs=[
+                ProcessingInput(
+                    source=step_profile.properties.ProcessingOutputConfig.Outputs["profile"].S3Output.S3Uri,
+                    destination="/opt/ml/processing/profile",
+                ),
+                ProcessingInput(
+                    source=step_process.properties.ProcessingOutputConfig.Outputs["features"].S3Output.S3Uri,
+                    destination="/opt/ml/processing/features",
+                ),
+            ],
+            outputs=[
+                ProcessingOutput(
+                    output_name="drift",
+                    source="/opt/ml/processing/drift",
+                    destination=step_output("Step-DriftCheck", "drift"),
+                )
+            ],
+            code=get_code_uri(sagemaker_session, default_bucket, base_job_prefix, "drift.py", offline),
+            job_arguments=["--model-package-group-name", model_package_group_name, "--region", region],
+            property_files=[drift_report],
+        )
+        # Without drift the model in production was trained on data like this, so the
+        # training, evaluation and registration are skipped
+        step_drift_cond = ConditionStep(
+            name="Step-DriftCond",
+            conditions=[
+                ConditionEquals(
+                    left=JsonGet(step=step_drift, property_file=drift_report, json_path="drift.detected"),
+                    right=True,
+                )
+            ],
+            if_steps=[step_train, step_eval, step_cond],
+            else_steps=[],
+        )
+        steps = [step_redshift_download, step_process, step_profile, step_drift, step_drift_cond]
+
     # Pipeline instance
     pipeline = Pipeline(
         name=pipeline_name,
@@ -379,11 +884,16 @@ def get_pipeline(
             processing_instance_type,
             processing_instance_count,
             training_instance_type,
+            training_instance_count,
+            training_input_mode,
+            transform_instance_count,
+            transform_instance_type,
+            tuning_max_parallel_jobs,
             model_approval_status,
             s3bucket,
         ],
 #         steps=[step_redshift_download, step_process],
-        steps=[step_redshift_download, step_process, step_train, step_eval, step_cond],
+        steps=steps,
         sagemaker_session=sagemaker_session,
     )
     return pipeline
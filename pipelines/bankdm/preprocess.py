@@ -10,9 +10,39 @@
 # distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
 # ANY KIND, either express or implied. See the License for the specific
 # language governing permissions and limitations under the License.
+"""Feature engineering script for the data unloaded from RedShift.
+
+Runs as the SageMaker Processing job code, so it must stay self-contained (no imports
+from the pipelines package). The base directory can be overridden to run it locally.
+
+With a negative fraction below 1, the train split keeps every positive row and that
+fraction of the negative rows, each kept negative weighing 1 / fraction. The weight is
+written after the label in the train and validation splits, which the built-in XGBoost
+container reads as instance weights with csv_weights=1, so that the weighted loss and
+thus the predictions stay those of the full data. The validation and test splits keep
+every row.
+
+With a gzip level, the three splits are written concurrently as multi-member gzip files,
+blocks of rows being compressed in parallel, for the training channels to be read with
+the Gzip compression type in Pipe mode.
+
+With test arrays, the test split is also written as float32 .npy arrays of features and
+labels, which evaluate.py memory-maps and predicts on without parsing csv.
+
+snapshot/snapshot.json is written last, with the digests the splits were made from and
+the write throughput and compression ratio, and marks the outputs as a complete feature
+snapshot that later executions can reuse.
+"""
 import argparse
+import gzip
+import io
+import json
 import logging
 import os
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
 
 
 import boto3
@@ -23,53 +53,355 @@ logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 logger.addHandler(logging.StreamHandler())
 
+DROP_COLUMNS = ['duration', 'emp_var_rate', 'cons_price_idx', 'cons_conf_idx', 'euribor3m', 'nr_employed']
+DERIVED_COLUMNS = ['no_previous_contact', 'not_working']
+LABEL = 'y'
+WEIGHT = 'instance_weight'
+# The rows compressed as one gzip member
+BLOCK_ROWS = 20000
+TEST_FEATURES = 'test_features.npy'
+TEST_LABELS = 'test_labels.npy'
 
-if __name__ == "__main__":
-    logger.info("Starting preprocessing.")
-    base_dir = "/opt/ml/processing"
 
-    # Access the gzip files that were unloaded from RedShift
-    unload_dir = "/opt/ml/processing/raw/"
-    unload_list = os.listdir(unload_dir)
+def combine_unload_files(unload_dir, raw_path):
+    """Concatenates the gzip files that were unloaded from RedShift into a single csv file.
+
+    Args:
+        unload_dir: directory holding the unloaded gzip files
+        raw_path: the csv file to write
+
+    Returns:
+        the list of unloaded files that were combined
+    """
+    unload_list = [f for f in os.listdir(unload_dir) if os.path.join(unload_dir, f) != raw_path]
     logger.info(f"List of files in unload_dir: {unload_list}")
-    
-    # The new variable is to determine if header should be written. 
+
+    # The new variable is to determine if header should be written.
     # It should only be written for the first file
     new = 0
 
     for file in reversed(unload_list):
         obj = os.path.join(unload_dir, file)
         logger.info("Processing file: " + obj)
-        df = pd.read_csv(obj, compression='gzip', sep = ',')
+        df = pd.read_csv(obj, compression='gzip', sep=',')
 
         # Write the gzip files to a single raw.csv file
         if new == 0:
             # Save the file to local directory
-            df.to_csv('{}/raw/raw.csv'.format(base_dir),
-                            mode="w",index=False,header=True)
+            df.to_csv(raw_path, mode="w", index=False, header=True)
             new = 1
         else:
-            df.to_csv('{}/raw/raw.csv'.format(base_dir),
-                            mode="a",index=False,header=False)
+            df.to_csv(raw_path, mode="a", index=False, header=False)
+    return unload_list
 
-    
-    # Specify the location of file that was produced by previous step
+
+def engineer_features(data):
+    """Adds the indicator variables and one-hot encodes the categorical columns.
+
+    Args:
+        data: the raw DataFrame as unloaded from RedShift
+
+    Returns:
+        the encoded DataFrame, still holding the y_no and y_yes columns
+    """
+    data['no_previous_contact'] = np.where(data['pdays'] == 999, 1, 0)                                 # Indicator variable to capture when pdays takes a value of 999
+    data['not_working'] = np.where(np.isin(data['job'], ['student', 'retired', 'unemployed']), 1, 0)   # Indicator for individuals not actively employed
+    model_data = pd.get_dummies(data, dtype=np.uint8)                                                  # Convert categorical variables to sets of indicators
+
+    return model_data.drop(DROP_COLUMNS, axis=1)
+
+
+def feature_schema(data, model_data):
+    """Describes the fitted feature transform, so that raw rows can be encoded without the training data.
+
+    Args:
+        data: the raw DataFrame after engineer_features added the derived columns
+        model_data: the encoded DataFrame returned by engineer_features
+
+    Returns:
+        a dict with the numeric columns (derived ones included), the levels of each
+        categorical column and the model input columns in order
+    """
+    kept = [c for c in data.columns if c not in DROP_COLUMNS and c != LABEL]
+    categorical = [c for c in kept if not pd.api.types.is_numeric_dtype(data[c])]
+    return {
+        'numeric': [c for c in kept if c not in categorical],
+        'derived': DERIVED_COLUMNS,
+        'categorical': {c: sorted(str(v) for v in data[c].dropna().unique()) for c in categorical},
+        'columns': [c for c in model_data.columns if c not in ('y_no', 'y_yes')],
+    }
+
+
+def split_data(model_data):
+    """Randomly sorts the data then splits out first 70%, second 20%, and last 10%."""
+    shuffled = model_data.sample(frac=1, random_state=1729)
+    train_end, validation_end = int(0.7 * len(model_data)), int(0.9 * len(model_data))
+    return shuffled.iloc[:train_end], shuffled.iloc[train_end:validation_end], shuffled.iloc[validation_end:]
+
+
+def downsample_negatives(data, fraction):
+    """Keeps every positive row and a fraction of the negative rows, weighted by 1 / fraction.
+
+    Whether a negative row is kept is decided by a hash of its values, so the same rows are
+    kept on every run and whatever the order or the sharding of the unloaded files.
+
+    Args:
+        data: the encoded DataFrame of a split
+        fraction: the fraction of negative rows to keep, in (0, 1]
+
+    Returns:
+        the kept rows with their instance weights in the WEIGHT column
+    """
+    if not 0 < fraction <= 1:
+        raise ValueError(f"The negative fraction must be in (0, 1], got {fraction}")
+    hashes = pd.util.hash_pandas_object(data, index=False).values
+    # The top 53 bits of the hash as a uniform float in [0, 1)
+    uniform = (hashes >> np.uint64(11)).astype(np.float64) * 2.0 ** -53
+    positive = data['y_yes'].values == 1
+    kept = data[positive | (uniform < fraction)].copy()
+    kept[WEIGHT] = np.where(kept['y_yes'].values == 1, 1.0, 1.0 / fraction)
+    return kept
+
+
+def split_frame(data):
+    """Orders the columns of a split as write_split writes them.
+
+    The y_yes label comes first, then the instance weight if the split has a WEIGHT
+    column, then the features.
+    """
+    label = [data['y_yes']] + ([data[WEIGHT]] if WEIGHT in data.columns else [])
+    features = data.drop(['y_no', 'y_yes', WEIGHT], axis=1, errors='ignore')
+    return pd.concat(label + [features], axis=1)
+
+
+def write_split(data, path):
+    """Writes a split with the y_yes label as the first column and no header.
+
+    The instance weight, if the split has a WEIGHT column, is the second column. Every
+    row, the last included, ends with a newline, so that the files of a channel can be
+    streamed back to back in Pipe mode.
+    """
+    split_frame(data).to_csv(path, index=False, header=False)
+
+
+def _gzip_member(data, level):
+    buffer = io.BytesIO()
+    # A fixed mtime keeps the output of the same rows byte for byte the same
+    with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=level, mtime=0) as f:
+        f.write(data)
+    return buffer.getvalue()
+
+
+class SplitWriter:
+    """Writes splits as write_split does, plain or as multi-member gzip files.
+
+    With a gzip level, every BLOCK_ROWS rows are formatted and handed to a thread pool to
+    compress as a gzip member, zlib releasing the GIL, and the members are written in
+    order. Concatenated members are a valid gzip file, read whole by gzip, pandas and the
+    Gzip decompression of SageMaker Pipe mode channels.
+    """
+
+    def __init__(self, level=0, threads=None, block_rows=BLOCK_ROWS):
+        """Creates the writer.
+
+        Args:
+            level: the gzip compression level from 1 to 9, 0 to write plain csv
+            threads: the compression threads, one per cpu by default
+            block_rows: the rows of a gzip member
+        """
+        self.level = level
+        self.block_rows = block_rows
+        self.suffix = '.csv.gz' if level else '.csv'
+        self.raw_bytes = 0
+        self.written_bytes = 0
+        self._pool = ThreadPoolExecutor(threads or os.cpu_count() or 1) if level else None
+        self._lock = threading.Lock()
+
+    def write(self, data, path):
+        """Writes a split to path, which should end with the suffix of the writer."""
+        frame = split_frame(data)
+        if not self.level:
+            frame.to_csv(path, index=False, header=False)
+            raw = os.path.getsize(path)
+        else:
+            raw = 0
+            members = []
+            for start in range(0, len(frame), self.block_rows):
+                block = frame.iloc[start:start + self.block_rows].to_csv(index=False, header=False).encode('utf-8')
+                raw += len(block)
+                members.append(self._pool.submit(_gzip_member, block, self.level))
+            with open(path, 'wb') as f:
+                for member in members:
+                    f.write(member.result())
+        with self._lock:
+            self.raw_bytes += raw
+            self.written_bytes += os.path.getsize(path)
+
+    def stats(self, seconds):
+        """Returns the bytes before and after compression, their ratio and the csv MB/s."""
+        return {
+            'level': self.level,
+            'seconds': seconds,
+            'raw_bytes': self.raw_bytes,
+            'bytes': self.written_bytes,
+            'ratio': self.raw_bytes / self.written_bytes if self.written_bytes else 1.0,
+            'mb_per_second': self.raw_bytes / 1e6 / seconds if seconds else 0.0,
+        }
+
+    def close(self):
+        """Shuts down the compression threads, if any."""
+        if self._pool:
+            self._pool.shutdown()
+
+
+def write_test_arrays(data, directory):
+    """Writes a split as TEST_FEATURES and TEST_LABELS, C-ordered float32 .npy arrays.
+
+    The features are in the columns order of write_split, so that they can be
+    memory-mapped and predicted on as they are.
+
+    Returns:
+        the paths of the features and labels
+    """
+    values = split_frame(data).to_numpy(dtype=np.float32)
+    paths = [f"{directory}/{TEST_FEATURES}", f"{directory}/{TEST_LABELS}"]
+    np.save(paths[0], np.ascontiguousarray(values[:, 1:]))
+    np.save(paths[1], np.ascontiguousarray(values[:, 0]))
+    return paths
+
+
+def write_score_rows(data, path):
+    """Writes the features of the rows prefixed by their key, with no label and no header.
+
+    The batch transform drops the key from the model input with the input filter $[1:]
+    and joins it back to the prediction, so that predictions can be matched to the rows.
+    """
+    data.drop(['y_no', 'y_yes'], axis=1).to_csv(path, index=True, header=False)
+
+
+def write_shards(data, directory, name, shards=1, write=write_split, suffix='.csv'):
+    """Writes a split as equally sized shards, so that ShardedByS3Key gives every training host the same rows.
+
+    A single shard keeps the <name>.csv file name, more are written as <name>_<i>.csv.
+    The rows are already shuffled, so contiguous shards are balanced in labels as well.
+
+    Returns:
+        the paths of the written shards
+    """
+    if shards <= 1:
+        paths = [f"{directory}/{name}{suffix}"]
+    else:
+        paths = [f"{directory}/{name}_{i:05d}{suffix}" for i in range(shards)]
+    bounds = np.linspace(0, len(data), len(paths) + 1).astype(int)
+    for path, start, end in zip(paths, bounds[:-1], bounds[1:]):
+        write(data.iloc[start:end], path)
+    return paths
+
+
+def main(base_dir, train_shards=1, score_shards=0, negative_fraction=1.0, digests=None, gzip_level=0,
+         test_arrays=False, key_column=None):
+    """Runs the preprocessing against the processing job directory layout under base_dir.
+
+    Args:
+        base_dir: the processing job directory holding raw/ and the split directories
+        train_shards: the number of shards to split the train split into, at least the
+            number of training instances
+        score_shards: the number of shards to write the features of the whole table into
+            for batch scoring under score/, none if 0
+        negative_fraction: the fraction of negative rows the train split keeps, all if 1,
+            in which case no instance weights are written
+        digests: the manifest and code digests to record in snapshot.json
+        gzip_level: the gzip level of the train, validation and test splits, 0 to write
+            them as plain csv
+        test_arrays: also write the test split as .npy arrays, see write_test_arrays
+        key_column: the key column of the table, which is not a feature but prefixes
+            every row to score, required to score rows
+    """
+    if score_shards > 0 and not key_column:
+        raise ValueError("Scoring the rows needs the key column of the table to join the predictions on")
+    logger.info("Starting preprocessing.")
+
+    # Access the gzip files that were unloaded from RedShift
+    unload_dir = f"{base_dir}/raw/"
     fn = f'{unload_dir}raw.csv'
+    combine_unload_files(unload_dir, fn)
+
+    # Specify the location of file that was produced by previous step
     logger.info("Reading downloaded data.")
 
     # read in csv
     data = pd.read_csv(fn, low_memory=False)
+    keys = data.pop(key_column) if key_column else None
 
     # Pre processing
-    data['no_previous_contact'] = np.where(data['pdays'] == 999, 1, 0)                                 # Indicator variable to capture when pdays takes a value of 999
-    data['not_working'] = np.where(np.in1d(data['job'], ['student', 'retired', 'unemployed']), 1, 0)   # Indicator for individuals not actively employed
-    model_data = pd.get_dummies(data)                                                                  # Convert categorical variables to sets of indicators
-    
-    model_data = model_data.drop(['duration', 'emp_var_rate', 'cons_price_idx', 'cons_conf_idx', 'euribor3m', 'nr_employed'], axis=1)
-    
-    # Randomly sort the data then split out first 70%, second 20%, and last 10%
-    train_data, validation_data, test_data = np.split(model_data.sample(frac=1, random_state=1729), [int(0.7 * len(model_data)), int(0.9 * len(model_data))])   
-    
-    pd.concat([train_data['y_yes'], train_data.drop(['y_no', 'y_yes'], axis=1)], axis=1).to_csv(f"{base_dir}/train/train.csv", index=False, header=False)
-    pd.concat([validation_data['y_yes'], validation_data.drop(['y_no', 'y_yes'], axis=1)], axis=1).to_csv(f"{base_dir}/validation/validation.csv", index=False, header=False)
-    pd.concat([test_data['y_yes'], test_data.drop(['y_no', 'y_yes'], axis=1)], axis=1).to_csv(f"{base_dir}/test/test.csv", index=False, header=False)
+    model_data = engineer_features(data)
+    train_data, validation_data, test_data = split_data(model_data)
+
+    os.makedirs(f"{base_dir}/features", exist_ok=True)
+    with open(f"{base_dir}/features/features.json", "w") as f:
+        json.dump(feature_schema(data, model_data), f, indent=2)
+
+    if negative_fraction < 1:
+        rows = len(train_data)
+        train_data = downsample_negatives(train_data, negative_fraction)
+        # The container reads the weight column of every channel once csv_weights=1
+        validation_data = validation_data.assign(**{WEIGHT: 1.0})
+        logger.info("Downsampled the train split from %d to %d rows.", rows, len(train_data))
+
+    # The three splits are written concurrently, sharing the compression threads
+    writer = SplitWriter(gzip_level)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(3) as pool:
+        writes = [
+            pool.submit(write_shards, train_data, f"{base_dir}/train", "train", train_shards, writer.write,
+                        writer.suffix),
+            pool.submit(writer.write, validation_data, f"{base_dir}/validation/validation{writer.suffix}"),
+            pool.submit(writer.write, test_data, f"{base_dir}/test/test{writer.suffix}"),
+        ]
+        for write in writes:
+            write.result()
+    writer.close()
+    write_stats = writer.stats(time.perf_counter() - start)
+    logger.info("Wrote the splits at %.1f MB/s of csv, %d bytes compressed %.2fx at level %d.",
+                write_stats['mb_per_second'], write_stats['raw_bytes'], write_stats['ratio'], gzip_level)
+    if test_arrays:
+        write_test_arrays(test_data, f"{base_dir}/test")
+        logger.info("Wrote the test split as float32 arrays.")
+    if score_shards > 0:
+        # Every row, keyed by the key column rather than its position in the unload, which
+        # depends on the slices of the cluster and the order the shards are combined in
+        os.makedirs(f"{base_dir}/score", exist_ok=True)
+        paths = write_shards(model_data.set_index(keys), f"{base_dir}/score", "score",
+                             score_shards, write=write_score_rows)
+        logger.info("Wrote %d rows to score in %d files.", len(model_data), len(paths))
+
+    os.makedirs(f"{base_dir}/snapshot", exist_ok=True)
+    with open(f"{base_dir}/snapshot/snapshot.json", "w") as f:
+        rows = {"train": len(train_data), "validation": len(validation_data), "test": len(test_data)}
+        json.dump(dict(digests or {}, rows=rows, negative_fraction=negative_fraction, write=write_stats), f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--base-dir", type=str, default="/opt/ml/processing")
+    parser.add_argument("--train-shards", type=int, default=1)
+    parser.add_argument("--score-shards", type=int, default=0)
+    parser.add_argument("--negative-fraction", type=float, default=1.0)
+    parser.add_argument("--gzip-level", type=int, default=0)
+    parser.add_argument("--test-arrays", action="store_true")
+    parser.add_argument("--key-column", type=str, default=None)
+    # Digests passed by the pipeline so that step caching is keyed on the code and data
+    parser.add_argument("--code-digest", type=str, default=None)
+    parser.add_argument("--manifest-digest", type=str, default=None)
+    args, _ = parser.parse_known_args()
+    logger.info("Code digest: %s, manifest digest: %s", args.code_digest, args.manifest_digest)
+    main(
+        args.base_dir,
+        args.train_shards,
+        args.score_shards,
+        args.negative_fraction,
+        {"manifest_digest": args.manifest_digest, "code_digest": args.code_digest},
+        args.gzip_level,
+        args.test_arrays,
+        args.key_column,
+    )
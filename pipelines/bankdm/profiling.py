@@ -0,0 +1,358 @@
+# Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+"""Profiling script summarising the unloaded shards in one streaming pass.
+
+Every shard is read in chunks by a pool of processes, and every column is summarised
+with mergeable sketches of bounded size: null counts, min/max, mean and variance and a
+quantile sketch for numeric columns, the most frequent levels for categorical columns and
+a HyperLogLog distinct count for both. Values are read as text, a column being numeric
+unless any of its values, in any shard, is not a number. The partial profiles of the
+shards are merged and written as profile.json, which keeps the weighted values of each
+quantile sketch so that drift.py can compare the distributions of two profiles without
+the data.
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import random
+
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+logger.addHandler(logging.StreamHandler())
+
+QUANTILES = [0.0, 0.01, 0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 0.99, 1.0]
+
+
+class Moments:
+    """Count, min, max, mean and variance, merged with the parallel algorithm of Chan et al."""
+
+    def __init__(self):
+        """Creates the moments of no values."""
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def update(self, values):
+        """Adds a numpy array of values."""
+        if len(values):
+            other = Moments()
+            other.count = len(values)
+            other.min, other.max = float(values.min()), float(values.max())
+            other.mean = float(values.mean())
+            other.m2 = float(((values - other.mean) ** 2).sum())
+            self.merge(other)
+
+    def merge(self, other):
+        """Adds the values of other Moments."""
+        if other.count == 0:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta ** 2 * self.count * other.count / count
+        self.count = count
+        self.min, self.max = min(self.min, other.min), max(self.max, other.max)
+
+    def to_dict(self):
+        """Returns min, max, mean and the population std, None for no values."""
+        if self.count == 0:
+            return {"min": None, "max": None, "mean": None, "std": None}
+        return {"min": self.min, "max": self.max, "mean": self.mean, "std": math.sqrt(self.m2 / self.count)}
+
+
+class QuantileSketch:
+    """A KLL-style quantile sketch of about 1.2k values, with a rank error of about 0.1%.
+
+    Level i holds values of weight 2**i. A level above its capacity is sorted and every
+    other value, starting at a random offset, is promoted to the next level.
+    """
+
+    def __init__(self, k=1024, seed=1729):
+        """Creates the sketch with capacity k at the top level and a seeded offset."""
+        self.k = k
+        self.levels = [np.empty(0)]
+        self._random = random.Random(seed)
+
+    def _capacity(self, level):
+        return max(2, int(self.k * (2.0 / 3.0) ** (len(self.levels) - level - 1)))
+
+    def _compress(self):
+        level = 0
+        while level < len(self.levels):
+            if len(self.levels[level]) > self._capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                values = np.sort(self.levels[level])
+                # An odd value out stays, so that the total weight is preserved
+                self.levels[level] = values[len(values) - len(values) % 2 :]
+                promoted = values[self._random.randint(0, 1) : len(values) - len(values) % 2 : 2]
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted])
+            level += 1
+
+    def update(self, values):
+        """Adds a numpy array of values."""
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+
+    def merge(self, other):
+        """Adds the values of another sketch, level by level."""
+        for level, values in enumerate(other.levels):
+            if level == len(self.levels):
+                self.levels.append(np.empty(0))
+            self.levels[level] = np.concatenate([self.levels[level], values])
+        self._compress()
+
+    def weighted_values(self):
+        """Returns the distinct values held, sorted, and their total weights."""
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(v), 2.0 ** i) for i, v in enumerate(self.levels)])
+        values, inverse = np.unique(values, return_inverse=True)
+        return values, np.bincount(inverse, weights=weights, minlength=len(values))
+
+    def quantiles(self, qs):
+        """Returns the values at the quantiles qs, None for no values."""
+        values, weights = self.weighted_values()
+        if not len(values):
+            return [None] * len(qs)
+        cumulative = np.cumsum(weights)
+        ranks = np.searchsorted(cumulative, np.asarray(qs) * cumulative[-1], side="left")
+        return [float(values[min(r, len(values) - 1)]) for r in ranks]
+
+    def to_dict(self):
+        """Returns the distinct values held and their weights."""
+        values, weights = self.weighted_values()
+        return {"values": values.tolist(), "weights": weights.tolist()}
+
+
+class HyperLogLog:
+    """A HyperLogLog distinct count over 64-bit hashes with 2**p registers."""
+
+    def __init__(self, p=12):
+        """Creates the 2**p registers, all zero."""
+        self.p = p
+        self.registers = np.zeros(2 ** p, dtype=np.uint8)
+
+    @staticmethod
+    def _bit_length(x):
+        length = np.zeros(len(x), dtype=np.int64)
+        x = x.copy()
+        for shift in (32, 16, 8, 4, 2, 1):
+            high = x >= (np.uint64(1) << np.uint64(shift))
+            length[high] += shift
+            x[high] >>= np.uint64(shift)
+        return length + (x > 0)
+
+    def update(self, hashes):
+        """Adds a numpy array of uint64 hashes."""
+        if not len(hashes):
+            return
+        width = 64 - self.p
+        index = (hashes >> np.uint64(width)).astype(np.int64)
+        rest = hashes & np.uint64((1 << width) - 1)
+        rank = (width - self._bit_length(rest) + 1).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+
+    def merge(self, other):
+        """Adds the hashes of another HyperLogLog of the same p."""
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def estimate(self):
+        """Returns the estimated number of distinct hashes."""
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(2.0 ** -self.registers.astype(np.float64))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+
+class TopK:
+    """The most frequent values with the Misra-Gries summary of at most capacity counters.
+
+    Counts are exact while a column has at most capacity distinct values, and otherwise
+    underestimate by at most the number of values seen divided by capacity.
+    """
+
+    def __init__(self, capacity=100):
+        """Creates the summary with no counters."""
+        self.capacity = capacity
+        self.counters = {}
+
+    def _reduce(self):
+        if len(self.counters) > self.capacity:
+            cut = sorted(self.counters.values(), reverse=True)[self.capacity]
+            self.counters = {v: c - cut for v, c in self.counters.items() if c > cut}
+
+    def update(self, counts):
+        """Adds a mapping of value to its count."""
+        for value, count in counts.items():
+            self.counters[value] = self.counters.get(value, 0) + int(count)
+        self._reduce()
+
+    def merge(self, other):
+        """Adds the counters of another summary."""
+        self.update(other.counters)
+
+    def top(self, k=20):
+        """Returns the k values of the largest counts and their counts, most frequent first."""
+        return sorted(self.counters.items(), key=lambda item: (-item[1], item[0]))[:k]
+
+
+class ColumnProfile:
+    """The sketches of one column, numeric unless it holds values that are not numbers.
+
+    The kind of a column is only known once all of it was seen, as a shard or a chunk
+    of nulls or of numbers says nothing of the others. So the levels of every column are
+    counted, and the moments and quantiles of its values while they all parse as numbers.
+    """
+
+    def __init__(self):
+        """Creates the sketches of a column of no values."""
+        self.count = 0
+        self.nulls = 0
+        self.text = 0
+        self.distinct = HyperLogLog()
+        self.moments = Moments()
+        self.quantiles = QuantileSketch()
+        self.top = TopK()
+
+    @property
+    def kind(self):
+        """Returns "categorical" if any value is not a number, else "numeric"."""
+        return "categorical" if self.text else "numeric"
+
+    def update(self, series):
+        """Adds the values of a pandas Series of str, nulls counted apart."""
+        nulls = series.isnull()
+        self.count += len(series)
+        self.nulls += int(nulls.sum())
+        values = series[~nulls]
+        if not self.text:
+            numbers = pd.to_numeric(values, errors="coerce")
+            self.text += int(numbers.isnull().sum())
+            if not self.text:
+                numbers = numbers.values.astype(np.float64)
+                self.moments.update(numbers)
+                self.quantiles.update(numbers)
+        # A level of the chunk past the capacity + 1 most frequent ones is evicted by the
+        # update unless it is counted already, so only those are added
+        levels = values.value_counts()
+        head, rest = levels.iloc[: self.top.capacity + 1], levels.iloc[self.top.capacity + 1 :]
+        self.top.update(pd.concat([head, rest[rest.index.isin(list(self.top.counters))]]))
+        self.distinct.update(pd.util.hash_pandas_object(values, index=False).values)
+
+    def merge(self, other):
+        """Adds the values of another profile of the column, of either kind."""
+        self.count += other.count
+        self.nulls += other.nulls
+        self.text += other.text
+        self.distinct.merge(other.distinct)
+        self.moments.merge(other.moments)
+        self.quantiles.merge(other.quantiles)
+        self.top.merge(other.top)
+
+    def to_dict(self):
+        """Returns the counts and the summary of the sketches, as written to profile.json."""
+        result = {"kind": self.kind, "count": self.count, "nulls": self.nulls, "distinct": self.distinct.estimate()}
+        if self.kind == "numeric":
+            result.update(self.moments.to_dict())
+            result["quantiles"] = dict(zip([str(q) for q in QUANTILES], self.quantiles.quantiles(QUANTILES)))
+            # The sketch itself, from which drift.py bins and compares distributions
+            result["sketch"] = self.quantiles.to_dict()
+        else:
+            result["top"] = [{"value": value, "count": count} for value, count in self.top.top()]
+        return result
+
+
+def profile_file(path, chunksize=100000):
+    """Profiles one unloaded shard chunk by chunk.
+
+    Returns:
+        a dict of column name to its ColumnProfile, in column order
+    """
+    profiles = {}
+    compression = "gzip" if path.endswith(".gz") else None
+    # Read as text, the kind of a column following from all of its values, see ColumnProfile
+    for chunk in pd.read_csv(path, compression=compression, chunksize=chunksize, dtype=str):
+        for column in chunk.columns:
+            profiles.setdefault(column, ColumnProfile()).update(chunk[column])
+    return profiles
+
+
+def merge_profiles(partials):
+    """Merges the partial profiles of several shards into the first one."""
+    merged = {}
+    for partial in partials:
+        for column, profile in partial.items():
+            if column in merged:
+                merged[column].merge(profile)
+            else:
+                merged[column] = profile
+    return merged
+
+
+def profile_files(paths, processes=None, chunksize=100000):
+    """Profiles the shards in parallel and merges their profiles.
+
+    Returns:
+        the profile as written to profile.json
+    """
+    processes = processes or os.cpu_count() or 1
+    if processes > 1 and len(paths) > 1:
+        with Pool(min(processes, len(paths))) as pool:
+            partials = pool.starmap(profile_file, [(path, chunksize) for path in paths])
+    else:
+        partials = [profile_file(path, chunksize) for path in paths]
+    merged = merge_profiles(partials)
+    rows = max([p.count for p in merged.values()] + [0])
+    return {
+        "rows": rows,
+        "files": len(paths),
+        "columns": {column: profile.to_dict() for column, profile in merged.items()},
+    }
+
+
+def main(base_dir, processes=None, chunksize=100000):
+    """Profiles the shards under base_dir/raw and writes base_dir/profile/profile.json."""
+    raw_dir = f"{base_dir}/raw"
+    paths = sorted(os.path.join(raw_dir, f) for f in os.listdir(raw_dir) if not f.startswith("."))
+    logger.info("Profiling %d files with %s processes.", len(paths), processes or os.cpu_count())
+    profile = profile_files(paths, processes, chunksize)
+    os.makedirs(f"{base_dir}/profile", exist_ok=True)
+    with open(f"{base_dir}/profile/profile.json", "w") as f:
+        json.dump(profile, f, indent=2)
+    logger.info("Profiled %d rows of %d columns.", profile["rows"], len(profile["columns"]))
+    return profile
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--base-dir", type=str, default="/opt/ml/processing")
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--chunksize", type=int, default=100000)
+    # Digests passed by the pipeline so that step caching is keyed on the code and data
+    parser.add_argument("--code-digest", type=str, default=None)
+    parser.add_argument("--manifest-digest", type=str, default=None)
+    args, _ = parser.parse_known_args()
+    logger.info("Code digest: %s, manifest digest: %s", args.code_digest, args.manifest_digest)
+    main(args.base_dir, args.processes, args.chunksize)
@@ -0,0 +1,155 @@
+# Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+r"""In-process scoring of raw rows with a trained model, without an endpoint.
+
+Loads model.tar.gz once, encodes chunks of raw rows with the fitted feature transform
+of features.json and predicts each chunk in one vectorized call, yielding predictions
+chunk by chunk so that memory stays bounded by the chunk size. Given a PredictionCache,
+rows already predicted by the same booster are answered from the cache:
+
+    python -m pipelines.bankdm.scoring --model model.tar.gz --features features.json \
+        --input table.csv --output predictions.csv
+"""
+import argparse
+import hashlib
+import logging
+import pickle
+import tarfile
+import time
+
+import numpy as np
+import pandas as pd
+import xgboost
+
+from pipelines.bankdm.features import FeatureSchema, RecordEncoder
+
+logger = logging.getLogger(__name__)
+
+MODEL_FILE = "xgboost-model"
+
+
+def load_model(model_path):
+    """Loads the booster from a model.tar.gz.
+
+    The built-in container pickles the booster up to version 1.2 and saves it in the
+    native xgboost format from 1.3 on, so both are accepted.
+
+    Args:
+        model_path: the model.tar.gz holding "xgboost-model"
+
+    Returns:
+        the xgboost.Booster
+    """
+    with tarfile.open(model_path) as tar:
+        data = tar.extractfile(MODEL_FILE).read()
+    try:
+        return pickle.loads(data)
+    except (pickle.UnpicklingError, EOFError, ValueError, TypeError):
+        pass
+    booster = xgboost.Booster()
+    booster.load_model(bytearray(data))
+    return booster
+
+
+def booster_digest(booster):
+    """Returns the sha256 digest of a booster, identifying the model version."""
+    return hashlib.sha256(booster.save_raw("ubj")).hexdigest()
+
+
+class Scorer:
+    """Scores raw rows with a booster and the fitted feature transform."""
+
+    def __init__(self, booster, schema, nthread=None, cache=None):
+        """Creates the scorer.
+
+        Args:
+            booster: the xgboost.Booster
+            schema: the FeatureSchema the booster was trained on
+            nthread: the number of threads predicting a chunk, all cores if None
+            cache: a PredictionCache of the predictions, None to not cache. It is emptied
+                when it held the predictions of another booster.
+        """
+        self.booster = booster
+        self.schema = schema
+        self.encoder = RecordEncoder(schema)
+        if nthread is not None:
+            self.booster.set_param({"nthread": nthread})
+        self.cache = cache
+        if cache is not None:
+            cache.set_model(booster_digest(booster))
+
+    @classmethod
+    def load(cls, model_path, features_path, nthread=None, cache=None):
+        """Creates the scorer from model.tar.gz and features.json."""
+        return cls(load_model(model_path), FeatureSchema.load(features_path), nthread, cache)
+
+    def predict(self, data):
+        """Predicts a DataFrame of raw rows.
+
+        Returns:
+            a float32 array with one prediction per row
+        """
+        return self.predict_encoded(self.schema.transform(data))
+
+    def predict_record(self, record):
+        """Predicts a single record, a mapping of the raw columns to their values.
+
+        Encodes into the buffer of the scorer, so concurrent callers need a scorer each.
+        """
+        return float(self.predict_encoded(self.encoder.encode(record)[np.newaxis, :])[0])
+
+    def predict_encoded(self, features):
+        """Predicts rows already encoded by the feature transform."""
+        if self.cache is not None:
+            return self.cache.predict(features, self.booster.inplace_predict)
+        return self.booster.inplace_predict(features)
+
+    def score(self, chunks):
+        """Predicts an iterable of DataFrame chunks of raw rows.
+
+        Yields:
+            the predictions of each chunk, in order
+        """
+        for chunk in chunks:
+            yield self.predict(chunk)
+
+
+def score_csv(scorer, input_path, output_path, chunksize=500_000):
+    """Scores a csv file of raw rows chunk by chunk and writes one prediction per line.
+
+    Returns:
+        a dict with the rows, seconds and rows per second
+    """
+    start = time.perf_counter()
+    rows = 0
+    with open(output_path, "w") as out:
+        for predictions in scorer.score(pd.read_csv(input_path, chunksize=chunksize)):
+            np.savetxt(out, predictions, fmt="%.6g")
+            rows += len(predictions)
+    seconds = time.perf_counter() - start
+    stats = {"rows": rows, "seconds": seconds, "rows_per_second": rows / seconds if seconds else 0.0}
+    logger.info("Scored %d rows in %.2fs (%.0f rows/s)", rows, seconds, stats["rows_per_second"])
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Scores a csv file of raw rows with a trained model.")
+    parser.add_argument("--model", type=str, required=True, help="The model.tar.gz to score with.")
+    parser.add_argument("--features", type=str, required=True, help="The features.json of preprocessing.")
+    parser.add_argument("--input", type=str, required=True, help="A csv file with the RedShift table columns.")
+    parser.add_argument("--output", type=str, required=True)
+    parser.add_argument("--chunksize", type=int, default=500_000)
+    parser.add_argument("--nthread", type=int, default=None)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    score_csv(Scorer.load(args.model, args.features, args.nthread), args.input, args.output, args.chunksize)
@@ -0,0 +1,326 @@
+# Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+"""A local inference server for the registered model, with dynamic request batching.
+
+Speaks the protocol of the SageMaker XGBoost container for the content and response
+types Step-RegisterModel declares: POST /invocations takes text/csv rows of encoded
+features and answers one prediction per line, GET /ping answers 200 once the model is
+loaded. Requests arriving within max_wait_ms of each other are coalesced into a single
+DMatrix prediction of at most max_batch_size rows; a request whose rows do not have the
+model's number of features is answered 400 before it joins a batch, and a failed
+prediction 500. GET /metrics answers the request latency percentiles and batch sizes as
+JSON:
+
+    python -m pipelines.bankdm.serve --model model.tar.gz --port 8080 --max-wait-ms 5
+"""
+import argparse
+import asyncio
+import io
+import json
+import logging
+import time
+
+from collections import deque
+
+import numpy as np
+import xgboost
+
+from pipelines.bankdm.scoring import load_model
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPES = ("text/csv",)
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    415: "Unsupported Media Type",
+    500: "Internal Server Error",
+}
+
+
+class Metrics:
+    """Request latencies and batch sizes over a sliding window."""
+
+    def __init__(self, window=10000):
+        """Creates the metrics, keeping the last window requests and batches."""
+        self.requests = 0
+        self.batches = 0
+        self.rows = 0
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+
+    def record_request(self, seconds):
+        """Records a request answered in seconds."""
+        self.requests += 1
+        self.latencies.append(seconds)
+
+    def record_batch(self, requests, rows):
+        """Records a batch of requests holding rows in total."""
+        self.batches += 1
+        self.rows += rows
+        self.batch_sizes.append(requests)
+
+    def snapshot(self):
+        """Returns the counters, the p50/p99 latency in ms and the requests per batch."""
+        latencies = np.array(self.latencies) * 1000.0
+        sizes = np.array(self.batch_sizes)
+        return {
+            "requests": self.requests,
+            "batches": self.batches,
+            "rows": self.rows,
+            "latency_p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else 0.0,
+            "latency_p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else 0.0,
+            "batch_size_mean": float(sizes.mean()) if len(sizes) else 0.0,
+            "batch_size_p99": float(np.percentile(sizes, 99)) if len(sizes) else 0.0,
+            "batch_size_max": int(sizes.max()) if len(sizes) else 0,
+        }
+
+
+class Batcher:
+    """Coalesces concurrent prediction requests into batches.
+
+    The first pending request opens a batch, which closes max_wait_ms later or once it
+    holds max_batch_size rows, and is predicted in one call off the event loop.
+    """
+
+    def __init__(self, predict, max_wait_ms=5.0, max_batch_size=1000, metrics=None):
+        """Creates the batcher.
+
+        Args:
+            predict: called with a 2-d float32 array, returns one prediction per row
+            max_wait_ms: how long a batch waits for more requests, 0 to not wait
+            max_batch_size: the number of rows that closes a batch early
+            metrics: the Metrics to record the batches in
+        """
+        self.predict = predict
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_batch_size = max_batch_size
+        self.metrics = metrics or Metrics()
+        self._queue = None
+        self._task = None
+
+    def start(self):
+        """Starts batching on the running event loop."""
+        self._queue = asyncio.Queue()
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """Stops batching, the pending requests being left unanswered."""
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    async def submit(self, rows):
+        """Queues the rows of a request and waits for their predictions."""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((rows, future))
+        return await future
+
+    async def _collect(self):
+        batch = [await self._queue.get()]
+        size = len(batch[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            batch.append(item)
+            size += len(item[0])
+        # Requests queued meanwhile join the batch without waiting
+        while size < self.max_batch_size and not self._queue.empty():
+            item = self._queue.get_nowait()
+            batch.append(item)
+            size += len(item[0])
+        return batch, size
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch, size = await self._collect()
+            try:
+                predictions = await loop.run_in_executor(None, self.predict, np.vstack([rows for rows, _ in batch]))
+            except Exception as e:  # pylint: disable=W0703
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.metrics.record_batch(len(batch), size)
+            start = 0
+            for rows, future in batch:
+                if not future.done():
+                    future.set_result(predictions[start : start + len(rows)])
+                start += len(rows)
+
+
+def parse_csv(body):
+    """Parses a text/csv payload of encoded rows into a 2-d float32 array."""
+    return np.loadtxt(io.StringIO(body.decode("utf-8")), delimiter=",", dtype=np.float32, ndmin=2)
+
+
+class InferenceServer:
+    """Serves a booster over HTTP/1.1 with keep-alive, see the module docstring."""
+
+    def __init__(self, booster, host="127.0.0.1", port=8080, max_wait_ms=5.0, max_batch_size=1000):
+        """Creates the server.
+
+        Args:
+            booster: the xgboost.Booster to serve
+            host: the address to listen on
+            port: the port to listen on, 0 for any free port
+            max_wait_ms: see Batcher
+            max_batch_size: see Batcher
+        """
+        self.booster = booster
+        self.num_features = booster.num_features()
+        self.host = host
+        self.port = port
+        self.metrics = Metrics()
+        self.batcher = Batcher(self._predict, max_wait_ms, max_batch_size, self.metrics)
+        self._server = None
+
+    def _predict(self, rows):
+        return self.booster.predict(xgboost.DMatrix(rows))
+
+    async def start(self):
+        """Starts listening, the port being updated to the one bound."""
+        self.batcher.start()
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info("Serving on %s:%d", self.host, self.port)
+
+    async def stop(self):
+        """Stops listening and batching."""
+        self._server.close()
+        await self._server.wait_closed()
+        await self.batcher.stop()
+
+    async def serve_forever(self):
+        """Starts the server and serves until cancelled."""
+        await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def _respond(self, method, path, headers, body):
+        if path == "/ping":
+            return 200, "text/plain", b""
+        if path == "/metrics":
+            return 200, "application/json", json.dumps(self.metrics.snapshot()).encode("utf-8")
+        if path != "/invocations":
+            return 404, "text/plain", b""
+        if method != "POST":
+            return 405, "text/plain", b""
+        content_type = headers.get("content-type", "").split(";")[0].strip()
+        if content_type not in CONTENT_TYPES:
+            return 415, "text/plain", f"Content type {content_type} is not supported".encode("utf-8")
+        start = time.perf_counter()
+        try:
+            rows = parse_csv(body)
+        except ValueError as e:
+            return 400, "text/plain", str(e).encode("utf-8")
+        # Rows of another width would fail the vstack, and so the whole batch they join
+        if rows.shape[1] != self.num_features:
+            message = f"Expected {self.num_features} features per row, got {rows.shape[1]}"
+            return 400, "text/plain", message.encode("utf-8")
+        try:
+            predictions = await self.batcher.submit(rows)
+        except Exception as e:  # pylint: disable=W0703
+            logger.exception("Prediction failed")
+            return 500, "text/plain", str(e).encode("utf-8")
+        self.metrics.record_request(time.perf_counter() - start)
+        return 200, "text/csv", "".join(f"{p}\n" for p in predictions.tolist()).encode("utf-8")
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                status, content_type, payload = await self._respond(method, path.split("?")[0], headers, body)
+                writer.write(
+                    f"HTTP/1.1 {status} {REASONS[status]}\r\nContent-Type: {content_type}\r\n"
+                    f"Content-Length: {len(payload)}\r\n\r\n".encode("latin-1") + payload
+                )
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+class Client:
+    """A minimal keep-alive HTTP client of the server, for tests and load generation."""
+
+    def __init__(self, reader, writer):
+        """Creates the client of an open connection."""
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def connect(cls, host, port):
+        """Opens a connection to the server."""
+        return cls(*await asyncio.open_connection(host, port))
+
+    async def request(self, method, path, body=b"", content_type="text/csv"):
+        """Sends a request and returns the status and the body of the response."""
+        self.writer.write(
+            f"{method} {path} HTTP/1.1\r\nContent-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n".encode("latin-1") + body
+        )
+        await self.writer.drain()
+        status = int((await self.reader.readline()).split()[1])
+        length = 0
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            if name.strip().lower() == "content-length":
+                length = int(value)
+        return status, await self.reader.readexactly(length)
+
+    async def close(self):
+        """Closes the connection."""
+        self.writer.close()
+        await self.writer.wait_closed()
+
+
+if __name__ == "__main__":  # pragma: no cover
+    parser = argparse.ArgumentParser("Serves a trained model with dynamic request batching.")
+    parser.add_argument("--model", type=str, required=True, help="The model.tar.gz to serve.")
+    parser.add_argument("--host", type=str, default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--max-wait-ms", type=float, default=5.0, help="How long a batch waits for requests.")
+    parser.add_argument("--max-batch-size", type=int, default=1000, help="The rows that close a batch early.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    server = InferenceServer(load_model(args.model), args.host, args.port, args.max_wait_ms, args.max_batch_size)
+    asyncio.run(server.serve_forever())
@@ -0,0 +1,294 @@
+# Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+r"""Compiles a trained model to SQL, so that a RedShift table is scored where it lives.
+
+Every tree of the booster becomes a nested CASE expression over the raw columns of the
+table: the feature encoding of features.json is folded into the splits, a split on a
+one-hot or derived indicator column becoming a test of the categorical level or of the
+indicator's predicate. Splits on numeric columns compare against the bound below which
+a value rounds to a float32 under the threshold, and send NULLs down the missing branch,
+so that the query predicts what the booster does on the encoded rows. The trees are
+summed pairwise, keeping the expression shallow, and the link of the objective applied:
+
+    python -m pipelines.bankdm.sql_scoring --model model.tar.gz --features features.json \
+        --table bankdm.bankdm_data --columns row_id --target-table bankdm.bankdm_scores \
+        --output score.sql
+
+With --database, --secret-arn and --cluster-identifier the query is also run through
+the Redshift Data API, scoring the whole table with a single statement.
+"""
+import argparse
+import json
+import logging
+import math
+import sys
+import time
+
+import numpy as np
+
+from pipelines.bankdm.features import DERIVED_SQL, FeatureSchema
+from pipelines.bankdm.scoring import load_model
+from pipelines.redshift_writeback import wait_for_statement
+
+logger = logging.getLogger(__name__)
+
+
+def _identity(margin):
+    return margin
+
+
+def _sigmoid(margin):
+    return f"1.0 / (1.0 + EXP(-({margin})))"
+
+
+def _logit(base_score):
+    return math.log(base_score / (1.0 - base_score))
+
+
+# The objectives supported, with the base margin of their base_score and their link
+OBJECTIVES = {
+    "reg:squarederror": (float, _identity),
+    "reg:linear": (float, _identity),
+    "binary:logitraw": (float, _identity),
+    "reg:logistic": (_logit, _sigmoid),
+    "binary:logistic": (_logit, _sigmoid),
+}
+
+
+def quote_identifier(name):
+    """Quotes a column or table name."""
+    return '"' + name.replace('"', '""') + '"'
+
+
+def quote_literal(value):
+    """Quotes a string literal."""
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def _number(value):
+    return repr(float(value))
+
+
+def float32_bound(threshold):
+    """Returns the comparison and the bound of x for which float32(x) < threshold.
+
+    XGBoost compares the float32 features with float32 thresholds, while the table holds
+    the raw values. The values below threshold in float32 are those below the midpoint of
+    the threshold and the float32 before it, and the midpoint itself if it rounds down.
+
+    Returns:
+        a tuple of the SQL operator, "<" or "<=", and the bound
+    """
+    threshold = np.float32(threshold)
+    before = np.nextafter(threshold, np.float32(-np.inf))
+    bound = (float(before) + float(threshold)) / 2.0
+    # A tie rounds to the float32 with an even mantissa
+    return ("<=" if int(before.view(np.uint32)) % 2 == 0 else "<"), bound
+
+
+def feature_sql(schema):
+    """Maps every model input column to its SQL over the raw columns of the table.
+
+    Returns:
+        a dict of model input column index to a tuple ("value", the column) for numeric
+        columns or ("indicator", its predicate) for indicator columns, worth 1 where the
+        predicate holds and 0 otherwise, NULL included
+    """
+    features = {}
+    for index, column in zip(schema.numeric_index, schema.numeric):
+        if column in schema.derived:
+            features[int(index)] = ("indicator", DERIVED_SQL[column](quote_identifier))
+        else:
+            features[int(index)] = ("value", quote_identifier(column))
+    for column, levels in schema.categorical.items():
+        for level, index in zip(levels, schema.level_index[column]):
+            if index >= 0:
+                features[int(index)] = ("indicator", f"{quote_identifier(column)} = {quote_literal(level)}")
+    return features
+
+
+def _feature_index(split, columns):
+    if split in columns:
+        return columns.index(split)
+    if split.startswith("f") and split[1:].isdigit():
+        return int(split[1:])
+    raise ValueError(f"Unknown split feature {split}")
+
+
+def compile_tree(node, features, columns):
+    """Compiles a tree of the json dump of a booster to a SQL expression.
+
+    Args:
+        node: the root node of the tree
+        features: the SQL of the model input columns, see feature_sql
+        columns: the model input columns, which the splits name or number
+
+    Returns:
+        the SQL expression of the leaf value of a row
+    """
+    if "leaf" in node:
+        return _number(node["leaf"])
+    if "split_condition" not in node:
+        raise ValueError(f"Node {node['nodeid']} is not a numeric split")
+    index = _feature_index(node["split"], columns)
+    if index not in features:
+        raise ValueError(f"Model input column {columns[index]} has no SQL encoding")
+    kind, sql = features[index]
+    children = {child["nodeid"]: child for child in node["children"]}
+    yes = compile_tree(children[node["yes"]], features, columns)
+    no = compile_tree(children[node["no"]], features, columns)
+    threshold = np.float32(node["split_condition"])
+    if kind == "indicator":
+        # An indicator is 0 or 1, never missing
+        if threshold <= 0:
+            return no
+        if threshold > 1:
+            return yes
+        return f"CASE WHEN {sql} THEN {no} ELSE {yes} END"
+    op, bound = float32_bound(threshold)
+    if node["missing"] == node["yes"]:
+        negated = ">" if op == "<=" else ">="
+        return f"CASE WHEN {sql} {negated} {_number(bound)} THEN {no} ELSE {yes} END"
+    return f"CASE WHEN {sql} {op} {_number(bound)} THEN {yes} ELSE {no} END"
+
+
+def _pairwise_sum(terms):
+    while len(terms) > 1:
+        terms = [f"({' + '.join(terms[i : i + 2])})" for i in range(0, len(terms), 2)]
+    return terms[0]
+
+
+def compile_expression(booster, schema):
+    """Compiles a booster and its feature encoding to one SQL expression.
+
+    Args:
+        booster: the xgboost.Booster, a gbtree of a single target
+        schema: the FeatureSchema the booster was trained on
+
+    Returns:
+        the SQL expression of the prediction of a row of the raw table
+
+    Raises:
+        ValueError: if the booster or its objective are not supported
+    """
+    learner = json.loads(booster.save_config())["learner"]
+    if learner["gradient_booster"]["name"] != "gbtree":
+        raise ValueError(f"Only gbtree boosters compile to SQL, not {learner['gradient_booster']['name']}")
+    params = learner["learner_model_param"]
+    if int(params.get("num_class", 0)) > 1 or int(params.get("num_target", 1)) > 1:
+        raise ValueError("Only boosters of a single target compile to SQL")
+    objective = learner["objective"]["name"]
+    if objective not in OBJECTIVES:
+        raise ValueError(f"Objective {objective} is not supported, expected one of {sorted(OBJECTIVES)}")
+    base_margin, link = OBJECTIVES[objective]
+    # A scalar, written as a one-element vector by xgboost 2.0 and later
+    base_score = float(params["base_score"].strip("[]"))
+
+    features = feature_sql(schema)
+    trees = [compile_tree(json.loads(tree), features, schema.columns) for tree in booster.get_dump(dump_format="json")]
+    return link(_pairwise_sum([_number(base_margin(base_score))] + trees))
+
+
+def compile_query(booster, schema, table, columns=(), alias="prediction", target_table=None):
+    """Compiles the query scoring every row of a table.
+
+    Args:
+        booster: the xgboost.Booster
+        schema: the FeatureSchema the booster was trained on
+        table: the table to score, e.g. schema.table
+        columns: the columns of the table to select with the prediction, e.g. its key
+        alias: the name of the prediction column
+        target_table: the table to create with the predictions, None to only select them
+
+    Returns:
+        the SQL statement
+    """
+    selected = [quote_identifier(c) for c in columns]
+    selected.append(f"{compile_expression(booster, schema)} AS {quote_identifier(alias)}")
+    query = f"SELECT {', '.join(selected)} FROM {table}"
+    return f"CREATE TABLE {target_table} AS {query}" if target_table else query
+
+
+def score_in_warehouse(client, query, sleep=time.sleep, **statement_kwargs):
+    """Runs a compiled query through the Redshift Data API and waits for it.
+
+    Args:
+        client: the redshift-data client, or a LocalRedshiftDataClient
+        query: the statement of compile_query
+        sleep: called with the seconds to wait between polls of the statement
+        statement_kwargs: Database, SecretArn, ClusterIdentifier or WorkgroupName of the
+            Data API calls
+
+    Returns:
+        a dict with the Id of the statement, the rows it affected and the seconds taken
+    """
+    start = time.perf_counter()
+    statement_id = client.execute_statement(Sql=query, **statement_kwargs)["Id"]
+    response = wait_for_statement(client, statement_id, sleep=sleep)
+    stats = {
+        "statement_id": statement_id,
+        "rows": response.get("ResultRows", 0),
+        "seconds": time.perf_counter() - start,
+    }
+    logger.info("Scored %d rows in the warehouse in %.2fs", stats["rows"], stats["seconds"])
+    return stats
+
+
+def main():  # pragma: no cover
+    """The main harness that compiles a trained model to SQL and optionally runs it."""
+    parser = argparse.ArgumentParser("Compiles a trained model to SQL scoring a RedShift table.")
+    parser.add_argument("--model", type=str, required=True, help="The model.tar.gz to compile.")
+    parser.add_argument("--features", type=str, required=True, help="The features.json of preprocessing.")
+    parser.add_argument("--table", type=str, required=True, help="The table to score, e.g. schema.table.")
+    parser.add_argument("--columns", type=str, default=None, help="Comma separated columns to select.")
+    parser.add_argument("--alias", type=str, default="prediction", help="The name of the prediction column.")
+    parser.add_argument("--target-table", type=str, default=None, help="The table to create with the scores.")
+    parser.add_argument("--output", type=str, default=None, help="The file to write the SQL to.")
+    parser.add_argument("--database", type=str, default=None, help="Runs the query in this database.")
+    parser.add_argument("--secret-arn", type=str, default=None)
+    parser.add_argument("--cluster-identifier", type=str, default=None)
+    parser.add_argument("--region", type=str, default=None)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    try:
+        query = compile_query(
+            load_model(args.model),
+            FeatureSchema.load(args.features),
+            args.table,
+            args.columns.split(",") if args.columns else (),
+            args.alias,
+            args.target_table,
+        )
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(query + ";\n")
+        else:
+            print(query)
+        if args.database:
+            import boto3
+
+            score_in_warehouse(
+                boto3.Session(region_name=args.region).client("redshift-data"),
+                query,
+                Database=args.database,
+                SecretArn=args.secret_arn,
+                ClusterIdentifier=args.cluster_identifier,
+            )
+    except Exception as e:  # pylint: disable=W0703
+        print(f"Exception: {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+# Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+"""Synthetic large versions of bank-additional.csv for performance work.
+
+Rows are resampled with replacement from the original data, and the integer columns
+are jittered so that the synthetic data is not just repeated rows. The columns and
+value domains stay those of bank-additional.csv, so it loads into the local Redshift
+stand-in and runs through preprocess.py unchanged.
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from pipelines.bankdm.local_pipeline import DEFAULT_DATA_PATH
+
+_JITTER = {"age": (17, 98), "campaign": (1, 56), "duration": (0, 4918)}
+
+
+def generate(n_rows, seed=1729, source_path=DEFAULT_DATA_PATH):
+    """Generates a synthetic DataFrame with the columns of bank-additional.csv.
+
+    Args:
+        n_rows: the number of rows to generate
+        seed: the random seed, the same seed generates the same data
+        source_path: the csv file to resample from
+
+    Returns:
+        a DataFrame of n_rows rows
+    """
+    rng = np.random.default_rng(seed)
+    source = pd.read_csv(source_path)
+    data = source.iloc[rng.integers(0, len(source), n_rows)].reset_index(drop=True)
+    for column, (low, high) in _JITTER.items():
+        jitter = rng.integers(-2, 3, n_rows)
+        data[column] = np.clip(data[column].to_numpy() + jitter, low, high)
+    return data
+
+
+def write(path, n_rows, seed=1729, source_path=DEFAULT_DATA_PATH):
+    """Generates n_rows synthetic rows and writes them to path as csv with a header."""
+    generate(n_rows, seed, source_path).to_csv(path, index=False)
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Writes a synthetic version of bank-additional.csv.")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--seed", type=int, default=1729)
+    parser.add_argument("--output", type=str, required=True)
+    args = parser.parse_args()
+    write(args.output, args.rows, args.seed)
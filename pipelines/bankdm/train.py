@@ -0,0 +1,344 @@
+# Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+"""Local stand-in for the SageMaker built-in XGBoost training container.
+
+Reads the headerless csv channels (label in the first column), trains with the
+hyperparameters of the pipeline and writes model.tar.gz holding the pickled booster
+as "xgboost-model", which is the layout evaluate.py expects.
+
+With more than one instance, every instance runs as a separate worker process joined
+through an xgboost collective, and the train files are assigned to the workers by key
+as SageMaker does for a ShardedByS3Key channel.
+
+In Pipe mode a channel is read as the single stream SageMaker writes to the channel's
+FIFO, i.e. its files back to back, so they must be headerless and newline-terminated.
+Gzipped files, the channel having the Gzip compression type, are decompressed as one stream.
+
+Given a checkpoint directory, the booster is checkpointed every save_interval rounds and
+training resumes from the latest checkpoint, as a restarted spot job does from the
+checkpoints SageMaker syncs back to /opt/ml/checkpoints.
+
+With the hyperparameter csv_weights=1, the column after the label holds the instance
+weight of the row in every channel, as in the built-in container.
+"""
+import io
+import logging
+import multiprocessing
+import os
+import pickle
+import tarfile
+
+import numpy as np
+import pandas as pd
+import xgboost
+
+logger = logging.getLogger(__name__)
+
+# Hyperparameters of the built-in container that are not xgboost training parameters
+_CONTAINER_ONLY = ("num_round", "silent", "csv_weights")
+
+INPUT_MODES = ("File", "Pipe", "FastFile")
+
+SAVE_INTERVAL = 5
+_CHECKPOINT_PREFIX = "xgboost-checkpoint."
+
+
+class PipeStream(io.RawIOBase):
+    """Reads files back to back as one stream, like the FIFO of a Pipe mode channel."""
+
+    def __init__(self, files):
+        """Creates the stream over the files, read in the given order."""
+        super().__init__()
+        self._files = iter(files)
+        self._current = None
+
+    def readable(self):
+        """Returns True, the stream is read-only."""
+        return True
+
+    def readinto(self, buffer):
+        """Reads the next bytes of the current file, moving on to the next file at its end."""
+        while True:
+            if self._current is None:
+                path = next(self._files, None)
+                if path is None:
+                    return 0
+                self._current = open(path, "rb")
+            count = self._current.readinto(buffer)
+            if count:
+                return count
+            self._current.close()
+            self._current = None
+
+    def close(self):
+        """Closes the file being read."""
+        if self._current is not None:
+            self._current.close()
+            self._current = None
+        super().close()
+
+
+def channel_files(channel_dir):
+    """Lists the data files of a channel directory in key order."""
+    files = sorted(
+        os.path.join(channel_dir, f) for f in os.listdir(channel_dir) if not f.startswith(".")
+    )
+    if not files:
+        raise ValueError(f"No data files found in channel {channel_dir}")
+    return files
+
+
+def read_values(files, input_mode="File"):
+    """Reads headerless csv files with the label in the first column.
+
+    Args:
+        files: the csv files
+        input_mode: the input mode of the channel, one of INPUT_MODES
+
+    Returns:
+        a tuple of the float32 features and labels
+    """
+    if input_mode not in INPUT_MODES:
+        raise ValueError(f"Unknown input mode {input_mode}, expected one of {INPUT_MODES}")
+    if input_mode == "Pipe":
+        # A gzipped channel is decompressed as one stream, the gzip files back to back
+        # being a valid multi-member gzip stream
+        compression = "gzip" if files and all(f.endswith(".gz") for f in files) else None
+        with io.BufferedReader(PipeStream(files)) as stream:
+            data = pd.read_csv(stream, header=None, compression=compression)
+    else:
+        data = pd.concat([pd.read_csv(f, header=None) for f in files], ignore_index=True)
+    values = data.to_numpy(dtype=np.float32)
+    return values[:, 1:], values[:, 0]
+
+
+def uses_csv_weights(hyperparameters):
+    """Whether the hyperparameters tell the container to read instance weights."""
+    return int(hyperparameters.get("csv_weights", 0)) == 1
+
+
+def to_dmatrix(features, labels, csv_weights=False):
+    """Builds a DMatrix of read_values, the first feature being the weight with csv_weights."""
+    if csv_weights:
+        return xgboost.DMatrix(features[:, 1:], label=labels, weight=features[:, 0])
+    return xgboost.DMatrix(features, label=labels)
+
+
+def read_files(files, input_mode="File", csv_weights=False):
+    """Reads headerless csv files with the label in the first column into a DMatrix."""
+    return to_dmatrix(*read_values(files, input_mode), csv_weights)
+
+
+def read_channel(channel_dir, input_mode="File", csv_weights=False):
+    """Reads every csv file of a channel directory into a DMatrix."""
+    return read_files(channel_files(channel_dir), input_mode, csv_weights)
+
+
+def _checkpoint_rounds(checkpoint_dir):
+    if not checkpoint_dir or not os.path.isdir(checkpoint_dir):
+        return []
+    suffixes = [n[len(_CHECKPOINT_PREFIX):] for n in os.listdir(checkpoint_dir) if n.startswith(_CHECKPOINT_PREFIX)]
+    return sorted(int(suffix) for suffix in suffixes if suffix.isdigit())
+
+
+def latest_checkpoint(checkpoint_dir):
+    """Finds the checkpoint with the most boosting rounds.
+
+    Returns:
+        a tuple of the checkpoint path and its number of rounds, or (None, 0)
+    """
+    rounds = _checkpoint_rounds(checkpoint_dir)
+    if not rounds:
+        return None, 0
+    return os.path.join(checkpoint_dir, f"{_CHECKPOINT_PREFIX}{rounds[-1]}"), rounds[-1]
+
+
+class CheckpointCallback(xgboost.callback.TrainingCallback):
+    """Saves the booster to checkpoint_dir every save_interval rounds.
+
+    Only the first worker writes. A checkpoint is written to a temporary file and renamed,
+    so an interruption never leaves a partial checkpoint behind, and only the latest
+    `keep` checkpoints are kept.
+    """
+
+    def __init__(self, checkpoint_dir, save_interval=SAVE_INTERVAL, keep=2):
+        """Creates the callback, see the class docstring."""
+        super().__init__()
+        self.checkpoint_dir = checkpoint_dir
+        self.save_interval = save_interval
+        self.keep = keep
+
+    def after_iteration(self, model, epoch, evals_log):
+        """Saves a checkpoint when the number of rounds is a multiple of save_interval."""
+        from xgboost import collective
+
+        rounds = model.num_boosted_rounds()
+        if rounds % self.save_interval or collective.get_rank() != 0:
+            return False
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        path = os.path.join(self.checkpoint_dir, f"{_CHECKPOINT_PREFIX}{rounds}")
+        with open(path + ".tmp", "wb") as f:
+            f.write(model.save_raw("ubj"))
+        os.replace(path + ".tmp", path)
+        for old in _checkpoint_rounds(self.checkpoint_dir)[: -self.keep]:
+            os.remove(os.path.join(self.checkpoint_dir, f"{_CHECKPOINT_PREFIX}{old}"))
+        return False
+
+
+def _train_booster(params, num_round, train_files, validation_dir, input_mode, checkpoint_dir=None,
+                   save_interval=SAVE_INTERVAL, csv_weights=False):
+    dtrain = read_files(train_files, input_mode, csv_weights)
+    evals = [(dtrain, "train")]
+    if validation_dir is not None:
+        evals.append((read_channel(validation_dir, input_mode, csv_weights), "validation"))
+
+    checkpoint, done = latest_checkpoint(checkpoint_dir)
+    booster = None
+    if checkpoint is not None:
+        logger.info("Resuming from %s after %d of %d rounds", checkpoint, done, num_round)
+        booster = xgboost.Booster(params)
+        with open(checkpoint, "rb") as f:
+            booster.load_model(bytearray(f.read()))
+    callbacks = [CheckpointCallback(checkpoint_dir, save_interval)] if checkpoint_dir else None
+    return xgboost.train(
+        params,
+        dtrain,
+        num_boost_round=max(0, num_round - done),
+        evals=evals,
+        verbose_eval=False,
+        xgb_model=booster,
+        callbacks=callbacks,
+    )
+
+
+def _train_worker(communicator_args, params, num_round, train_files, validation_dir, input_mode, checkpoint,
+                  model_file, csv_weights):
+    from xgboost import collective
+
+    with collective.CommunicatorContext(**communicator_args):
+        booster = _train_booster(
+            params, num_round, train_files, validation_dir, input_mode, *checkpoint, csv_weights=csv_weights
+        )
+        if collective.get_rank() == 0:
+            with open(model_file, "wb") as f:
+                pickle.dump(booster, f)
+
+
+def _train_distributed(params, num_round, train_files, validation_dir, input_mode, checkpoint, model_file,
+                       instance_count, csv_weights=False):
+    from xgboost.tracker import RabitTracker
+
+    if len(train_files) < instance_count:
+        raise ValueError(f"{len(train_files)} train files cannot be sharded across {instance_count} instances")
+    # The workers all-reduce gradient histograms, which needs the hist tree method
+    params = dict({"tree_method": "hist"}, **params)
+    params.setdefault("nthread", max(1, (os.cpu_count() or 1) // instance_count))
+
+    tracker = RabitTracker(n_workers=instance_count, host_ip="127.0.0.1")
+    tracker.start()
+    communicator_args = tracker.worker_args()
+    context = multiprocessing.get_context("spawn")
+    workers = [
+        context.Process(
+            target=_train_worker,
+            args=(
+                communicator_args,
+                params,
+                num_round,
+                train_files[rank::instance_count],
+                validation_dir,
+                input_mode,
+                checkpoint,
+                model_file,
+                csv_weights,
+            ),
+        )
+        for rank in range(instance_count)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    failed = [worker.exitcode for worker in workers if worker.exitcode != 0]
+    if failed:
+        raise RuntimeError(f"Training workers failed with exit codes {failed}")
+    tracker.wait_for()
+
+
+def _archive_model(model_file, model_dir):
+    model_path = os.path.join(model_dir, "model.tar.gz")
+    with tarfile.open(model_path, "w:gz") as tar:
+        tar.add(model_file, arcname="xgboost-model")
+    os.remove(model_file)
+    logger.info("Wrote model to %s", model_path)
+    return model_path
+
+
+def save_model(booster, model_dir):
+    """Writes the booster to model_dir/model.tar.gz in the layout of the built-in container.
+
+    Returns:
+        the path to model.tar.gz
+    """
+    os.makedirs(model_dir, exist_ok=True)
+    model_file = os.path.join(model_dir, "xgboost-model")
+    with open(model_file, "wb") as f:
+        pickle.dump(booster, f)
+    return _archive_model(model_file, model_dir)
+
+
+def train(
+    train_dir,
+    validation_dir,
+    model_dir,
+    hyperparameters,
+    instance_count=1,
+    input_mode="File",
+    checkpoint_dir=None,
+    save_interval=SAVE_INTERVAL,
+):
+    """Trains the booster and writes model_dir/model.tar.gz.
+
+    Args:
+        train_dir: the train channel directory
+        validation_dir: the validation channel directory, or None
+        model_dir: the directory to write model.tar.gz to
+        hyperparameters: the hyperparameters as passed to the built-in container
+        instance_count: the number of training instances, each training on its share
+            of the train files
+        input_mode: the input mode of the channels, one of INPUT_MODES
+        checkpoint_dir: the directory to checkpoint to and resume from, or None
+        save_interval: the number of rounds between checkpoints
+
+    Returns:
+        the path to model.tar.gz
+    """
+    params = {k: v for k, v in hyperparameters.items() if k not in _CONTAINER_ONLY}
+    num_round = int(hyperparameters.get("num_round", 10))
+    train_files = channel_files(train_dir)
+    checkpoint = (checkpoint_dir, save_interval)
+    csv_weights = uses_csv_weights(hyperparameters)
+
+    if instance_count <= 1:
+        booster = _train_booster(
+            params, num_round, train_files, validation_dir, input_mode, *checkpoint, csv_weights=csv_weights
+        )
+        return save_model(booster, model_dir)
+
+    os.makedirs(model_dir, exist_ok=True)
+    model_file = os.path.join(model_dir, "xgboost-model")
+    _train_distributed(
+        params, num_round, train_files, validation_dir, input_mode, checkpoint, model_file, instance_count,
+        csv_weights,
+    )
+    return _archive_model(model_file, model_dir)
@@ -0,0 +1,119 @@
+# Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+"""Local stand-in for the batch transform job of the pipeline.
+
+Mirrors the settings of Step-BatchTransform: the input files are distributed across the
+instances, each file is split by line and sent to the model in MultiRecord mini-batches
+of at most max_payload MB, the key in the first column is kept out of the model input
+($[1:]) and joined back to the prediction ($[0,-1]). Each input file <name> produces
+<name>.out in the output directory.
+"""
+import io
+import logging
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import xgboost
+
+from pipelines.bankdm.scoring import load_model
+
+logger = logging.getLogger(__name__)
+
+
+def mini_batches(lines, max_payload):
+    """Groups lines into mini-batches of at most max_payload MB.
+
+    A line larger than max_payload forms a batch of its own, as a single record that the
+    container still has to accept.
+
+    Args:
+        lines: the newline-terminated records
+        max_payload: the maximum payload size in MB
+
+    Yields:
+        lists of lines
+    """
+    limit = max_payload * 1024 * 1024
+    batch, size = [], 0
+    for line in lines:
+        if batch and size + len(line) > limit:
+            yield batch
+            batch, size = [], 0
+        batch.append(line)
+        size += len(line)
+    if batch:
+        yield batch
+
+
+def transform_file(booster, input_path, output_path, max_payload=6):
+    """Scores one input file and writes the keys joined with their predictions.
+
+    Returns:
+        a tuple of the number of rows and of mini-batches
+    """
+    rows, batches = 0, 0
+    with open(input_path) as src, open(output_path, "w") as dst:
+        for batch in mini_batches(src, max_payload):
+            # The key, any column of the table, is split off as text and never parsed
+            keys, features = zip(*(line.split(",", 1) for line in batch))
+            values = np.loadtxt(io.StringIO("".join(features)), delimiter=",", dtype=np.float32, ndmin=2)
+            predictions = booster.predict(xgboost.DMatrix(values))
+            dst.writelines(f"{key},{p}\n" for key, p in zip(keys, predictions))
+            rows += len(batch)
+            batches += 1
+    return rows, batches
+
+
+def batch_transform(model_path, input_dir, output_dir, instance_count=2, max_payload=6):
+    """Scores every file of input_dir across instance_count workers.
+
+    Args:
+        model_path: the model.tar.gz to score with
+        input_dir: the directory of headerless csv files, key first
+        output_dir: the directory to write the <name>.out files to
+        instance_count: the number of instances, each scoring its share of the files
+        max_payload: the maximum size of a mini-batch in MB
+
+    Returns:
+        a dict with the rows, mini-batches, seconds and rows per second of the transform
+    """
+    files = sorted(f for f in os.listdir(input_dir) if not f.startswith("."))
+    os.makedirs(output_dir, exist_ok=True)
+
+    def run_instance(instance):
+        # Every instance loads its own copy of the model, as the transform containers do
+        booster = load_model(model_path)
+        counts = [
+            transform_file(booster, os.path.join(input_dir, f), os.path.join(output_dir, f + ".out"), max_payload)
+            for f in files[instance::instance_count]
+        ]
+        return [sum(c) for c in zip(*counts)] or [0, 0]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=instance_count) as pool:
+        counts = list(pool.map(run_instance, range(instance_count)))
+    seconds = time.perf_counter() - start
+    rows, batches = [sum(c) for c in zip(*counts)]
+    stats = {
+        "rows": rows,
+        "batches": batches,
+        "files": len(files),
+        "seconds": seconds,
+        "rows_per_second": rows / seconds if seconds else 0.0,
+    }
+    logger.info("Scored %d rows in %d mini-batches in %.2fs (%.0f rows/s)", rows, batches, seconds,
+                stats["rows_per_second"])
+    return stats
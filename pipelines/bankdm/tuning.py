@@ -0,0 +1,161 @@
+# Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+"""Local stand-in for the Hyperband tuning job of the pipeline.
+
+Runs successive halving over randomly sampled candidates: every rung trains the
+surviving trials in parallel on a subsample of the train split for a fraction of the
+rounds, stops a trial once its validation rmse stops improving, and promotes the best
+1/reduction_factor of the trials to the next rung. The last rung trains on the whole
+train split for the full num_round, and its best booster is written as the model.
+"""
+import logging
+import math
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import xgboost
+
+from pipelines.bankdm import train as local_train
+
+logger = logging.getLogger(__name__)
+
+
+def sample_candidates(ranges, n, seed=1729):
+    """Samples candidate hyperparameters uniformly from the ranges.
+
+    Args:
+        ranges: a dict of hyperparameter name to (type, min, max), type being
+            "Integer" or "Continuous"
+        n: the number of candidates
+        seed: the random seed, the same seed samples the same candidates
+
+    Returns:
+        a list of n dicts of hyperparameters
+    """
+    rng = np.random.default_rng(seed)
+    candidates = []
+    for _ in range(n):
+        candidate = {}
+        for name, (kind, low, high) in ranges.items():
+            if kind == "Integer":
+                candidate[name] = int(rng.integers(low, high + 1))
+            else:
+                candidate[name] = round(float(rng.uniform(low, high)), 4)
+        candidates.append(candidate)
+    return candidates
+
+
+def rung_schedule(n_candidates, num_round, reduction_factor=3):
+    """Plans the rungs of successive halving.
+
+    Returns:
+        a list of (number of trials, fraction of the train split, rounds) per rung
+    """
+    rungs = max(1, int(math.log(n_candidates, reduction_factor) + 1e-9) + 1)
+    schedule = []
+    trials = n_candidates
+    for rung in range(rungs):
+        fraction = float(reduction_factor) ** (rung - rungs + 1)
+        schedule.append((trials, fraction, max(1, int(round(num_round * fraction)))))
+        trials = max(1, math.ceil(trials / reduction_factor))
+    return schedule
+
+
+def tune(
+    train_dir,
+    validation_dir,
+    model_dir,
+    hyperparameters,
+    ranges,
+    max_jobs=27,
+    max_parallel_jobs=4,
+    reduction_factor=3,
+    early_stopping_rounds=5,
+    seed=1729,
+):
+    """Tunes the hyperparameters by successive halving and writes the best model.
+
+    Args:
+        train_dir: the train channel directory, its rows already shuffled
+        validation_dir: the validation channel directory, which scores the trials
+        model_dir: the directory to write model.tar.gz of the best trial to
+        hyperparameters: the static hyperparameters, num_round being the budget of
+            the last rung
+        ranges: the search space, see sample_candidates
+        max_jobs: the number of candidates
+        max_parallel_jobs: the number of trials trained at the same time
+        reduction_factor: the fraction 1/reduction_factor of the trials promoted per rung
+        early_stopping_rounds: stop a trial after this many rounds without improvement
+        seed: the random seed of the candidates
+
+    Returns:
+        a dict with the best hyperparameters, its validation rmse and every trial
+    """
+    params = {k: v for k, v in hyperparameters.items() if k not in local_train._CONTAINER_ONLY}
+    num_round = int(hyperparameters.get("num_round", 10))
+    csv_weights = local_train.uses_csv_weights(hyperparameters)
+    features, labels = local_train.read_values(local_train.channel_files(train_dir))
+    dvalid = local_train.read_channel(validation_dir, csv_weights=csv_weights)
+    nthread = max(1, (os.cpu_count() or 1) // max_parallel_jobs)
+
+    candidates = [dict(params, **c) for c in sample_candidates(ranges, max_jobs, seed)]
+    survivors = list(range(len(candidates)))
+    trials = []
+    boosters = {}
+    for rung, (_, fraction, rounds) in enumerate(rung_schedule(max_jobs, num_round, reduction_factor)):
+        rows = max(1, int(len(labels) * fraction))
+        dtrain = local_train.to_dmatrix(features[:rows], labels[:rows], csv_weights)
+
+        def run_trial(index):
+            booster = xgboost.train(
+                dict(candidates[index], nthread=nthread),
+                dtrain,
+                num_boost_round=rounds,
+                evals=[(dvalid, "validation")],
+                early_stopping_rounds=early_stopping_rounds,
+                verbose_eval=False,
+            )
+            return index, booster
+
+        with ThreadPoolExecutor(max_workers=max_parallel_jobs) as pool:
+            results = list(pool.map(run_trial, survivors))
+
+        scores = {}
+        for index, booster in results:
+            scores[index] = booster.best_score
+            boosters[index] = booster
+            trials.append(
+                {
+                    "rung": rung,
+                    "trial": index,
+                    "rows": rows,
+                    "rounds": booster.best_iteration + 1,
+                    "validation_rmse": booster.best_score,
+                    "hyperparameters": candidates[index],
+                }
+            )
+        logger.info("Rung %d: %d trials on %d rows for up to %d rounds", rung, len(survivors), rows, rounds)
+        keep = max(1, math.ceil(len(survivors) / reduction_factor))
+        survivors = sorted(survivors, key=scores.get)[:keep]
+
+    best = survivors[0]
+    booster = boosters[best]
+    local_train.save_model(booster[: booster.best_iteration + 1], model_dir)
+    best_hyperparameters = dict(hyperparameters, **{k: candidates[best][k] for k in ranges})
+    return {
+        "best_hyperparameters": best_hyperparameters,
+        "best_validation_rmse": booster.best_score,
+        "trials": trials,
+    }
@@ -0,0 +1,46 @@
+# Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+"""Content digests used to key pipeline step caching."""
+from __future__ import absolute_import
+
+import hashlib
+import json
+
+
+def file_digest(*paths):
+    """Returns the sha256 hex digest of the contents of the given files, in order."""
+    sha = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha.update(block)
+    return sha.hexdigest()
+
+
+def step_fingerprint(code_digest, params=None, upstream=()):
+    """Returns the cache key of a step.
+
+    Args:
+        code_digest: the digest of the step's code
+        params: the JSON-serialisable parameters of the step, e.g. hyperparameters
+        upstream: the digests of the data manifests or fingerprints of upstream steps
+
+    Returns:
+        a sha256 hex digest that changes whenever any of the inputs change
+    """
+    payload = json.dumps(
+        {"code": code_digest, "params": params or {}, "upstream": list(upstream)},
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
@@ -16,7 +16,7 @@ from __future__ import absolute_import
 import argparse
 import sys
 
-from pipelines._utils import get_pipeline_driver
+from pipelines._utils import get_pipeline_driver, convert_struct
 
 
 def main():  # pragma: no cover
@@ -48,6 +48,19 @@ def main():  # pragma: no cover
         default=None,
         help="Dict string of keyword arguments for the pipeline generation (if supported)",
     )
+    parser.add_argument(
+        "--offline",
+        dest="offline",
+        action="store_true",
+        help="Build the definition without calling AWS (if supported). The account, role, "
+        "image and bucket must then be given in --kwargs or the --env-cache file.",
+    )
+    parser.add_argument(
+        "--env-cache",
+        dest="env_cache",
+        default=None,
+        help="JSON file caching the account, role, image and bucket between builds (if supported)",
+    )
     args = parser.parse_args()
 
     if args.module_name is None:
@@ -55,7 +68,12 @@ def main():  # pragma: no cover
         sys.exit(2)
 
     try:
-        pipeline = get_pipeline_driver(args.module_name, args.kwargs)
+        kwargs = convert_struct(args.kwargs)
+        if args.offline:
+            kwargs["offline"] = True
+        if args.env_cache:
+            kwargs["env_cache"] = args.env_cache
+        pipeline = get_pipeline_driver(args.module_name, kwargs)
         content = pipeline.definition()
         if args.file_name:
             with open(args.file_name, "w") as f:
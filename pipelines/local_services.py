@@ -0,0 +1,521 @@
+# Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+"""Local stand-ins for the AWS services used by the pipeline.
+
+These keep the call signatures and response shapes of the boto3 clients they replace,
+so that the same pipeline code can run offline against a local directory.
+"""
+from __future__ import absolute_import
+
+import csv
+import datetime
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+
+
+class LocalS3:
+    """A local directory standing in for S3, where s3://bucket/key maps to <root>/bucket/key."""
+
+    def __init__(self, root):
+        """Creates the local S3 rooted at the given directory.
+
+        Args:
+            root: the directory holding one sub-directory per bucket
+        """
+        self.root = os.path.abspath(root)
+
+    def path(self, s3_uri):
+        """Returns the local path of an s3:// uri."""
+        match = re.match(r"^s3://([^/]+)/?(.*)$", s3_uri)
+        if match is None:
+            raise ValueError(f"Not an S3 uri: {s3_uri}")
+        bucket, key = match.groups()
+        return os.path.join(self.root, bucket, *[p for p in key.split("/") if p])
+
+    def list(self, s3_uri):
+        """Lists the s3:// uris of all objects under a prefix, in key order."""
+        base = self.path(s3_uri)
+        uris = []
+        for dirpath, _, filenames in os.walk(base):
+            for filename in filenames:
+                rel = os.path.relpath(os.path.join(dirpath, filename), self.root)
+                uris.append("s3://" + rel.replace(os.sep, "/"))
+        return sorted(uris)
+
+    def list_objects_v2(self, Bucket, Prefix="", **kwargs):
+        """Lists the objects under a prefix in the response shape of S3.Client.list_objects_v2."""
+        contents = []
+        for uri in self.list(f"s3://{Bucket}/{Prefix}"):
+            path = self.path(uri)
+            with open(path, "rb") as f:
+                etag = hashlib.md5(f.read()).hexdigest()
+            contents.append(
+                {
+                    "Key": uri[len(f"s3://{Bucket}/"):],
+                    "ETag": f'"{etag}"',
+                    "Size": os.path.getsize(path),
+                    "LastModified": datetime.datetime.fromtimestamp(os.path.getmtime(path), datetime.timezone.utc),
+                }
+            )
+        return {"Contents": contents, "KeyCount": len(contents), "IsTruncated": False}
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        """Deletes objects and the directories left empty, see S3.Client.delete_objects."""
+        deleted = []
+        for obj in Delete["Objects"]:
+            path = self.path(f"s3://{Bucket}/{obj['Key']}")
+            if os.path.exists(path):
+                os.remove(path)
+                deleted.append({"Key": obj["Key"]})
+            directory = os.path.dirname(path)
+            while directory != self.root and os.path.isdir(directory) and not os.listdir(directory):
+                os.rmdir(directory)
+                directory = os.path.dirname(directory)
+        return {"Deleted": deleted}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        """Writes an object, see S3.Client.put_object."""
+        path = self.path(f"s3://{Bucket}/{Key}")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = Body.encode("utf-8") if isinstance(Body, str) else Body
+        with open(path, "wb") as f:
+            f.write(data)
+        return {"ETag": f'"{hashlib.md5(data).hexdigest()}"'}
+
+
+def redshift_column_name(name):
+    """Maps a bank-additional.csv header to the RedShift column name created in notebook 03."""
+    name = name.replace(".", "_")
+    return "defaulted" if name == "default" else name
+
+
+def _column_type(values):
+    for cast, sql_type in ((int, "INTEGER"), (float, "REAL")):
+        try:
+            for value in values:
+                cast(value)
+            return sql_type, cast
+        except ValueError:
+            continue
+    return "TEXT", str
+
+
+class LocalRedshiftDataClient:
+    """A Redshift Data API client backed by SQLite.
+
+    Supports execute_statement, batch_execute_statement, describe_statement and
+    get_statement_result. Statements run synchronously, so describe_statement reports
+    FINISHED (or FAILED) as soon as the Id is returned. UNLOAD is emulated by writing
+    gzipped CSV shards into a LocalS3, and COPY by reading CSV files, gzipped or not, from
+    a prefix or a manifest of it. The Redshift statements of a staged merge without a
+    SQLite equivalent, CREATE SCHEMA, CREATE TEMP TABLE (LIKE) and DELETE USING, are
+    rewritten for SQLite.
+    """
+
+    _unload = re.compile(
+        r"^\s*unload\s*\(\s*'(?P<query>.*)'\s*\)\s*to\s*'(?P<uri>[^']+)'(?P<options>.*)$",
+        re.IGNORECASE | re.DOTALL,
+    )
+    _copy = re.compile(
+        r"^\s*copy\s+(?P<table>[\w.\"]+)\s*(?:\((?P<columns>[^)]*)\))?\s*from\s*'(?P<uri>[^']+)'(?P<options>.*)$",
+        re.IGNORECASE | re.DOTALL,
+    )
+    _create_schema = re.compile(
+        r"^\s*create\s+schema\s+(?:if\s+not\s+exists\s+)?(?P<schema>\w+)\s*;?\s*$", re.IGNORECASE
+    )
+    _create_like = re.compile(
+        r"^\s*create\s+temp(?:orary)?\s+table\s+(?P<table>\w+)\s*\(\s*like\s+(?P<source>[\w.\"]+)\s*\)\s*;?\s*$",
+        re.IGNORECASE,
+    )
+    _delete_using = re.compile(
+        r"^\s*delete\s+from\s+(?P<table>[\w.\"]+)\s+using\s+(?P<using>[\w.\"]+)\s+where\s+(?P<condition>.*?)\s*;?\s*$",
+        re.IGNORECASE | re.DOTALL,
+    )
+
+    def __init__(self, s3, database=":memory:", slices=4):
+        """Creates the client.
+
+        Args:
+            s3: the LocalS3 that UNLOAD writes to
+            database: the SQLite database file
+            slices: the number of shards UNLOAD writes, like the slices of a cluster
+        """
+        self.s3 = s3
+        self.slices = slices
+        self._conn = sqlite3.connect(database, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        self._statements = {}
+
+    def load_csv(self, path, schema, table, key_column=None):
+        """Creates schema.table from a csv file such as bank-additional.csv.
+
+        Args:
+            path: the csv file with a header row
+            schema: the schema to create the table in
+            table: the table name
+            key_column: the name of a key column to number the rows in from 1, first, as
+                an IDENTITY(1, 1) column would; none if None
+
+        Returns:
+            the number of rows loaded
+        """
+        with open(path, newline="") as f:
+            reader = csv.reader(f)
+            header = [redshift_column_name(c) for c in next(reader)]
+            rows = list(reader)
+        if key_column:
+            header = [key_column] + header
+            rows = [[str(i)] + row for i, row in enumerate(rows, 1)]
+        types = [_column_type([r[i] for r in rows]) for i in range(len(header))]
+        with self._lock:
+            self._attach(schema)
+            columns = ", ".join(f'"{c}" {t}' for c, (t, _) in zip(header, types))
+            self._conn.execute(f'DROP TABLE IF EXISTS {schema}."{table}"')
+            self._conn.execute(f'CREATE TABLE {schema}."{table}" ({columns})')
+            self._conn.executemany(
+                f'INSERT INTO {schema}."{table}" VALUES ({", ".join("?" * len(header))})',
+                [[cast(v) for v, (_, cast) in zip(r, types)] for r in rows],
+            )
+        return len(rows)
+
+    def _attach(self, schema):
+        attached = [row[1] for row in self._conn.execute("PRAGMA database_list")]
+        if schema not in attached:
+            self._conn.execute(f"ATTACH DATABASE ':memory:' AS {schema}")
+
+    def execute_statement(self, Sql, Database=None, **kwargs):
+        """Runs one statement, see RedshiftDataAPIService.Client.execute_statement."""
+        return self._run([Sql], Database)
+
+    def batch_execute_statement(self, Sqls, Database=None, **kwargs):
+        """Runs the statements as one transaction, see batch_execute_statement."""
+        return self._run(Sqls, Database)
+
+    def _run(self, sqls, database):
+        statement_id = str(uuid.uuid4())
+        started = time.time()
+        result = {"Id": statement_id, "Database": database, "QueryString": ";".join(sqls)}
+        try:
+            with self._lock:
+                columns, records, affected = self._execute_all(sqls)
+            result.update(Status="FINISHED", ResultRows=affected, HasResultSet=columns is not None)
+            result["_columns"], result["_records"] = columns, records
+        except (sqlite3.Error, ValueError) as e:
+            result.update(Status="FAILED", Error=str(e), HasResultSet=False)
+        result["Duration"] = int((time.time() - started) * 1e9)
+        self._statements[statement_id] = result
+        return {"Id": statement_id, "Database": database}
+
+    def _execute_all(self, sqls):
+        columns, records, affected = None, [], 0
+        self._conn.execute("BEGIN")
+        try:
+            for sql in sqls:
+                columns, records, count = self._execute(sql)
+                affected += count
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        return columns, records, affected
+
+    def _execute(self, sql):
+        unload = self._unload.match(sql)
+        if unload:
+            return None, [], self._unload_to_s3(
+                unload.group("query").replace("''", "'").rstrip("; "),
+                unload.group("uri"),
+                unload.group("options").lower(),
+            )
+        copy = self._copy.match(sql)
+        if copy:
+            return None, [], self._copy_from_s3(
+                copy.group("table"), copy.group("columns"), copy.group("uri"), copy.group("options").lower()
+            )
+        create_schema = self._create_schema.match(sql)
+        if create_schema:
+            self._attach(create_schema.group("schema"))
+            return None, [], 0
+        sql = self._create_like.sub(r"CREATE TEMP TABLE \g<table> AS SELECT * FROM \g<source> WHERE 0", sql)
+        sql = self._delete_using.sub(
+            r"DELETE FROM \g<table> WHERE EXISTS (SELECT 1 FROM \g<using> WHERE \g<condition>)", sql
+        )
+        cursor = self._conn.execute(sql)
+        if cursor.description is None:
+            return None, [], max(cursor.rowcount, 0)
+        records = cursor.fetchall()
+        return [d[0] for d in cursor.description], records, len(records)
+
+    def _unload_to_s3(self, query, uri, options):
+        cursor = self._conn.execute(query)
+        header = [d[0] for d in cursor.description]
+        rows = cursor.fetchall()
+        target = self.s3.path(uri)
+        os.makedirs(target, exist_ok=True)
+        if "allowoverwrite" in options:
+            for name in os.listdir(target):
+                if re.match(r"^\d{4}_part_\d{2}", name):
+                    os.remove(os.path.join(target, name))
+        gzipped = "gzip" in options
+        for i in range(self.slices):
+            name = f"{i:04d}_part_00" + (".gz" if gzipped else "")
+            buffer = io.StringIO(newline="")
+            writer = csv.writer(buffer, lineterminator="\n")
+            if "header" in options:
+                writer.writerow(header)
+            writer.writerows(rows[i :: self.slices])
+            data = buffer.getvalue().encode("utf-8")
+            with open(os.path.join(target, name), "wb") as f:
+                # mtime=0 keeps the shards, and so their ETags, identical for identical data
+                f.write(gzip.compress(data, mtime=0) if gzipped else data)
+        return len(rows)
+
+    def _copy_from_s3(self, table, columns, uri, options):
+        if "manifest" in options:
+            with open(self.s3.path(uri)) as f:
+                uris = [entry["url"] for entry in json.load(f)["entries"]]
+        else:
+            uris = self.s3.list(uri)
+        skip = re.search(r"ignoreheader\s+(?:as\s+)?(\d+)", options)
+        delimiter = re.search(r"delimiter\s+(?:as\s+)?'(.)'", options)
+        rows = []
+        for file_uri in uris:
+            with open(self.s3.path(file_uri), "rb") as f:
+                data = f.read()
+            if "gzip" in options:
+                data = gzip.decompress(data)
+            reader = csv.reader(io.StringIO(data.decode("utf-8"), newline=""),
+                                delimiter=delimiter.group(1) if delimiter else ",")
+            rows.extend(list(reader)[int(skip.group(1)) if skip else 0 :])
+        if not rows:
+            return 0
+        target = f"{table} ({columns})" if columns else table
+        self._conn.executemany(f"INSERT INTO {target} VALUES ({', '.join('?' * len(rows[0]))})",
+                               [[v if v != "" else None for v in row] for row in rows])
+        return len(rows)
+
+    def describe_statement(self, Id):
+        """Describes a statement, see RedshiftDataAPIService.Client.describe_statement."""
+        return {k: v for k, v in self._statements[Id].items() if not k.startswith("_")}
+
+    def get_statement_result(self, Id, **kwargs):
+        """Returns the records of a statement in the typed-field shape of the Data API."""
+        statement = self._statements[Id]
+        if not statement.get("HasResultSet"):
+            raise ValueError(f"Statement {Id} has no result set")
+
+        def field(value):
+            if value is None:
+                return {"isNull": True}
+            if isinstance(value, int):
+                return {"longValue": value}
+            if isinstance(value, float):
+                return {"doubleValue": value}
+            return {"stringValue": str(value)}
+
+        return {
+            "ColumnMetadata": [{"name": c} for c in statement["_columns"]],
+            "Records": [[field(v) for v in record] for record in statement["_records"]],
+            "TotalNumRows": len(statement["_records"]),
+        }
+
+
+class LocalClientError(Exception):
+    """An error carrying the response shape of botocore's ClientError."""
+
+    def __init__(self, code, message):
+        """Creates the error with an error code such as ResourceNotFound."""
+        super().__init__(f"An error occurred ({code}): {message}")
+        self.response = {"Error": {"Code": code, "Message": message}}
+
+
+class LocalSageMakerClient:
+    """A SageMaker client for the pipeline APIs that plays back a scripted execution.
+
+    Pipelines are stored in memory. An execution runs its steps in order, one step per
+    call to describe_pipeline_execution, so that a poller sees every step go through
+    Executing to its outcome. A step given a failure reason fails the execution, and the
+    steps after it never start. Endpoints are described from the endpoints dict, which a
+    test updates to deploy another config.
+    """
+
+    def __init__(self, steps=(), failures=None, cache_hits=(), page_size=2, endpoints=None):
+        """Creates the client.
+
+        Args:
+            steps: the step names in the order they run
+            failures: a dict of step name to the failure reason of that step
+            cache_hits: the names of the steps reusing a cached result
+            page_size: the number of steps per page of list_pipeline_execution_steps
+            endpoints: a dict of endpoint name to its EndpointConfigName and
+                EndpointStatus, as describe_endpoint answers them
+        """
+        self.steps = list(steps)
+        self.failures = dict(failures or {})
+        self.cache_hits = set(cache_hits)
+        self.page_size = page_size
+        self.endpoints = dict(endpoints or {})
+        self.pipelines = {}
+        self.calls = []
+        self._executions = {}
+        self._epoch = datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc)
+
+    def create_pipeline(self, PipelineName, PipelineDefinition, RoleArn, **kwargs):
+        """Creates a pipeline, see SageMaker.Client.create_pipeline."""
+        self.calls.append("create_pipeline")
+        if PipelineName in self.pipelines:
+            raise LocalClientError("ValidationException", f"Pipeline {PipelineName} already exists")
+        self.pipelines[PipelineName] = PipelineDefinition
+        return {"PipelineArn": self._pipeline_arn(PipelineName)}
+
+    def update_pipeline(self, PipelineName, PipelineDefinition, **kwargs):
+        """Updates a pipeline, see SageMaker.Client.update_pipeline."""
+        self.calls.append("update_pipeline")
+        self._pipeline(PipelineName)
+        self.pipelines[PipelineName] = PipelineDefinition
+        return {"PipelineArn": self._pipeline_arn(PipelineName)}
+
+    def describe_pipeline(self, PipelineName):
+        """Describes a pipeline, see SageMaker.Client.describe_pipeline."""
+        self.calls.append("describe_pipeline")
+        return {
+            "PipelineArn": self._pipeline_arn(PipelineName),
+            "PipelineName": PipelineName,
+            "PipelineDefinition": self._pipeline(PipelineName),
+        }
+
+    def start_pipeline_execution(self, PipelineName, **kwargs):
+        """Starts an execution, see SageMaker.Client.start_pipeline_execution."""
+        self.calls.append("start_pipeline_execution")
+        self._pipeline(PipelineName)
+        arn = f"{self._pipeline_arn(PipelineName)}/execution/{uuid.uuid4().hex[:12]}"
+        self._executions[arn] = 0
+        return {"PipelineExecutionArn": arn}
+
+    def describe_pipeline_execution(self, PipelineExecutionArn):
+        """Advances the execution by one step and describes it."""
+        tick = self._executions[PipelineExecutionArn] = self._executions[PipelineExecutionArn] + 1
+        steps = self._steps_at(tick)
+        if any(step["StepStatus"] == "Failed" for step in steps):
+            status = "Failed"
+        elif len(steps) == len(self.steps) and all(step["StepStatus"] == "Succeeded" for step in steps):
+            status = "Succeeded"
+        else:
+            status = "Executing"
+        return {"PipelineExecutionArn": PipelineExecutionArn, "PipelineExecutionStatus": status}
+
+    def list_pipeline_execution_steps(self, PipelineExecutionArn, NextToken=None, **kwargs):
+        """Lists the steps started so far, latest first, in pages of page_size."""
+        steps = list(reversed(self._steps_at(self._executions[PipelineExecutionArn])))
+        start = int(NextToken or 0)
+        response = {"PipelineExecutionSteps": steps[start : start + self.page_size]}
+        if start + self.page_size < len(steps):
+            response["NextToken"] = str(start + self.page_size)
+        return response
+
+    def describe_endpoint(self, EndpointName):
+        """Describes an endpoint, see SageMaker.Client.describe_endpoint."""
+        self.calls.append("describe_endpoint")
+        if EndpointName not in self.endpoints:
+            raise LocalClientError("ValidationException", f"Could not find endpoint {EndpointName}")
+        return dict(self.endpoints[EndpointName], EndpointName=EndpointName)
+
+    def _steps_at(self, tick):
+        steps = []
+        for i, name in enumerate(self.steps):
+            if i >= tick:
+                break
+            step = {"StepName": name, "StartTime": self._epoch + datetime.timedelta(minutes=i)}
+            if i == tick - 1:
+                step["StepStatus"] = "Executing"
+                steps.append(step)
+                break
+            step["EndTime"] = self._epoch + datetime.timedelta(minutes=i + 1)
+            if name in self.failures:
+                step.update(StepStatus="Failed", FailureReason=self.failures[name])
+                steps.append(step)
+                break
+            step["StepStatus"] = "Succeeded"
+            if name in self.cache_hits:
+                step["CacheHitResult"] = {"SourcePipelineExecutionArn": "arn:aws:sagemaker:local:execution/cached"}
+            steps.append(step)
+        return steps
+
+    def _pipeline(self, name):
+        if name not in self.pipelines:
+            raise LocalClientError("ResourceNotFound", f"Pipeline {name} does not exist")
+        return self.pipelines[name]
+
+    @staticmethod
+    def _pipeline_arn(name):
+        return f"arn:aws:sagemaker:local:000000000000:pipeline/{name.lower()}"
+
+
+class LocalSageMakerRuntimeClient:
+    """A sagemaker-runtime client serving invoke_endpoint from a local predict function.
+
+    Every request takes latency seconds plus row_latency seconds per row, like a real
+    endpoint where the round trip dominates small requests. Requests above the payload
+    limit fail validation, and requests beyond max_concurrency in flight are throttled.
+    """
+
+    def __init__(self, predict, latency=0.0, row_latency=0.0, max_concurrency=None,
+                 max_payload=6 * 1024 * 1024):
+        """Creates the client.
+
+        Args:
+            predict: called with the rows of a request as a list of lists of floats,
+                returns one prediction per row
+            latency: the seconds every request takes
+            row_latency: the additional seconds per row of a request
+            max_concurrency: the number of requests in flight above which requests are
+                throttled, unlimited if None
+            max_payload: the maximum payload size in bytes
+        """
+        self.predict = predict
+        self.latency = latency
+        self.row_latency = row_latency
+        self.max_concurrency = max_concurrency
+        self.max_payload = max_payload
+        self.requests = 0
+        self.throttled = 0
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    def invoke_endpoint(self, EndpointName, Body, ContentType="text/csv", Accept="text/csv", **kwargs):
+        """Scores a text/csv payload, see SageMakerRuntime.Client.invoke_endpoint."""
+        if len(Body) > self.max_payload:
+            raise LocalClientError("ValidationError", f"Payload of {len(Body)} bytes exceeds {self.max_payload}")
+        with self._lock:
+            self.requests += 1
+            if self.max_concurrency is not None and self._in_flight >= self.max_concurrency:
+                self.throttled += 1
+                raise LocalClientError("ThrottlingException", "Rate exceeded")
+            self._in_flight += 1
+        try:
+            rows = [[float(v) for v in line.split(",")] for line in Body.decode("utf-8").splitlines() if line]
+            time.sleep(self.latency + self.row_latency * len(rows))
+            predictions = self.predict(rows)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+        body = "\n".join(str(p) for p in predictions).encode("utf-8")
+        return {"Body": io.BytesIO(body), "ContentType": Accept, "InvokedProductionVariant": "AllTraffic"}
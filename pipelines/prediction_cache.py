@@ -0,0 +1,143 @@
+# Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+"""A bounded cache of predictions keyed on encoded feature vectors.
+
+Once duration and the macro columns are dropped many customers encode to the same
+feature vector, so the same predictions are requested again and again. The cache keys a
+prediction on a hash of the float32 bytes of the encoded row and on the digest of the
+model that predicted it, evicts the least recently used entries beyond max_size and
+expires entries older than ttl seconds. Setting a different model digest empties it.
+"""
+from __future__ import absolute_import
+
+import hashlib
+import threading
+import time
+
+from collections import OrderedDict
+
+import numpy as np
+
+
+class PredictionCache:
+    """An LRU cache of predictions with a time to live, see the module docstring."""
+
+    def __init__(self, max_size=100000, ttl=3600.0, clock=time.monotonic):
+        """Creates the cache.
+
+        Args:
+            max_size: the maximum number of cached predictions
+            ttl: the seconds a prediction stays valid, None to never expire
+            clock: returns the current time in seconds
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.model_digest = None
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expirations": 0,
+            "invalidations": 0,
+            "lookup_seconds": 0.0,
+            "predict_seconds": 0.0,
+        }
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        """Returns the number of cached predictions."""
+        return len(self._entries)
+
+    def set_model(self, model_digest):
+        """Sets the digest of the model predicting, emptying the cache if it changed."""
+        with self._lock:
+            if model_digest != self.model_digest:
+                if self._entries:
+                    self.stats["invalidations"] += 1
+                self._entries.clear()
+                self.model_digest = model_digest
+
+    def key(self, row):
+        """Returns the cache key of an encoded row."""
+        row = np.ascontiguousarray(row, dtype=np.float32)
+        return hashlib.blake2b(row.tobytes(), digest_size=16, key=str(self.model_digest).encode("utf-8")[:64]).digest()
+
+    def _lookup(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, stored = entry
+        if self.ttl is not None and now - stored > self.ttl:
+            del self._entries[key]
+            self.stats["expirations"] += 1
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _store(self, key, value, now):
+        self._entries[key] = (value, now)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def predict(self, rows, predict):
+        """Predicts the rows, calling predict only for the distinct rows not cached.
+
+        Args:
+            rows: a 2-d array of encoded rows
+            predict: called with the 2-d float32 array of the rows missed, returns one
+                prediction per row
+
+        Returns:
+            a float64 array with one prediction per row
+        """
+        start = time.perf_counter()
+        rows = np.ascontiguousarray(rows, dtype=np.float32).reshape(len(rows), -1)
+        keys = [self.key(row) for row in rows]
+        predictions = np.empty(len(rows), dtype=np.float64)
+        # The rows missed, by key, the first one of every key being predicted
+        missed = OrderedDict()
+        with self._lock:
+            now = self.clock()
+            for i, key in enumerate(keys):
+                value = None if key in missed else self._lookup(key, now)
+                if value is None:
+                    missed.setdefault(key, []).append(i)
+                else:
+                    predictions[i] = value
+            self.stats["hits"] += len(rows) - len(missed)
+            self.stats["misses"] += len(missed)
+            self.stats["lookup_seconds"] += time.perf_counter() - start
+        if missed:
+            start = time.perf_counter()
+            first = [indexes[0] for indexes in missed.values()]
+            values = np.asarray(predict(rows[first]), dtype=np.float64)
+            with self._lock:
+                self.stats["predict_seconds"] += time.perf_counter() - start
+                now = self.clock()
+                for (key, indexes), value in zip(missed.items(), values):
+                    predictions[indexes] = value
+                    self._store(key, value, now)
+        return predictions
+
+    def snapshot(self):
+        """Returns the counters with the size, the hit rate and the mean lookup time in us."""
+        with self._lock:
+            stats = dict(self.stats, size=len(self._entries))
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        stats["lookup_us"] = stats["lookup_seconds"] / lookups * 1e6 if lookups else 0.0
+        return stats
@@ -0,0 +1,218 @@
+# Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+"""A client scoring many rows against a SageMaker endpoint.
+
+Instead of one invoke_endpoint call per row, rows are packed into multi-row text/csv
+payloads of up to max_payload bytes, the payloads are sent concurrently by a bounded
+thread pool, throttled requests are retried with exponential backoff and the predictions
+are reassembled in the order of the input rows. With a PredictionCache, only the rows
+not predicted before by the same model version are sent. Unless given, the version is
+the endpoint config the endpoint runs, as an update deploys a new config: it is described
+again every version_refresh seconds, and the cache is bypassed while the endpoint updates.
+"""
+from __future__ import absolute_import
+
+import random
+import re
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+# Real-time endpoints reject payloads above 6 MB, leave room for the request overhead
+MAX_PAYLOAD = 5 * 1024 * 1024
+RETRYABLE_ERRORS = ("ThrottlingException", "TooManyRequestsException", "ServiceUnavailable")
+
+
+def encode_rows(rows):
+    """Encodes rows of numbers as newline-terminated csv lines."""
+    return [",".join(map(str, row)) + "\n" for row in (r.tolist() if hasattr(r, "tolist") else r for r in rows)]
+
+
+def pack_payloads(lines, max_payload=MAX_PAYLOAD):
+    """Packs csv lines into payloads of at most max_payload bytes.
+
+    Args:
+        lines: the newline-terminated csv lines
+        max_payload: the maximum payload size in bytes
+
+    Returns:
+        a list of (index of the first row, payload bytes, number of rows)
+    """
+    payloads = []
+    start, batch, size = 0, [], 0
+    for i, line in enumerate(lines):
+        encoded = line.encode("utf-8")
+        if len(encoded) > max_payload:
+            raise ValueError(f"Row {i} is {len(encoded)} bytes, above the payload limit of {max_payload}")
+        if batch and size + len(encoded) > max_payload:
+            payloads.append((start, b"".join(batch), len(batch)))
+            start, batch, size = i, [], 0
+        batch.append(encoded)
+        size += len(encoded)
+    if batch:
+        payloads.append((start, b"".join(batch), len(batch)))
+    return payloads
+
+
+def parse_predictions(body):
+    """Parses a text/csv response of the built-in XGBoost container into floats.
+
+    Older versions of the container separate the predictions by commas, newer by lines.
+    """
+    text = body.decode("utf-8").strip()
+    return [float(value) for value in re.split(r"[,\n]", text) if value] if text else []
+
+
+def _is_retryable(error):
+    response = getattr(error, "response", {})
+    code = response.get("Error", {}).get("Code")
+    status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    return code in RETRYABLE_ERRORS or status in (429, 503)
+
+
+class PredictionClient:
+    """Scores rows against an endpoint with concurrent multi-row requests."""
+
+    def __init__(
+        self,
+        endpoint_name,
+        runtime_client=None,
+        region=None,
+        max_payload=MAX_PAYLOAD,
+        max_workers=8,
+        max_retries=5,
+        backoff=0.1,
+        sleep=time.sleep,
+        cache=None,
+        model_version=None,
+        sagemaker_client=None,
+        version_refresh=60.0,
+        clock=time.monotonic,
+    ):
+        """Creates the client.
+
+        Args:
+            endpoint_name: the name of the endpoint
+            runtime_client: a sagemaker-runtime client, created for region if not given
+            region: the aws region of the endpoint
+            max_payload: the maximum size of a request payload in bytes
+            max_workers: the maximum number of requests in flight
+            max_retries: the number of retries of a throttled request
+            backoff: the base of the exponential backoff between retries, in seconds
+            sleep: called with the seconds to wait before a retry
+            cache: a PredictionCache of the predictions, None to not cache
+            model_version: identifies the model behind the endpoint in the cache, e.g. the
+                model package arn, the endpoint config of the endpoint if None. Setting
+                another version empties the cache.
+            sagemaker_client: a sagemaker client describing the endpoint, created for region
+                if needed and not given
+            version_refresh: the seconds after which the endpoint config is described again
+            clock: returns the current time in seconds
+        """
+        if runtime_client is None:
+            import boto3
+
+            runtime_client = boto3.Session(region_name=region).client("sagemaker-runtime")
+        self.endpoint_name = endpoint_name
+        self.runtime_client = runtime_client
+        self.max_payload = max_payload
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.sleep = sleep
+        self.cache = cache
+        self.model_version = model_version
+        self.version_refresh = version_refresh
+        self.clock = clock
+        if cache is not None and model_version is None and sagemaker_client is None:
+            import boto3
+
+            sagemaker_client = boto3.Session(region_name=region).client("sagemaker")
+        self.sagemaker_client = sagemaker_client
+        if cache is not None and model_version is not None:
+            cache.set_model(model_version)
+        self._endpoint_config = None
+        self._described_at = None
+        self.stats = {"rows": 0, "requests": 0, "retries": 0}
+        self._lock = threading.Lock()
+        self._random = random.Random(0)
+
+    def _count(self, **counts):
+        with self._lock:
+            for key, value in counts.items():
+                self.stats[key] += value
+
+    def _use_cache(self):
+        """Sets the model version of the cache, returning whether its predictions hold."""
+        if self.model_version is not None:
+            return True
+        with self._lock:
+            now = self.clock()
+            if self._described_at is None or now - self._described_at >= self.version_refresh:
+                endpoint = self.sagemaker_client.describe_endpoint(EndpointName=self.endpoint_name)
+                # While updating, either config may answer a request
+                in_service = endpoint["EndpointStatus"] == "InService"
+                self._endpoint_config = endpoint["EndpointConfigName"] if in_service else None
+                self._described_at = now
+                if self._endpoint_config is not None:
+                    self.cache.set_model(self._endpoint_config)
+            return self._endpoint_config is not None
+
+    def _invoke(self, payload, rows):
+        for attempt in range(self.max_retries + 1):
+            try:
+                self._count(requests=1)
+                response = self.runtime_client.invoke_endpoint(
+                    EndpointName=self.endpoint_name, ContentType="text/csv", Accept="text/csv", Body=payload
+                )
+                break
+            except Exception as e:  # pylint: disable=W0703
+                if attempt == self.max_retries or not _is_retryable(e):
+                    raise
+                self._count(retries=1)
+                with self._lock:
+                    jitter = 0.5 + self._random.random()
+                self.sleep(self.backoff * 2 ** attempt * jitter)
+        predictions = parse_predictions(response["Body"].read())
+        if len(predictions) != rows:
+            raise ValueError(f"Expected {rows} predictions, the endpoint returned {len(predictions)}")
+        return predictions
+
+    def predict(self, rows):
+        """Scores the rows and returns their predictions in input order.
+
+        Args:
+            rows: the rows to score, e.g. a 2-d numpy array or a list of lists
+
+        Returns:
+            a list with one prediction per row
+        """
+        if self.cache is not None and self._use_cache():
+            # The cache keys rows on their float32 values, which the container parses them to
+            return self.cache.predict(rows, self._predict_float32).tolist()
+        return self._predict_lines(encode_rows(rows))
+
+    def _predict_float32(self, rows):
+        return self._predict_lines([",".join(map(str, row)) + "\n" for row in rows])
+
+    def _predict_lines(self, lines):
+        payloads = pack_payloads(lines, self.max_payload)
+        predictions = [None] * sum(count for _, _, count in payloads)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = [(start, pool.submit(self._invoke, payload, count)) for start, payload, count in payloads]
+            for start, future in futures:
+                batch = future.result()
+                predictions[start : start + len(batch)] = batch
+        self._count(rows=len(predictions))
+        return predictions
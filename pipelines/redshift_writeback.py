@@ -0,0 +1,235 @@
+# Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+r"""Writes predictions back to a RedShift table with a single staged COPY.
+
+The rows are split evenly into gzipped csv files, so that every slice of the cluster
+loads a file in parallel, and staged on S3 with a COPY manifest listing exactly those
+files. One COPY through the Redshift Data API then loads them, instead of inserting row
+by row. With key columns, the COPY goes to a temporary staging table that is merged
+into the target in the same transaction: target rows with the keys of staged rows are
+deleted and the staged rows inserted.
+
+    python -m pipelines.redshift_writeback --input predictions.csv --schema bankdm \
+        --table bankdm_scores --s3-prefix s3://bucket/bankdm/writeback/<run> \
+        --iam-role <arn> --database dev --secret-arn <arn> --cluster-identifier <id> \
+        --key-columns row_id
+"""
+from __future__ import absolute_import
+
+import argparse
+import gzip
+import io
+import json
+import logging
+import re
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+
+FINISHED = "FINISHED"
+FAILED_STATUSES = ("FAILED", "ABORTED")
+
+
+class StatementError(Exception):
+    """A Redshift Data API statement failed, was aborted or did not finish in time."""
+
+
+def _split_uri(s3_uri):
+    match = re.match(r"^s3://([^/]+)/(.*?)/?$", s3_uri)
+    if match is None:
+        raise ValueError(f"Not an S3 prefix: {s3_uri}")
+    return match.groups()
+
+
+def stage_files(s3, data, s3_prefix, files=4, compresslevel=6):
+    """Writes the rows as evenly split gzipped csv files and a COPY manifest.
+
+    Args:
+        s3: an S3 client, or a LocalS3
+        data: the DataFrame to stage, its columns in the order of the COPY column list
+        s3_prefix: the s3:// prefix to stage under, e.g. unique per run
+        files: the number of files, ideally a multiple of the slices of the cluster
+        compresslevel: the gzip compression level
+
+    Returns:
+        the s3:// uri of the manifest
+    """
+    bucket, prefix = _split_uri(s3_prefix)
+    files = max(1, min(files, len(data)))
+    bounds = [len(data) * i // files for i in range(files + 1)]
+    entries = []
+    for i in range(files):
+        buffer = io.StringIO()
+        data.iloc[bounds[i] : bounds[i + 1]].to_csv(buffer, index=False, header=False)
+        key = f"{prefix}/part_{i:04d}.csv.gz"
+        body = gzip.compress(buffer.getvalue().encode("utf-8"), compresslevel=compresslevel, mtime=0)
+        s3.put_object(Bucket=bucket, Key=key, Body=body)
+        entries.append({"url": f"s3://{bucket}/{key}", "mandatory": True, "meta": {"content_length": len(body)}})
+    s3.put_object(Bucket=bucket, Key=f"{prefix}/manifest", Body=json.dumps({"entries": entries}))
+    return f"s3://{bucket}/{prefix}/manifest"
+
+
+def build_copy_query(table, columns, manifest_uri, iam_role):
+    """Builds the COPY statement loading the staged files of a manifest into a table."""
+    return (
+        f"copy {table} ({', '.join(columns)}) from '{manifest_uri}' iam_role '{iam_role}' "
+        "format as csv gzip manifest"
+    )
+
+
+def build_merge_queries(schema, table, columns, key_columns, manifest_uri, iam_role):
+    """Builds the statements of a staged merge, run as one transaction.
+
+    Returns:
+        the list of statements: create the staging table, COPY into it, delete the
+        target rows having staged keys, insert the staged rows and drop the staging table
+    """
+    stage = f"{table}_stage"
+    condition = " and ".join(f"{table}.{k} = {stage}.{k}" for k in key_columns)
+    return [
+        f"create temp table {stage} (like {schema}.{table})",
+        build_copy_query(stage, columns, manifest_uri, iam_role),
+        f"delete from {schema}.{table} using {stage} where {condition}",
+        f"insert into {schema}.{table} ({', '.join(columns)}) select {', '.join(columns)} from {stage}",
+        f"drop table {stage}",
+    ]
+
+
+def wait_for_statement(client, statement_id, delay=1.0, max_delay=30.0, timeout=3600.0, sleep=time.sleep):
+    """Waits for a Data API statement, polling with exponential backoff.
+
+    Args:
+        client: the redshift-data client
+        statement_id: the Id returned by execute_statement or batch_execute_statement
+        delay: the seconds before the first poll, doubled after every poll
+        max_delay: the maximum seconds between polls
+        timeout: the seconds after which to stop waiting
+        sleep: called with the seconds to wait
+
+    Returns:
+        the describe_statement response of the finished statement
+
+    Raises:
+        StatementError: if the statement failed, was aborted or did not finish in time
+    """
+    waited = 0.0
+    while True:
+        response = client.describe_statement(Id=statement_id)
+        status = response["Status"]
+        if status == FINISHED:
+            return response
+        if status in FAILED_STATUSES:
+            raise StatementError(f"Statement {statement_id} {status.lower()}: {response.get('Error', '')}")
+        if waited >= timeout:
+            raise StatementError(f"Statement {statement_id} still {status} after {waited:.0f}s")
+        sleep(delay)
+        waited += delay
+        delay = min(delay * 2, max_delay)
+
+
+def write_back(
+    client,
+    s3,
+    data,
+    schema,
+    table,
+    s3_prefix,
+    iam_role,
+    key_columns=None,
+    files=4,
+    sleep=time.sleep,
+    **statement_kwargs,
+):
+    """Stages the rows on S3 and loads them into schema.table with one COPY.
+
+    Args:
+        client: the redshift-data client
+        s3: an S3 client, or a LocalS3
+        data: the DataFrame of rows, its columns named as the table columns
+        schema: the schema of the table
+        table: the table to write to, created beforehand
+        s3_prefix: the s3:// prefix to stage the files under
+        iam_role: the role RedShift reads the staged files with
+        key_columns: the columns identifying a row to upsert on, None to append
+        files: the number of staged files, see stage_files
+        sleep: called with the seconds to wait between polls of the statement
+        statement_kwargs: Database, SecretArn, ClusterIdentifier or WorkgroupName of the
+            Data API calls
+
+    Returns:
+        a dict with the rows, the staged files, the Id of the statement and the seconds taken
+    """
+    start = time.perf_counter()
+    columns = list(data.columns)
+    manifest_uri = stage_files(s3, data, s3_prefix, files)
+    if key_columns:
+        sqls = build_merge_queries(schema, table, columns, key_columns, manifest_uri, iam_role)
+        statement_id = client.batch_execute_statement(Sqls=sqls, **statement_kwargs)["Id"]
+    else:
+        sql = build_copy_query(f"{schema}.{table}", columns, manifest_uri, iam_role)
+        statement_id = client.execute_statement(Sql=sql, **statement_kwargs)["Id"]
+    wait_for_statement(client, statement_id, sleep=sleep)
+    stats = {
+        "rows": len(data),
+        "files": max(1, min(files, len(data))),
+        "statement_id": statement_id,
+        "seconds": time.perf_counter() - start,
+    }
+    logger.info("Wrote %d rows to %s.%s in %.2fs", stats["rows"], schema, table, stats["seconds"])
+    return stats
+
+
+def main():  # pragma: no cover
+    """The main harness that writes a csv file of predictions back to RedShift."""
+    parser = argparse.ArgumentParser("Writes predictions back to a RedShift table with a staged COPY.")
+    parser.add_argument("--input", type=str, required=True, help="A csv file with a header of table columns.")
+    parser.add_argument("--schema", type=str, required=True)
+    parser.add_argument("--table", type=str, required=True)
+    parser.add_argument("--s3-prefix", type=str, required=True, help="The s3:// prefix to stage the files under.")
+    parser.add_argument("--iam-role", type=str, required=True, help="The role RedShift reads S3 with.")
+    parser.add_argument("--database", type=str, required=True)
+    parser.add_argument("--secret-arn", type=str, required=True)
+    parser.add_argument("--cluster-identifier", type=str, required=True)
+    parser.add_argument("--key-columns", type=str, default=None, help="Comma separated columns to upsert on.")
+    parser.add_argument("--files", type=int, default=4, help="The number of staged files.")
+    parser.add_argument("--region", type=str, default=None)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    try:
+        import boto3
+        import pandas as pd
+
+        session = boto3.Session(region_name=args.region)
+        write_back(
+            session.client("redshift-data"),
+            session.client("s3"),
+            pd.read_csv(args.input),
+            args.schema,
+            args.table,
+            args.s3_prefix,
+            args.iam_role,
+            key_columns=args.key_columns.split(",") if args.key_columns else None,
+            files=args.files,
+            Database=args.database,
+            SecretArn=args.secret_arn,
+            ClusterIdentifier=args.cluster_identifier,
+        )
+    except Exception as e:  # pylint: disable=W0703
+        print(f"Exception: {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+# Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+"""A CLI to run pipelines offline with local stand-ins for the AWS services."""
+from __future__ import absolute_import
+
+import argparse
+import json
+import logging
+import sys
+
+from pipelines._utils import get_local_pipeline_driver
+
+
+def main():  # pragma: no cover
+    """The main harness that runs the pipeline locally.
+
+    Prints the evaluation report and the per-stage timing breakdown.
+    """
+    parser = argparse.ArgumentParser("Runs the pipeline for the pipeline script locally.")
+
+    parser.add_argument(
+        "-n",
+        "--module-name",
+        dest="module_name",
+        type=str,
+        help="The module name of the pipeline to import.",
+    )
+    parser.add_argument(
+        "-w",
+        "--work-dir",
+        dest="work_dir",
+        type=str,
+        default="local-run",
+        help="The directory standing in for S3 and the job volumes.",
+    )
+    parser.add_argument(
+        "-kwargs",
+        "--kwargs",
+        dest="kwargs",
+        default=None,
+        help="Dict string of keyword arguments for the local run (if supported)",
+    )
+    args = parser.parse_args()
+
+    if args.module_name is None:
+        parser.print_help()
+        sys.exit(2)
+    logging.basicConfig(level=logging.INFO)
+
+    try:
+        result = get_local_pipeline_driver(args.module_name, args.work_dir, args.kwargs)
+        print("\n###### Evaluation report:")
+        print(json.dumps(result["evaluation"], indent=2))
+        print(f"\n###### Registered model package: {result['registered']}")
+        if result.get("transform"):
+            transform = result["transform"]
+            print(
+                f"\n###### Batch transform: {transform['rows']} rows in {transform['batches']} mini-batches, "
+                f"{transform['rows_per_second']:.0f} rows/s"
+            )
+        print("\n###### Stage timings:")
+        print(result["report"])
+    except Exception as e:  # pylint: disable=W0703
+        print(f"Exception: {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
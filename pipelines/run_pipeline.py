@@ -17,7 +17,19 @@ import argparse
 import json
 import sys
 
-from pipelines._utils import get_pipeline_driver, convert_struct, get_pipeline_custom_tags
+from pipelines._utils import (
+    get_pipeline_driver,
+    convert_struct,
+    get_pipeline_custom_tags,
+    format_step_summary,
+    format_variant_summary,
+    expand_kwargs,
+    failed_steps,
+    get_pipeline_drivers,
+    monitor_execution,
+    run_variants,
+    upsert_if_changed,
+)
 
 
 def main():  # pragma: no cover
@@ -41,7 +53,9 @@ def main():  # pragma: no cover
         "--kwargs",
         dest="kwargs",
         default=None,
-        help="Dict string of keyword arguments for the pipeline generation (if supported)",
+        help="Dict string of keyword arguments for the pipeline generation (if supported), or a list "
+        "of such dicts, one per pipeline variant. A \"grid\" key holding a dict of argument name to "
+        "list of values expands into one variant per combination.",
     )
     parser.add_argument(
         "-role-arn",
@@ -65,6 +79,26 @@ def main():  # pragma: no cover
         default=None,
         help="""List of dict strings of '[{"Key": "string", "Value": "string"}, ..]'""",
     )
+    parser.add_argument(
+        "--poll-interval",
+        dest="poll_interval",
+        type=float,
+        default=30,
+        help="Seconds between polls of the execution status.",
+    )
+    parser.add_argument(
+        "--print-definition",
+        dest="print_definition",
+        action="store_true",
+        help="Print the pipeline definition before creating/updating the pipeline.",
+    )
+    parser.add_argument(
+        "--max-concurrency",
+        dest="max_concurrency",
+        type=int,
+        default=4,
+        help="The number of pipeline variants started and monitored at a time.",
+    )
     args = parser.parse_args()
 
     if args.module_name is None or args.role_arn is None:
@@ -73,32 +107,80 @@ def main():  # pragma: no cover
     tags = convert_struct(args.tags)
 
     try:
-        pipeline = get_pipeline_driver(args.module_name, args.kwargs)
-        print("###### Creating/updating a SageMaker Pipeline with the following definition:")
-        parsed = json.loads(pipeline.definition())
-        print(json.dumps(parsed, indent=2, sort_keys=True))
+        variants = expand_kwargs(args.kwargs)
+    except Exception as e:  # pylint: disable=W0703
+        print(f"Exception: {e}")
+        sys.exit(1)
+    if len(variants) > 1:
+        run_pipeline_variants(args, variants, tags)
+        return
+
+    # A single variant, given as a dict, a one-element list or a grid of single values
+    kwargs = variants[0]
+    try:
+        pipeline = get_pipeline_driver(args.module_name, kwargs)
+        if args.print_definition:
+            print("###### Creating/updating a SageMaker Pipeline with the following definition:")
+            parsed = json.loads(pipeline.definition())
+            print(json.dumps(parsed, indent=2, sort_keys=True))
 
-        all_tags = get_pipeline_custom_tags(args.module_name, args.kwargs, tags)
+        all_tags = get_pipeline_custom_tags(args.module_name, kwargs, tags)
 
-        upsert_response = pipeline.upsert(
-            role_arn=args.role_arn, description=args.description, tags=all_tags
+        upsert_response, digest = upsert_if_changed(
+            pipeline, role_arn=args.role_arn, description=args.description, tags=all_tags
         )
-        print("\n###### Created/Updated SageMaker Pipeline: Response received:")
-        print(upsert_response)
+        if upsert_response is None:
+            print(f"###### Pipeline definition unchanged (sha256 {digest[:12]}), skipping upsert")
+        else:
+            print(f"###### Created/Updated SageMaker Pipeline (sha256 {digest[:12]}): Response received:")
+            print(upsert_response)
 
         execution = pipeline.start()
         print(f"\n###### Execution started with PipelineExecutionArn: {execution.arn}")
 
-        print("Waiting for the execution to finish...")
-        execution.wait()
-        print("\n#####Execution completed. Execution step details:")
+        status, steps = monitor_execution(
+            pipeline.sagemaker_session.sagemaker_client, execution.arn, poll_interval=args.poll_interval
+        )
+        print(f"\n###### Execution {status}. Step status and cache results:")
+        print(format_step_summary(steps))
+    except Exception as e:  # pylint: disable=W0703
+        print(f"Exception: {e}")
+        sys.exit(1)
+
+    if status != "Succeeded":
+        for step in failed_steps(steps):
+            print(f"Step {step['StepName']} {step['StepStatus']}: {step.get('FailureReason', '')}")
+        sys.exit(1)
 
-        print(execution.list_steps())
-        # Todo print the status?
+
+def run_pipeline_variants(args, variants, tags):  # pragma: no cover
+    """Builds, upserts, starts and monitors the pipeline variants concurrently."""
+    try:
+        print(f"###### Building {len(variants)} pipeline variants")
+        pipelines = get_pipeline_drivers(args.module_name, variants)
+        # A copy per variant, as the project tags are appended to the list passed
+        all_tags = [get_pipeline_custom_tags(args.module_name, kwargs, list(tags)) for kwargs in variants]
+        results = run_variants(
+            pipelines,
+            role_arn=args.role_arn,
+            description=args.description,
+            tags=all_tags,
+            max_concurrency=args.max_concurrency,
+            poll_interval=args.poll_interval,
+        )
     except Exception as e:  # pylint: disable=W0703
         print(f"Exception: {e}")
         sys.exit(1)
 
+    for result in results:
+        if result["steps"]:
+            print(f"\n###### {result['name']}: step status and cache results:")
+            print(format_step_summary(result["steps"]))
+    print("\n###### Pipeline variants:")
+    print(format_variant_summary(results))
+    if any(result["status"] != "Succeeded" for result in results):
+        sys.exit(1)
+
 
 if __name__ == "__main__":
     main()
@@ -13,7 +13,17 @@ with open("README.md", "r") as f:
 
 
 required_packages = ["sagemaker"]
+# The local pipeline runner, scoring, serving and benchmarks run the processing scripts
+# and train in process
+local_packages = [
+    "numpy",
+    "pandas",
+    "scikit-learn",
+    "scipy",
+    "xgboost>=1.1",
+]
 extras = {
+    "local": local_packages,
     "test": [
         "black",
         "coverage",
@@ -25,6 +35,7 @@ extras = {
         "sagemaker",
         "tox",
     ]
+    + local_packages,
 }
 setuptools.setup(
     name=about["__title__"],
@@ -45,6 +56,7 @@ setuptools.setup(
         "console_scripts": [
             "get-pipeline-definition=pipelines.get_pipeline_definition:main",
             "run-pipeline=pipelines.run_pipeline:main",
+            "run-local-pipeline=pipelines.run_local_pipeline:main",
         ]
     },
     classifiers=[
@@ -0,0 +1,53 @@
+"""Benchmarks distributed training of the local training stand-in on synthetic data.
+
+    pytest tests/benchmarks --run-benchmarks -s
+
+BENCHMARK_ROWS and BENCHMARK_INSTANCES size the run. Every worker, and the single
+instance baseline, trains with nthread=1, simulating training hosts of one core each:
+the speedup is that of adding hosts, not of distributed over multi-threaded training on
+one host with the same cores. It is only asserted when the machine has a core per
+instance.
+"""
+import os
+import time
+
+import pytest
+
+from pipelines.bankdm import preprocess, synthetic, train
+from pipelines.bankdm.pipeline import HYPERPARAMETERS
+from pipelines.local_services import redshift_column_name
+
+ROWS = int(os.environ.get("BENCHMARK_ROWS", "400000"))
+INSTANCES = int(os.environ.get("BENCHMARK_INSTANCES", "4"))
+
+pytestmark = pytest.mark.benchmark
+
+
+@pytest.fixture(scope="module")
+def train_dir(tmp_path_factory):
+    data = synthetic.generate(ROWS).rename(columns=redshift_column_name)
+    data = preprocess.engineer_features(data)
+    train_data, _, _ = preprocess.split_data(data)
+    directory = tmp_path_factory.mktemp("train")
+    preprocess.write_shards(train_data, str(directory), "train", INSTANCES)
+    return str(directory)
+
+
+def _timed_train(train_dir, model_dir, instance_count):
+    # One core per simulated host, see the module docstring
+    hyperparameters = dict(HYPERPARAMETERS, tree_method="hist", nthread=1)
+    start = time.perf_counter()
+    train.train(train_dir, None, model_dir, hyperparameters, instance_count=instance_count)
+    return time.perf_counter() - start
+
+
+def test_distributed_training_speedup(train_dir, tmp_path):
+    single = _timed_train(train_dir, str(tmp_path / "single"), 1)
+    distributed = _timed_train(train_dir, str(tmp_path / "distributed"), INSTANCES)
+    speedup = single / distributed
+    print(f"\n{ROWS} rows on one-core hosts: 1 instance {single:.2f}s, {INSTANCES} instances {distributed:.2f}s, "
+          f"speedup {speedup:.2f}x")
+
+    assert os.path.exists(os.path.join(str(tmp_path / "distributed"), "model.tar.gz"))
+    if (os.cpu_count() or 1) >= INSTANCES:
+        assert speedup > 1.0
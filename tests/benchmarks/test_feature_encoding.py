@@ -0,0 +1,62 @@
+"""Benchmarks encoding single records for online scoring.
+
+    pytest tests/benchmarks/test_feature_encoding.py --run-benchmarks -s
+
+Compares RecordEncoder with the pandas path of the notebooks, np.where, np.isin and
+pd.get_dummies on a one row DataFrame, and with FeatureSchema.transform of one row.
+"""
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from pipelines.bankdm import preprocess, synthetic
+from pipelines.bankdm.features import FeatureSchema, RecordEncoder
+from pipelines.local_services import redshift_column_name
+
+RECORDS = 2000
+
+pytestmark = pytest.mark.benchmark
+
+
+@pytest.fixture(scope="module")
+def schema_and_records():
+    data = synthetic.generate(20000).rename(columns=redshift_column_name)
+    model_data = preprocess.engineer_features(data)
+    schema = FeatureSchema.from_dict(preprocess.feature_schema(data, model_data))
+    records = data.drop(columns=preprocess.DERIVED_COLUMNS).head(RECORDS).to_dict("records")
+    return schema, records
+
+
+def pandas_encode(record, columns):
+    data = pd.DataFrame([record])
+    data["no_previous_contact"] = np.where(data["pdays"] == 999, 1, 0)
+    data["not_working"] = np.where(np.isin(data["job"], ["student", "retired", "unemployed"]), 1, 0)
+    encoded = pd.get_dummies(data, dtype=np.uint8).drop(preprocess.DROP_COLUMNS, axis=1, errors="ignore")
+    return encoded.reindex(columns=columns, fill_value=0).to_numpy(dtype=np.float32)[0]
+
+
+def _per_record(encode, records):
+    start = time.perf_counter()
+    for record in records:
+        encode(record)
+    return (time.perf_counter() - start) / len(records) * 1e6
+
+
+def test_record_encoder_is_faster_than_pandas(schema_and_records):
+    schema, records = schema_and_records
+    encoder = RecordEncoder(schema)
+    for record in records[:50]:
+        np.testing.assert_array_equal(encoder.encode(record), pandas_encode(record, schema.columns))
+
+    timings = {
+        "pandas get_dummies": _per_record(lambda r: pandas_encode(r, schema.columns), records),
+        "FeatureSchema.transform": _per_record(lambda r: schema.transform(pd.DataFrame([r])), records),
+        "RecordEncoder.encode": _per_record(encoder.encode, records),
+    }
+    print()
+    for name, micros in timings.items():
+        print(f"{name:>24}: {micros:9.1f} us/record")
+
+    assert timings["RecordEncoder.encode"] * 10 < timings["pandas get_dummies"]
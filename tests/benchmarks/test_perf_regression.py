@@ -0,0 +1,134 @@
+"""Benchmarks the hot paths of preprocess.py and evaluate.py against stored baselines.
+
+    pytest tests/benchmarks/test_perf_regression.py --run-benchmarks -s
+    tox -e benchmark
+
+Every benchmark takes the best of a few runs on BENCHMARK_ROWS synthetic rows and fails
+if it is slower than its baseline in tests/benchmarks/baselines.json by more than
+--tolerance (BENCHMARK_TOLERANCE, 50% by default). Timings are stored relative to a
+fixed calibration workload, see conftest.calibrate. After an intended change, rewrite
+the baselines with --update-baselines.
+"""
+import gzip
+import os
+
+import numpy as np
+import pytest
+import xgboost
+
+from pipelines.bankdm import evaluate, preprocess, synthetic
+from pipelines.bankdm.pipeline import HYPERPARAMETERS
+from pipelines.bankdm.train import save_model
+from pipelines.local_services import redshift_column_name
+
+ROWS = int(os.environ.get("BENCHMARK_ROWS", "100000"))
+SHARDS = 4
+
+pytestmark = pytest.mark.benchmark
+
+
+@pytest.fixture(scope="module")
+def raw_data():
+    return synthetic.generate(ROWS).rename(columns=redshift_column_name)
+
+
+@pytest.fixture(scope="module")
+def model_data(raw_data):
+    return preprocess.engineer_features(raw_data.copy())
+
+
+@pytest.fixture(scope="module")
+def splits(model_data):
+    return preprocess.split_data(model_data)
+
+
+@pytest.fixture(scope="module")
+def unload_dir(raw_data, tmp_path_factory):
+    directory = tmp_path_factory.mktemp("unload")
+    bounds = np.linspace(0, len(raw_data), SHARDS + 1).astype(int)
+    for i, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+        with gzip.open(str(directory / f"000{i}_part_00.gz"), "wt") as f:
+            raw_data.iloc[start:end].to_csv(f, index=False)
+    return str(directory)
+
+
+@pytest.fixture(scope="module")
+def test_path(splits, tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("test") / "test.csv")
+    preprocess.write_split(splits[2], path)
+    return path
+
+
+@pytest.fixture(scope="module")
+def model_path(splits, tmp_path_factory):
+    train_data = splits[0]
+    features = train_data.drop(["y_no", "y_yes"], axis=1).to_numpy(dtype=np.float32)
+    params = {k: v for k, v in HYPERPARAMETERS.items() if k not in ("num_round", "silent")}
+    booster = xgboost.train(
+        dict(params, tree_method="hist"),
+        xgboost.DMatrix(features, label=train_data["y_yes"].to_numpy()),
+        int(HYPERPARAMETERS["num_round"]),
+    )
+    return save_model(booster, str(tmp_path_factory.mktemp("model")))
+
+
+def test_shard_ingest(baselines, unload_dir):
+    raw_path = os.path.join(unload_dir, "raw.csv")
+    baselines.check("shard_ingest", lambda: preprocess.combine_unload_files(unload_dir, raw_path), repeat=3)
+    assert os.path.getsize(raw_path) > 0
+
+
+def test_feature_encoding(baselines, raw_data):
+    baselines.check("feature_encoding", preprocess.engineer_features, setup=lambda: (raw_data.copy(),))
+
+
+def test_split(baselines, model_data):
+    baselines.check("split", lambda: preprocess.split_data(model_data))
+
+
+def test_csv_write(baselines, splits, tmp_path):
+    path = str(tmp_path / "train.csv")
+    baselines.check("csv_write", lambda: preprocess.write_split(splits[0], path), repeat=3)
+
+
+def test_gzip_split_write(baselines, splits, tmp_path):
+    path = str(tmp_path / "train.csv.gz")
+    writer = preprocess.SplitWriter(level=1)
+    baselines.check("gzip_split_write", lambda: writer.write(splits[0], path), repeat=3)
+    writer.close()
+
+
+def test_score_rows_write(baselines, model_data, tmp_path):
+    path = str(tmp_path / "score.csv")
+    baselines.check("score_rows_write", lambda: preprocess.write_score_rows(model_data, path), repeat=3)
+
+
+def test_test_data_read(baselines, test_path):
+    baselines.check("test_data_read", lambda: evaluate.read_test_data(test_path))
+
+
+def test_test_arrays_predict(baselines, splits, model_path, tmp_path):
+    # Against test_data_read and batch_predict, the memory-mapped arrays predicted in place
+    preprocess.write_test_arrays(splits[2], str(tmp_path))
+    model = evaluate.load_model(model_path, str(tmp_path))
+    paths = evaluate.find_test_arrays(str(tmp_path))
+    baselines.check("test_arrays_predict", lambda: evaluate.predict(model, evaluate.read_test_arrays(*paths)[1]))
+
+
+def test_model_load(baselines, model_path, tmp_path):
+    baselines.check("model_load", lambda: evaluate.load_model(model_path, str(tmp_path)))
+
+
+def test_batch_predict(baselines, model_path, test_path, tmp_path):
+    model = evaluate.load_model(model_path, str(tmp_path))
+    _, features = evaluate.read_test_data(test_path)
+    values = features.get_data().toarray()
+    # A new DMatrix every run, as predictions are cached on the DMatrix
+    baselines.check("batch_predict", model.predict, setup=lambda: (xgboost.DMatrix(values),))
+
+
+def test_metrics(baselines, model_path, test_path, tmp_path):
+    model = evaluate.load_model(model_path, str(tmp_path))
+    labels, features = evaluate.read_test_data(test_path)
+    predictions = model.predict(features)
+    baselines.check("metrics", lambda: evaluate.build_report(labels, predictions))
@@ -0,0 +1,87 @@
+"""Load-generation benchmark of the local inference server.
+
+    pytest tests/benchmarks/test_serving_load.py --run-benchmarks -s
+
+BENCHMARK_CLIENTS keep-alive clients each send BENCHMARK_REQUESTS single-row requests
+back to back, once without batching (one request per prediction) and once per max
+wait window, and the throughput, latency percentiles and batch sizes of each run are
+printed. Requests queued while a batch is predicted join the next one even with no wait.
+"""
+import asyncio
+import json
+import os
+import time
+
+import numpy as np
+import pytest
+import xgboost
+
+from pipelines.bankdm.serve import Client, InferenceServer
+
+CLIENTS = int(os.environ.get("BENCHMARK_CLIENTS", "64"))
+REQUESTS = int(os.environ.get("BENCHMARK_REQUESTS", "50"))
+# name: (max_wait_ms, max_batch_size)
+CONFIGURATIONS = {
+    "unbatched": (0.0, 1),
+    "max wait 0ms": (0.0, 1000),
+    "max wait 2ms": (2.0, 1000),
+    "max wait 10ms": (10.0, 1000),
+}
+
+pytestmark = pytest.mark.benchmark
+
+
+@pytest.fixture(scope="module")
+def booster():
+    rng = np.random.default_rng(0)
+    features = rng.random((20000, 60), dtype=np.float32)
+    labels = (features[:, 0] + rng.normal(0, 0.1, len(features)) > 0.5).astype(np.float32)
+    params = {"objective": "binary:logistic", "max_depth": 5, "nthread": 1}
+    return xgboost.train(params, xgboost.DMatrix(features, label=labels), 100)
+
+
+async def generate_load(server, payload):
+    async def client_loop():
+        client = await Client.connect(server.host, server.port)
+        for _ in range(REQUESTS):
+            status, _ = await client.request("POST", "/invocations", payload)
+            assert status == 200
+        await client.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client_loop() for _ in range(CLIENTS)))
+    seconds = time.perf_counter() - start
+    client = await Client.connect(server.host, server.port)
+    metrics = json.loads((await client.request("GET", "/metrics"))[1])
+    await client.close()
+    return dict(metrics, requests_per_second=CLIENTS * REQUESTS / seconds)
+
+
+def _run(booster, max_wait_ms, max_batch_size, payload):
+    async def main():
+        server = InferenceServer(booster, port=0, max_wait_ms=max_wait_ms, max_batch_size=max_batch_size)
+        await server.start()
+        try:
+            return await generate_load(server, payload)
+        finally:
+            await server.stop()
+
+    return asyncio.run(main())
+
+
+def test_dynamic_batching_under_load(booster):
+    row = np.random.default_rng(1).random(60, dtype=np.float32)
+    payload = (",".join(map(str, row.tolist())) + "\n").encode("utf-8")
+
+    results = {name: _run(booster, *configuration, payload) for name, configuration in CONFIGURATIONS.items()}
+    print(f"\n{CLIENTS} clients x {REQUESTS} requests")
+    for name, r in results.items():
+        print(
+            f"{name:>14}: {r['requests_per_second']:8.0f} req/s, "
+            f"p50 {r['latency_p50_ms']:6.2f} ms, p99 {r['latency_p99_ms']:6.2f} ms, "
+            f"{r['batch_size_mean']:5.1f} requests per batch"
+        )
+
+    for r in results.values():
+        assert r["requests"] == CLIENTS * REQUESTS
+    assert results["max wait 2ms"]["requests_per_second"] > results["unbatched"]["requests_per_second"]
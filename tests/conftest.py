@@ -0,0 +1,144 @@
+import json
+import os
+import time
+
+import numpy as np
+import pytest
+
+ACCOUNT_ID = "123456789012"
+IMAGE_URI = "683313688378.dkr.ecr.us-east-1.amazonaws.com/sagemaker-xgboost:1.0-1-cpu-py3"
+
+
+BASELINES_PATH = os.path.join(os.path.dirname(__file__), "benchmarks", "baselines.json")
+
+
+def pytest_addoption(parser):
+    parser.addoption("--run-benchmarks", action="store_true", help="run the benchmarks under tests/benchmarks")
+    parser.addoption("--baselines", default=BASELINES_PATH, help="the JSON file of benchmark baselines")
+    parser.addoption(
+        "--tolerance",
+        type=float,
+        default=float(os.environ.get("BENCHMARK_TOLERANCE", "0.5")),
+        help="the fraction by which a benchmark may be slower than its baseline",
+    )
+    parser.addoption("--update-baselines", action="store_true", help="write the measured timings as the baselines")
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--run-benchmarks"):
+        return
+    skip = pytest.mark.skip(reason="benchmark, run with --run-benchmarks")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
+
+
+@pytest.fixture
+def build_definition(monkeypatch):
+    """Builds the BankDM pipeline definition offline, without calling AWS."""
+    monkeypatch.setenv("AWS_EC2_METADATA_DISABLED", "true")
+    pipeline_module = pytest.importorskip("pipelines.bankdm.pipeline")
+
+    def _build(**kwargs):
+        kwargs.setdefault("offline", True)
+        kwargs.setdefault("account_id", ACCOUNT_ID)
+        kwargs.setdefault("image_uri", IMAGE_URI)
+        kwargs.setdefault("role", f"arn:aws:iam::{ACCOUNT_ID}:role/pipeline")
+        kwargs.setdefault("default_bucket", "bucket")
+        pipeline = pipeline_module.get_pipeline(region="us-east-1", **kwargs)
+        return json.loads(pipeline.definition())
+
+    return _build
+
+
+def steps_by_name(definition):
+    """Flattens the steps of a definition, including those nested in condition steps."""
+    steps = {}
+    pending = list(definition["Steps"])
+    while pending:
+        step = pending.pop()
+        steps[step["Name"]] = step
+        for branch in ("IfSteps", "ElseSteps"):
+            pending.extend(step.get("Arguments", {}).get(branch, []))
+    return steps
+
+
+def calibrate(repeat=5):
+    """Times a fixed numpy and interpreter workload, the unit timings are stored in.
+
+    Baselines are relative to it, so that they carry over to machines of other speeds.
+    """
+    data = np.random.default_rng(0).random(1000000)
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        np.sort(data)
+        sum(i * i for i in range(200000))
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+class Baselines:
+    """Compares benchmark timings with the baselines stored in a JSON file.
+
+    A timing fails if it exceeds its baseline by more than the tolerance and by more than
+    NOISE_SECONDS, so that sub-millisecond benchmarks do not fail on timer noise.
+    """
+
+    NOISE_SECONDS = 0.002
+
+    def __init__(self, path, tolerance, update=False):
+        self.path = path
+        self.tolerance = tolerance
+        self.update = update
+        self.unit = calibrate()
+        self.results = {}
+        self.stored = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.stored = json.load(f)["benchmarks"]
+
+    def check(self, name, func, setup=None, repeat=5):
+        """Times func, the best of repeat runs after setup, against the baseline of name.
+
+        Returns:
+            the best time in seconds
+        """
+        timings = []
+        for _ in range(repeat):
+            args = setup() if setup else ()
+            start = time.perf_counter()
+            func(*args)
+            timings.append(time.perf_counter() - start)
+        seconds = min(timings)
+        relative = seconds / self.unit
+        self.results[name] = {"seconds": round(seconds, 6), "relative": round(relative, 4)}
+        baseline = self.stored.get(name)
+        print(f"\n{name:>24}: {seconds * 1000:9.2f} ms, {relative:8.2f} units", end="")
+        if baseline is None or self.update:
+            return seconds
+        print(f" (baseline {baseline['relative']:.2f})", end="")
+        limit = max(baseline["relative"] * (1 + self.tolerance), baseline["relative"] + self.NOISE_SECONDS / self.unit)
+        assert relative <= limit, (
+            f"{name} took {relative:.2f} units, more than its baseline of {baseline['relative']:.2f} "
+            f"by over {self.tolerance:.0%}"
+        )
+        return seconds
+
+    def save(self):
+        benchmarks = dict(sorted(dict(self.stored, **self.results).items()))
+        with open(self.path, "w") as f:
+            json.dump({"unit_seconds": round(self.unit, 6), "benchmarks": benchmarks}, f, indent=2)
+            f.write("\n")
+
+
+@pytest.fixture(scope="session")
+def baselines(request):
+    """The Baselines of the session, written back at its end with --update-baselines."""
+    config = request.config
+    result = Baselines(
+        config.getoption("--baselines"), config.getoption("--tolerance"), config.getoption("--update-baselines")
+    )
+    yield result
+    if result.update:
+        result.save()
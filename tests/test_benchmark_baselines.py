@@ -0,0 +1,23 @@
+import json
+import time
+
+import pytest
+
+from conftest import Baselines
+
+
+def test_benchmarks_fail_when_slower_than_their_baseline(tmp_path):
+    path = str(tmp_path / "baselines.json")
+    recorder = Baselines(path, tolerance=0.5, update=True)
+    recorder.check("sleep", lambda: time.sleep(0.01), repeat=1)
+    recorder.save()
+
+    checker = Baselines(path, tolerance=0.5)
+    assert checker.stored["sleep"]["seconds"] >= 0.01
+    checker.check("sleep", lambda: time.sleep(0.01), repeat=1)
+    checker.check("new", lambda: None)
+    with pytest.raises(AssertionError, match="more than its baseline"):
+        checker.check("sleep", lambda: time.sleep(0.05), repeat=1)
+
+    with open(path) as f:
+        assert list(json.load(f)["benchmarks"]) == ["sleep"]
@@ -0,0 +1,77 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from pipelines.bankdm import drift, profiling
+
+FEATURES = {"numeric": ["age", "ratio"], "categorical": ["job"], "derived": ["ratio"]}
+
+
+def _profile(tmp_path, name, data):
+    path = str(tmp_path / f"{name}.csv")
+    data.to_csv(path, index=False)
+    return profiling.profile_files([path], processes=1)
+
+
+def _data(seed, age_mean=40.0, jobs=(0.4, 0.3, 0.2, 0.1), rows=20000):
+    rng = np.random.default_rng(seed)
+    age = rng.normal(age_mean, 10, rows).round()
+    return pd.DataFrame(
+        {
+            "age": age,
+            "ratio": age / 100,
+            "job": rng.choice(["admin.", "technician", "student", "retired"], rows, p=list(jobs)),
+            "y": rng.binomial(1, 0.1, rows),
+        }
+    )
+
+
+@pytest.fixture
+def reference(tmp_path):
+    return _profile(tmp_path, "reference", _data(0))
+
+
+def test_samples_of_the_same_distribution_do_not_drift(tmp_path, reference):
+    current = _profile(tmp_path, "current", _data(1))
+    report = drift.detect_drift(reference, current, drift.monitored_columns(FEATURES))
+
+    assert report["drift"]["detected"] is False
+    assert set(report["columns"]) == {"age", "job", "y"}
+    assert report["columns"]["age"]["psi"] < 0.01
+    assert report["columns"]["age"]["ks"] < 0.02
+    assert report["columns"]["job"]["cramers_v"] < 0.02
+
+
+def test_a_shifted_numeric_column_drifts(tmp_path, reference):
+    current = _profile(tmp_path, "current", _data(1, age_mean=46.0))
+    report = drift.detect_drift(reference, current, drift.monitored_columns(FEATURES))
+
+    assert report["drift"]["columns"] == ["age"]
+    assert report["columns"]["age"]["psi"] > drift.THRESHOLDS["psi"]
+    assert report["columns"]["age"]["ks"] == pytest.approx(0.23, abs=0.03)
+
+
+def test_shifted_level_frequencies_drift(tmp_path, reference):
+    current = _profile(tmp_path, "current", _data(1, jobs=(0.1, 0.2, 0.3, 0.4)))
+    report = drift.detect_drift(reference, current, drift.monitored_columns(FEATURES))
+
+    assert report["drift"]["columns"] == ["job"]
+    assert report["columns"]["job"]["cramers_v"] > drift.THRESHOLDS["cramers_v"]
+    assert report["columns"]["job"]["p_value"] < 1e-6
+
+
+def test_main_retrains_without_a_reference(tmp_path, reference):
+    for channel, document in (("profile", reference), ("features", FEATURES)):
+        (tmp_path / channel).mkdir()
+        (tmp_path / channel / f"{channel}.json").write_text(json.dumps(document))
+
+    report = drift.main(str(tmp_path))
+    assert report["drift"] == {"detected": True, "columns": [], "reason": "no reference profile"}
+
+    (tmp_path / "reference").mkdir()
+    (tmp_path / "reference" / "profile.json").write_text(json.dumps(reference))
+    drift.main(str(tmp_path))
+    with open(tmp_path / "drift" / "drift.json") as f:
+        assert json.load(f)["drift"]["detected"] is False
@@ -0,0 +1,86 @@
+import datetime
+import os
+
+import pytest
+
+from pipelines.local_services import LocalS3
+from pipelines.bankdm.local_pipeline import _load_lambda_module
+
+BUCKET = "bucket"
+NOW = datetime.datetime(2021, 6, 1, tzinfo=datetime.timezone.utc)
+
+
+@pytest.fixture
+def store():
+    return _load_lambda_module()
+
+
+def _publish(s3, uri, channels=("train", "snapshot")):
+    prefix = uri[len(f"s3://{BUCKET}/"):]
+    for channel in channels:
+        s3.put_object(Bucket=BUCKET, Key=f"{prefix}/{channel}/{channel}.json", Body="{}")
+
+
+def test_a_published_snapshot_is_found_by_its_fingerprint(tmp_path, store):
+    s3 = LocalS3(str(tmp_path))
+    fingerprint = store.snapshot_fingerprint("manifest", "code", 1)
+    assert fingerprint != store.snapshot_fingerprint("manifest", "code", 2)
+
+    uri, hit = store.lookup_snapshot(s3, BUCKET, fingerprint, now=NOW)
+    assert not hit
+    assert uri == f"s3://{BUCKET}/bankdm/snapshots/{fingerprint[:16]}-20210601T000000Z"
+    # Without its marker the snapshot is incomplete
+    _publish(s3, uri, channels=("train",))
+    assert store.lookup_snapshot(s3, BUCKET, fingerprint, now=NOW) == (uri, False)
+
+    _publish(s3, uri)
+    assert store.lookup_snapshot(s3, BUCKET, fingerprint, now=NOW) == (uri, True)
+    assert not store.lookup_snapshot(s3, BUCKET, store.snapshot_fingerprint("other", "code", 1), now=NOW)[1]
+
+
+def test_snapshots_beyond_the_retention_are_evicted(tmp_path, store):
+    s3 = LocalS3(str(tmp_path))
+    uris = []
+    for i in range(4):
+        uri, _ = store.lookup_snapshot(s3, BUCKET, store.snapshot_fingerprint(f"manifest-{i}", "code", 1), now=NOW)
+        _publish(s3, uri)
+        # Snapshot i was last used i hours after NOW
+        for dirpath, _, filenames in os.walk(s3.path(uri)):
+            for filename in filenames:
+                mtime = (NOW + datetime.timedelta(hours=i)).timestamp()
+                os.utime(os.path.join(dirpath, filename), (mtime, mtime))
+        uris.append(uri)
+    names = [uri.rsplit("/", 1)[-1] for uri in uris]
+    # The first snapshot is used again, which makes it the most recent
+    store.lookup_snapshot(s3, BUCKET, store.snapshot_fingerprint("manifest-0", "code", 1), now=NOW)
+
+    evicted = store.evict_snapshots(s3, BUCKET, keep=2, max_age_days=30, now=NOW, protect=[uris[1]])
+    assert evicted == [names[2]]
+    assert sorted(store.list_snapshots(s3, BUCKET)) == sorted([names[0], names[1], names[3]])
+
+    later = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=31)
+    assert store.evict_snapshots(s3, BUCKET, keep=5, max_age_days=30, now=later) == [names[0], names[3], names[1]]
+    assert store.list_snapshots(s3, BUCKET) == {}
+    assert not os.path.exists(s3.path(f"s3://{BUCKET}/bankdm/snapshots"))
+
+
+class ScriptedStatement:
+    def __init__(self, statuses):
+        self.statuses = list(statuses)
+
+    def describe_statement(self, Id):
+        return {"Id": Id, "Status": self.statuses.pop(0), "Error": "disk full"}
+
+
+def test_the_unload_is_waited_for_before_its_data_is_digested(store):
+    sleeps = []
+    client = ScriptedStatement(["SUBMITTED", "STARTED", "STARTED", "FINISHED"])
+    assert store.wait_for_unload(client, "id", timeout=60, sleep=sleeps.append)["Status"] == "FINISHED"
+    assert sleeps == [2.0, 4.0, 8.0]
+
+    with pytest.raises(RuntimeError, match="failed: disk full"):
+        store.wait_for_unload(ScriptedStatement(["STARTED", "FAILED"]), "id", timeout=60, sleep=lambda s: None)
+    with pytest.raises(RuntimeError, match="aborted"):
+        store.wait_for_unload(ScriptedStatement(["ABORTED"]), "id", timeout=60, sleep=lambda s: None)
+    with pytest.raises(RuntimeError, match="still STARTED"):
+        store.wait_for_unload(ScriptedStatement(["STARTED"] * 10), "id", timeout=5, sleep=lambda s: None)
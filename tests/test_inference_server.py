@@ -0,0 +1,132 @@
+import asyncio
+import json
+
+import numpy as np
+import pytest
+import xgboost
+
+from pipelines.bankdm.serve import Batcher, Client, InferenceServer, Metrics
+
+
+@pytest.fixture(scope="module")
+def booster():
+    rng = np.random.default_rng(0)
+    features = rng.random((200, 5), dtype=np.float32)
+    labels = (features[:, 0] > 0.5).astype(np.float32)
+    return xgboost.train({"objective": "binary:logistic", "nthread": 1}, xgboost.DMatrix(features, label=labels), 5)
+
+
+def csv_body(rows):
+    return "".join(",".join(map(str, row)) + "\n" for row in rows.tolist()).encode("utf-8")
+
+
+def run_server(booster, scenario, **kwargs):
+    async def main():
+        server = InferenceServer(booster, port=0, **kwargs)
+        await server.start()
+        try:
+            return await scenario(server)
+        finally:
+            await server.stop()
+
+    return asyncio.run(main())
+
+
+def test_server_answers_ping_invocations_and_errors(booster):
+    rows = np.random.default_rng(1).random((3, 5), dtype=np.float32)
+
+    async def scenario(server):
+        client = await Client.connect(server.host, server.port)
+        responses = [
+            await client.request("GET", "/ping"),
+            await client.request("POST", "/invocations", csv_body(rows)),
+            await client.request("POST", "/invocations", b"{}", content_type="application/json"),
+            await client.request("POST", "/invocations", b"1,a\n"),
+            await client.request("GET", "/missing"),
+        ]
+        await client.close()
+        return responses
+
+    ping, invocations, unsupported, malformed, missing = run_server(booster, scenario)
+    assert ping[0] == 200
+    assert invocations[0] == 200
+    predictions = [float(line) for line in invocations[1].decode().splitlines()]
+    np.testing.assert_allclose(predictions, booster.predict(xgboost.DMatrix(rows)), rtol=1e-6)
+    assert unsupported[0] == 415
+    assert malformed[0] == 400
+    assert missing[0] == 404
+
+
+def test_concurrent_requests_are_batched(booster):
+    rows = np.random.default_rng(2).random((40, 5), dtype=np.float32)
+
+    async def scenario(server):
+        clients = [await Client.connect(server.host, server.port) for _ in rows]
+        bodies = [csv_body(rows[i : i + 1]) for i in range(len(rows))]
+        requests = [client.request("POST", "/invocations", body) for client, body in zip(clients, bodies)]
+        responses = await asyncio.gather(*requests)
+        metrics = json.loads((await clients[0].request("GET", "/metrics"))[1])
+        for client in clients:
+            await client.close()
+        return responses, metrics
+
+    responses, metrics = run_server(booster, scenario, max_wait_ms=50)
+    predictions = [float(body) for _, body in responses]
+    np.testing.assert_allclose(predictions, booster.predict(xgboost.DMatrix(rows)), rtol=1e-6)
+    assert metrics["requests"] == 40
+    assert metrics["rows"] == 40
+    assert metrics["batches"] < 40
+    assert metrics["batch_size_max"] > 1
+    assert metrics["latency_p99_ms"] >= metrics["latency_p50_ms"] > 0
+
+
+def test_requests_of_another_width_do_not_fail_the_batch_they_arrive_with(booster):
+    rows = np.random.default_rng(3).random((6, 5), dtype=np.float32)
+
+    async def scenario(server):
+        clients = [await Client.connect(server.host, server.port) for _ in range(len(rows) + 1)]
+        bodies = [csv_body(rows[i : i + 1]) for i in range(len(rows))]
+        bodies.insert(3, csv_body(rows[:1, :3]))
+        responses = await asyncio.gather(
+            *(client.request("POST", "/invocations", body) for client, body in zip(clients, bodies))
+        )
+
+        def fail(rows):
+            raise RuntimeError("out of memory")
+
+        server.batcher.predict = fail
+        failed = await clients[0].request("POST", "/invocations", bodies[0])
+        for client in clients:
+            await client.close()
+        return responses, failed
+
+    responses, failed = run_server(booster, scenario, max_wait_ms=50)
+    malformed = responses.pop(3)
+    assert malformed == (400, b"Expected 5 features per row, got 3")
+    assert [status for status, _ in responses] == [200] * len(rows)
+    predictions = [float(body) for _, body in responses]
+    np.testing.assert_allclose(predictions, booster.predict(xgboost.DMatrix(rows)), rtol=1e-6)
+    assert failed == (500, b"out of memory")
+
+
+def test_batcher_caps_the_batch_size_and_reports_errors():
+    calls = []
+
+    def predict(rows):
+        calls.append(len(rows))
+        if np.isnan(rows).any():
+            raise ValueError("nan")
+        return rows[:, 0]
+
+    async def main():
+        batcher = Batcher(predict, max_wait_ms=20, max_batch_size=4, metrics=Metrics())
+        batcher.start()
+        results = await asyncio.gather(*(batcher.submit(np.full((1, 1), i, np.float32)) for i in range(10)))
+        with pytest.raises(ValueError):
+            await batcher.submit(np.full((1, 1), np.nan, np.float32))
+        await batcher.stop()
+        return results
+
+    results = asyncio.run(main())
+    assert [float(r[0]) for r in results] == list(range(10))
+    assert calls[:3] == [4, 4, 2]
@@ -0,0 +1,306 @@
+import gzip
+import json
+import os
+import pickle
+import shutil
+import tarfile
+
+import numpy as np
+import pandas as pd
+import pytest
+import xgboost
+
+from pipelines.local_services import LocalRedshiftDataClient, LocalS3, redshift_column_name
+from pipelines.bankdm.local_pipeline import DEFAULT_DATA_PATH, run_local_pipeline
+from pipelines.bankdm.scoring import Scorer
+from pipelines.bankdm.train import channel_files, latest_checkpoint, read_values, train
+from pipelines.bankdm.transform import mini_batches, transform_file
+from pipelines.bankdm.tuning import rung_schedule
+
+
+@pytest.fixture
+def sample_csv(tmp_path):
+    with open(DEFAULT_DATA_PATH) as f:
+        lines = f.readlines()[:801]
+    path = tmp_path / "sample.csv"
+    path.write_text("".join(lines))
+    return str(path)
+
+
+def test_redshift_stub_loads_with_redshift_column_names(tmp_path, sample_csv):
+    client = LocalRedshiftDataClient(LocalS3(str(tmp_path)))
+    assert client.load_csv(sample_csv, "dm", "data") == 800
+
+    statement = client.execute_statement(Database="bankdm", Sql="select defaulted, emp_var_rate from dm.data")
+    assert client.describe_statement(Id=statement["Id"])["Status"] == "FINISHED"
+    result = client.get_statement_result(Id=statement["Id"])
+    assert [c["name"] for c in result["ColumnMetadata"]] == ["defaulted", "emp_var_rate"]
+    assert result["TotalNumRows"] == 800
+
+
+def test_redshift_stub_unloads_gzip_shards(tmp_path, sample_csv):
+    s3 = LocalS3(str(tmp_path))
+    client = LocalRedshiftDataClient(s3, slices=3)
+    client.load_csv(sample_csv, "dm", "data")
+
+    statement = client.execute_statement(
+        Sql="unload('select * from dm.data;') to 's3://bucket/bankdm/unload/' "
+        "iam_role 'role' format as CSV header ALLOWOVERWRITE GZIP"
+    )
+    assert client.describe_statement(Id=statement["Id"])["ResultRows"] == 800
+    shards = s3.list("s3://bucket/bankdm/unload/")
+    assert [os.path.basename(uri) for uri in shards] == [f"000{i}_part_00.gz" for i in range(3)]
+    with gzip.open(s3.path(shards[0]), "rt") as f:
+        assert f.readline().startswith("age,job,marital,education,defaulted")
+
+
+def test_redshift_stub_reports_failed_statements(tmp_path):
+    client = LocalRedshiftDataClient(LocalS3(str(tmp_path)))
+    statement = client.execute_statement(Sql="select * from missing")
+    assert client.describe_statement(Id=statement["Id"])["Status"] == "FAILED"
+
+
+def test_local_pipeline_runs_end_to_end(tmp_path, sample_csv):
+    result = run_local_pipeline(str(tmp_path / "work"), data_path=sample_csv)
+
+    stages = [name for name, _ in result["timings"]]
+    assert stages == [
+        "Load-RedShift-table",
+        "Lambda-RedShift-dl",
+        "Step-PreProcess",
+        "Step-Profile",
+        "Step-Train",
+        "Step-Eval",
+        "Step-AccuracyCond",
+    ]
+    assert result["evaluation"]["regression_metrics"]["mse"]["value"] < 1.0
+    with open(result["profile"]) as f:
+        profile = json.load(f)
+    assert profile["rows"] == 800
+    assert profile["columns"]["age"]["kind"] == "numeric"
+    assert profile["columns"]["job"]["kind"] == "categorical"
+    assert os.path.exists(os.path.join(result["registered"], "model.tar.gz"))
+    assert "Total" in result["report"]
+
+
+def test_local_pipeline_reruns_only_changed_steps(tmp_path, sample_csv):
+    work_dir = str(tmp_path / "work")
+    first = run_local_pipeline(work_dir, data_path=sample_csv)
+    assert set(first["cache"].values()) == {"miss"}
+
+    second = run_local_pipeline(work_dir, data_path=sample_csv)
+    assert set(second["cache"].values()) == {"hit"}
+    assert second["evaluation"] == first["evaluation"]
+
+    third = run_local_pipeline(work_dir, data_path=sample_csv, hyperparameters={"num_round": 5, "max_depth": 2})
+    assert third["cache"] == {
+        "Step-PreProcess": "hit",
+        "Step-Profile": "hit",
+        "Step-Train": "miss",
+        "Step-Eval": "miss",
+    }
+
+
+def test_local_pipeline_trains_across_instances_on_train_shards(tmp_path, sample_csv):
+    result = run_local_pipeline(
+        str(tmp_path / "work"), data_path=sample_csv, training_instance_count=2, training_input_mode="Pipe"
+    )
+
+    process_dir = os.path.join(str(tmp_path / "work"), "jobs", "Step-PreProcess")
+    (job,) = os.listdir(process_dir)
+    shards = sorted(os.listdir(os.path.join(process_dir, job, "train")))
+    assert shards == ["train_00000.csv", "train_00001.csv"]
+    assert result["evaluation"]["regression_metrics"]["mse"]["value"] < 1.0
+
+
+def test_rung_schedule_promotes_a_third_of_the_trials_to_more_data_and_rounds():
+    assert rung_schedule(27, 54, 3) == [(27, 1 / 27, 2), (9, 1 / 9, 6), (3, 1 / 3, 18), (1, 1.0, 54)]
+    assert rung_schedule(1, 10, 3) == [(1, 1.0, 10)]
+
+
+def test_local_pipeline_tunes_by_successive_halving(tmp_path, sample_csv):
+    result = run_local_pipeline(
+        str(tmp_path / "work"), data_path=sample_csv, enable_tuning=True, tuning_max_jobs=9, tuning_max_parallel_jobs=3
+    )
+
+    assert "Step-Tune" in result["cache"]
+    trials = result["tuning"]["trials"]
+    assert [len([t for t in trials if t["rung"] == rung]) for rung in range(3)] == [9, 3, 1]
+    assert result["tuning"]["best_validation_rmse"] == min(t["validation_rmse"] for t in trials if t["rung"] == 2)
+    assert result["evaluation"]["regression_metrics"]["mse"]["value"] < 1.0
+
+
+def test_pipe_mode_streams_the_channel_files_back_to_back(tmp_path):
+    for i, rows in enumerate(["1,0.5,2\n0,1.5,3\n", "1,2.5,4\n"]):
+        (tmp_path / f"train_{i:05d}.csv").write_text(rows)
+    files = channel_files(str(tmp_path))
+
+    features, labels = read_values(files, "Pipe")
+    assert labels.tolist() == [1, 0, 1]
+    assert features.tolist() == read_values(files, "File")[0].tolist()
+    with pytest.raises(ValueError, match="input mode"):
+        read_values(files, "Stream")
+
+
+def test_training_resumes_from_the_latest_checkpoint(tmp_path, sample_csv):
+    work_dir = str(tmp_path / "work")
+    run_local_pipeline(work_dir, data_path=sample_csv)
+    (process_job,) = os.listdir(os.path.join(work_dir, "jobs", "Step-PreProcess"))
+    process_dir = os.path.join(work_dir, "jobs", "Step-PreProcess", process_job)
+    checkpoint_dir = str(tmp_path / "checkpoints")
+    hyperparameters = {"objective": "reg:squarederror", "max_depth": 2}
+
+    # A job interrupted after 7 rounds leaves the checkpoint of round 5 behind
+    train(process_dir + "/train", None, str(tmp_path / "first"), dict(hyperparameters, num_round=7),
+          checkpoint_dir=checkpoint_dir, save_interval=5)
+    assert latest_checkpoint(checkpoint_dir) == (os.path.join(checkpoint_dir, "xgboost-checkpoint.5"), 5)
+
+    model_path = train(process_dir + "/train", None, str(tmp_path / "resumed"), dict(hyperparameters, num_round=12),
+                       checkpoint_dir=checkpoint_dir, save_interval=5)
+    with tarfile.open(model_path) as tar:
+        booster = pickle.load(tar.extractfile("xgboost-model"))
+    assert booster.num_boosted_rounds() == 12
+    assert sorted(os.listdir(checkpoint_dir)) == ["xgboost-checkpoint.10", "xgboost-checkpoint.5"]
+
+
+def test_mini_batches_respect_the_max_payload():
+    lines = ["x" * 400_000 + "\n"] * 6
+    assert [len(batch) for batch in mini_batches(lines, 1)] == [2, 2, 2]
+    assert [len(batch) for batch in mini_batches(["x" * 2_000_000 + "\n"], 1)] == [1]
+
+
+def test_transform_keeps_the_key_as_text(tmp_path):
+    features = np.random.default_rng(0).random((3, 2), dtype=np.float32)
+    booster = xgboost.train({"max_depth": 2}, xgboost.DMatrix(features, label=features[:, 0]), 3)
+    keys = ["4f1c2a9e-0b7d-4e5c-9a1f-3d2b8c6e7f10", "ACCT-0042", "9007199254740993"]
+    input_path = tmp_path / "score.csv"
+    input_path.write_text("".join(f"{key},{a},{b}\n" for key, (a, b) in zip(keys, features.tolist())))
+
+    assert transform_file(booster, str(input_path), str(tmp_path / "score.csv.out"), max_payload=1) == (3, 1)
+    rows = [line.rstrip("\n").split(",") for line in (tmp_path / "score.csv.out").read_text().splitlines()]
+    assert [row[0] for row in rows] == keys
+    np.testing.assert_allclose([float(row[1]) for row in rows], booster.predict(xgboost.DMatrix(features)))
+
+
+def test_local_pipeline_scores_the_table_with_batch_transform(tmp_path, sample_csv):
+    result = run_local_pipeline(
+        str(tmp_path / "work"),
+        data_path=sample_csv,
+        enable_batch_transform=True,
+        score_shards=3,
+        transform_instance_count=2,
+        transform_max_payload=0.01,
+    )
+
+    transform = result["transform"]
+    assert transform["rows"] == 800
+    assert transform["files"] == 3
+    assert transform["batches"] > 3
+    assert transform["rows_per_second"] > 0
+    outputs = sorted(os.listdir(transform["output_dir"]))
+    assert outputs == [f"score_{i:05d}.csv.out" for i in range(3)]
+    predictions = {}
+    for name in outputs:
+        with open(os.path.join(transform["output_dir"], name)) as f:
+            rows = [line.rstrip("\n").split(",") for line in f]
+        assert all(len(row) == 2 for row in rows)
+        predictions.update((int(row[0]), float(row[1])) for row in rows)
+    # Keyed by the identity column of the table, numbering its rows from 1
+    assert sorted(predictions) == list(range(1, 801))
+    raw = pd.read_csv(sample_csv).rename(columns=redshift_column_name)
+    expected = Scorer.load(result["model"], result["features"]).predict(raw)
+    scored = [predictions[key] for key in range(1, 801)]
+    assert scored == pytest.approx(expected.tolist(), rel=1e-5, abs=1e-6)
+
+
+def test_local_pipeline_skips_training_when_the_data_did_not_drift(tmp_path, sample_csv):
+    work_dir = str(tmp_path / "work")
+    first = run_local_pipeline(work_dir, data_path=sample_csv, enable_drift_check=True)
+    assert first["drift"]["drift"]["reason"] == "no reference profile"
+    assert os.path.exists(os.path.join(first["registered"], "profile.json"))
+
+    second = run_local_pipeline(work_dir, data_path=sample_csv, enable_drift_check=True, use_cache=False)
+    assert second["drift"]["drift"]["detected"] is False
+    assert second["registered"] is None
+    assert [name for name, _ in second["timings"]][-1] == "Step-DriftCheck"
+
+    data = pd.read_csv(sample_csv)
+    data["age"] += 15
+    shifted = str(tmp_path / "shifted.csv")
+    data.to_csv(shifted, index=False)
+    third = run_local_pipeline(work_dir, data_path=shifted, enable_drift_check=True)
+    assert third["drift"]["drift"]["columns"] == ["age"]
+    assert third["registered"].endswith("2")
+
+
+def test_local_pipeline_trains_on_weighted_downsampled_negatives(tmp_path, sample_csv):
+    work_dir = str(tmp_path / "work")
+    result = run_local_pipeline(work_dir, data_path=sample_csv, negative_fraction=0.5)
+
+    (job,) = os.listdir(os.path.join(work_dir, "jobs", "Step-PreProcess"))
+    splits = {
+        name: pd.read_csv(os.path.join(work_dir, "jobs", "Step-PreProcess", job, name, f"{name}.csv"), header=None)
+        for name in ("train", "validation", "test")
+    }
+    assert splits["train"].shape[1] == splits["test"].shape[1] + 1 == splits["validation"].shape[1]
+    assert set(splits["train"][1]) == {1.0, 2.0}
+    assert len(splits["train"]) < 0.7 * 800
+    assert result["evaluation"]["regression_metrics"]["mse"]["value"] < 1.0
+
+
+def test_local_pipeline_reuses_the_feature_snapshot_of_the_extraction(tmp_path, sample_csv):
+    work_dir = str(tmp_path / "work")
+    first = run_local_pipeline(work_dir, data_path=sample_csv)
+    s3 = LocalS3(os.path.join(work_dir, "s3"))
+    with open(os.path.join(s3.path(first["snapshot"]), "snapshot", "snapshot.json")) as f:
+        marker = json.load(f)
+    assert marker["rows"] == {"train": 560, "validation": 160, "test": 80}
+    assert len(marker["manifest_digest"]) == 64
+
+    # The snapshot, not the job directory, short-circuits the preprocessing
+    shutil.rmtree(os.path.join(work_dir, "jobs", "Step-PreProcess"))
+    second = run_local_pipeline(work_dir, data_path=sample_csv)
+    assert second["snapshot"] == first["snapshot"]
+    assert second["cache"]["Step-PreProcess"] == "hit"
+    assert second["evaluation"] == first["evaluation"]
+
+    third = run_local_pipeline(work_dir, data_path=sample_csv, negative_fraction=0.5, snapshot_keep=1)
+    assert third["cache"]["Step-PreProcess"] == "miss"
+    # Retention applies at the next lookup, which keeps only the snapshot in use
+    fourth = run_local_pipeline(work_dir, data_path=sample_csv, negative_fraction=0.5, snapshot_keep=1)
+    assert fourth["cache"]["Step-PreProcess"] == "hit"
+    assert s3.list(fourth["snapshot"].rsplit("/", 1)[0]) == s3.list(fourth["snapshot"])
+
+
+def test_local_pipeline_trains_on_gzipped_splits_in_pipe_mode(tmp_path, sample_csv):
+    plain = run_local_pipeline(str(tmp_path / "plain"), data_path=sample_csv)
+    work_dir = str(tmp_path / "work")
+    result = run_local_pipeline(work_dir, data_path=sample_csv, split_gzip_level=6)
+
+    s3 = LocalS3(os.path.join(work_dir, "s3"))
+    snapshot_dir = s3.path(result["snapshot"])
+    for name in ("train", "validation", "test"):
+        assert os.listdir(os.path.join(snapshot_dir, name)) == [f"{name}.csv.gz"]
+    with open(os.path.join(snapshot_dir, "snapshot", "snapshot.json")) as f:
+        write = json.load(f)["write"]
+    assert write["level"] == 6 and write["ratio"] > 1
+    # The splits and thus the model are those of the plain csv
+    assert result["evaluation"] == plain["evaluation"]
+    with pytest.raises(ValueError, match="Pipe mode"):
+        run_local_pipeline(work_dir, data_path=sample_csv, split_gzip_level=6, training_input_mode="FastFile")
+
+
+def test_local_pipeline_evaluates_on_the_memory_mapped_test_arrays(tmp_path, sample_csv):
+    plain = run_local_pipeline(str(tmp_path / "plain"), data_path=sample_csv)
+    work_dir = str(tmp_path / "work")
+    result = run_local_pipeline(work_dir, data_path=sample_csv, test_arrays=True)
+
+    (job,) = os.listdir(os.path.join(work_dir, "jobs", "Step-Eval"))
+    assert sorted(os.listdir(os.path.join(work_dir, "jobs", "Step-Eval", job, "test"))) == [
+        "test.csv",
+        "test_features.npy",
+        "test_labels.npy",
+    ]
+    assert result["evaluation"]["regression_metrics"]["mse"]["value"] == pytest.approx(
+        plain["evaluation"]["regression_metrics"]["mse"]["value"]
+    )
@@ -0,0 +1,251 @@
+import json
+import os
+import time
+
+import pytest
+from unittest import mock
+
+from conftest import ACCOUNT_ID, IMAGE_URI, steps_by_name
+from pipelines.fingerprint import file_digest
+
+BANKDM_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "pipelines", "bankdm")
+
+
+def test_steps_are_cached_on_code_and_data_digests(build_definition):
+    steps = steps_by_name(build_definition())
+
+    for name in ("Step-PreProcess", "Step-Profile", "Step-Train", "Step-Eval"):
+        assert steps[name]["CacheConfig"] == {"Enabled": True, "ExpireAfter": "P30D"}
+
+    process_args = steps["Step-PreProcess"]["Arguments"]["AppSpecification"]["ContainerArguments"]
+    assert process_args[1] == {"Get": "Steps.Lambda-RedShift-dl.OutputParameters['manifest_digest']"}
+    assert process_args[3] == file_digest(os.path.join(BANKDM_DIR, "preprocess.py"))
+    profile_args = steps["Step-Profile"]["Arguments"]["AppSpecification"]["ContainerArguments"]
+    assert profile_args[1] == process_args[1]
+    assert profile_args[3] == file_digest(os.path.join(BANKDM_DIR, "profiling.py"))
+    eval_args = steps["Step-Eval"]["Arguments"]["AppSpecification"]["ContainerArguments"]
+    assert eval_args == ["--code-digest", file_digest(os.path.join(BANKDM_DIR, "evaluate.py"))]
+    assert steps["Step-Train"]["Arguments"]["ProfilerConfig"]["DisableProfiler"] is True
+
+
+def test_training_is_sharded_across_training_instances(build_definition):
+    definition = build_definition()
+    steps = steps_by_name(definition)
+
+    count = {"Get": "Parameters.TrainingInstanceCount"}
+    assert {"Name": "TrainingInstanceCount", "Type": "Integer", "DefaultValue": 1} in definition["Parameters"]
+    train_args = steps["Step-Train"]["Arguments"]
+    assert train_args["ResourceConfig"]["InstanceCount"] == count
+    channels = {c["ChannelName"]: c["DataSource"]["S3DataSource"] for c in train_args["InputDataConfig"]}
+    assert channels["train"]["S3DataDistributionType"] == "ShardedByS3Key"
+    assert channels["validation"]["S3DataDistributionType"] == "FullyReplicated"
+    process_args = steps["Step-PreProcess"]["Arguments"]["AppSpecification"]["ContainerArguments"]
+    assert process_args[4] == "--train-shards"
+
+
+def test_tuning_step_passes_its_best_model_on(build_definition):
+    definition = build_definition(enable_tuning=True, tuning_max_jobs=9)
+    steps = steps_by_name(definition)
+
+    assert "Step-Train" not in steps
+    tuning = steps["Step-Tune"]["Arguments"]["HyperParameterTuningJobConfig"]
+    assert tuning["Strategy"] == "Hyperband"
+    assert tuning["StrategyConfig"]["HyperbandStrategyConfig"] == {"MinResource": 5, "MaxResource": 50}
+    assert tuning["ResourceLimits"] == {
+        "MaxNumberOfTrainingJobs": 9,
+        "MaxParallelTrainingJobs": {"Get": "Parameters.TuningMaxParallelJobs"},
+    }
+    model = steps["Step-Eval"]["Arguments"]["ProcessingInputs"][0]["S3Input"]["S3Uri"]
+    assert model["Std:Join"]["Values"][-2] == {"Get": "Steps.Step-Tune.TrainingJobSummaries[0].TrainingJobName"}
+
+
+def test_training_channels_can_be_streamed(build_definition):
+    definition = build_definition()
+    steps = steps_by_name(definition)
+
+    mode = [p for p in definition["Parameters"] if p["Name"] == "TrainingInputMode"][0]
+    assert mode["DefaultValue"] == "File"
+    assert mode["EnumValues"] == ["File", "Pipe", "FastFile"]
+    for channel in steps["Step-Train"]["Arguments"]["InputDataConfig"]:
+        assert channel["InputMode"] == {"Get": "Parameters.TrainingInputMode"}
+
+
+def test_training_is_checkpointed_and_can_run_on_spot(build_definition):
+    steps = steps_by_name(build_definition())
+    train_args = steps["Step-Train"]["Arguments"]
+    checkpoint = train_args["CheckpointConfig"]["S3Uri"]["Std:Join"]["Values"]
+    assert checkpoint[3] == {"Get": "Steps.Lambda-RedShift-dl.OutputParameters['manifest_digest']"}
+    assert "EnableManagedSpotTraining" not in train_args
+
+    spot_args = steps_by_name(build_definition(use_spot_instances=True, max_run=3600, max_wait=7200))[
+        "Step-Train"
+    ]["Arguments"]
+    assert spot_args["EnableManagedSpotTraining"] is True
+    assert spot_args["StoppingCondition"] == {"MaxRuntimeInSeconds": 3600, "MaxWaitTimeInSeconds": 7200}
+    assert spot_args["CheckpointConfig"] == train_args["CheckpointConfig"]
+
+
+def test_batch_transform_scores_the_table_with_the_registered_model(build_definition):
+    steps = steps_by_name(
+        build_definition(enable_batch_transform=True, score_shards=8, transform_max_payload=4, key_column="row_id")
+    )
+
+    process_args = steps["Step-PreProcess"]["Arguments"]
+    assert process_args["AppSpecification"]["ContainerArguments"][6:] == [
+        "--score-shards",
+        "8",
+        "--key-column",
+        "row_id",
+    ]
+    assert "score" in [o["OutputName"] for o in process_args["ProcessingOutputConfig"]["Outputs"]]
+    transform = steps["Step-BatchTransform"]["Arguments"]
+    assert transform["ModelName"] == {"Get": "Steps.Step-CreateModel.ModelName"}
+    assert transform["BatchStrategy"] == "MultiRecord"
+    assert transform["MaxPayloadInMB"] == 4
+    assert transform["TransformInput"]["SplitType"] == "Line"
+    assert transform["DataProcessing"] == {"InputFilter": "$[1:]", "OutputFilter": "$[0,-1]", "JoinSource": "Input"}
+    assert transform["TransformResources"]["InstanceCount"] == {"Get": "Parameters.TransformInstanceCount"}
+
+
+def test_batch_transform_needs_the_key_column(build_definition):
+    with pytest.raises(ValueError, match="key_column"):
+        build_definition(enable_batch_transform=True)
+
+
+def test_batch_transform_is_optional(build_definition):
+    steps = steps_by_name(build_definition())
+    assert "Step-BatchTransform" not in steps
+    assert steps["Step-PreProcess"]["Arguments"]["AppSpecification"]["ContainerArguments"][6:] == [
+        "--score-shards",
+        "0",
+    ]
+
+
+def test_definition_is_the_same_across_builds(build_definition):
+    assert build_definition() == build_definition()
+
+
+def test_step_cache_can_be_disabled(build_definition):
+    steps = steps_by_name(build_definition(enable_step_cache=False))
+    assert steps["Step-Train"]["CacheConfig"]["Enabled"] is False
+
+
+def test_offline_definition_makes_no_aws_calls(build_definition):
+    with mock.patch("botocore.client.BaseClient._make_api_call", side_effect=AssertionError("AWS call")):
+        start = time.perf_counter()
+        definition = build_definition()
+        elapsed = time.perf_counter() - start
+
+    steps = steps_by_name(definition)
+    assert elapsed < 5
+    assert steps["Step-Train"]["Arguments"]["AlgorithmSpecification"]["TrainingImage"] == IMAGE_URI
+    code = steps["Step-PreProcess"]["Arguments"]["ProcessingInputs"][-1]["S3Input"]["S3Uri"]
+    digest = file_digest(os.path.join(BANKDM_DIR, "preprocess.py"))
+    assert code == f"s3://bucket/BankDM-/code/{digest[:16]}/preprocess.py"
+
+
+def test_offline_definition_requires_environment(build_definition):
+    with pytest.raises(ValueError, match="account_id"):
+        build_definition(account_id=None)
+
+
+def test_environment_is_cached_for_offline_builds(build_definition, tmp_path):
+    env_cache = str(tmp_path / "env.json")
+    with mock.patch("pipelines.bankdm.pipeline.get_boto_session") as boto_session:
+        boto_session.return_value.client.return_value.get_caller_identity.return_value = {
+            "Account": ACCOUNT_ID
+        }
+        pipeline_module = pytest.importorskip("pipelines.bankdm.pipeline")
+        env = pipeline_module.resolve_environment(
+            "us-east-1",
+            mock.Mock(),
+            role=f"arn:aws:iam::{ACCOUNT_ID}:role/pipeline",
+            image_uri=IMAGE_URI,
+            default_bucket="bucket",
+            env_cache=env_cache,
+        )
+    assert env["account_id"] == ACCOUNT_ID
+    with open(env_cache) as f:
+        assert json.load(f)["us-east-1"]["account_id"] == ACCOUNT_ID
+
+    definition = build_definition(account_id=None, role=None, image_uri=None, default_bucket=None,
+                                  env_cache=env_cache)
+    assert definition["Parameters"][-1]["DefaultValue"] == "bucket"
+
+
+def test_training_runs_only_on_drift_when_the_check_is_enabled(build_definition):
+    definition = build_definition(enable_drift_check=True)
+    assert [step["Name"] for step in definition["Steps"]] == [
+        "Lambda-RedShift-dl",
+        "Step-PreProcess",
+        "Step-Profile",
+        "Step-DriftCheck",
+        "Step-DriftCond",
+    ]
+    steps = steps_by_name(definition)
+    assert "CacheConfig" not in steps["Step-DriftCheck"]
+    assert steps["Step-DriftCheck"]["PropertyFiles"] == [
+        {"PropertyFileName": "DriftReport", "OutputName": "drift", "FilePath": "drift.json"}
+    ]
+    condition = steps["Step-DriftCond"]["Arguments"]
+    assert condition["Conditions"][0]["LeftValue"]["Std:JsonGet"]["Path"] == "drift.detected"
+    assert [step["Name"] for step in condition["IfSteps"]] == ["Step-Train", "Step-Eval", "Step-AccuracyCond"]
+
+
+def test_registered_models_keep_the_profile_of_their_training_data(build_definition):
+    register = steps_by_name(build_definition())["Step-RegisterModel-RegisterModel"]["Arguments"]
+    statistics = register["ModelMetrics"]["ModelDataQuality"]["Statistics"]
+    assert statistics["ContentType"] == "application/json"
+    assert statistics["S3Uri"]["Std:Join"]["Values"] == [
+        {"Get": "Steps.Step-Profile.ProcessingOutputConfig.Outputs['profile'].S3Output.S3Uri"},
+        "profile.json",
+    ]
+
+
+def test_downsampled_training_reads_instance_weights(build_definition):
+    steps = steps_by_name(build_definition(negative_fraction=0.2))
+    assert steps["Step-PreProcess"]["Arguments"]["AppSpecification"]["ContainerArguments"][-2:] == [
+        "--negative-fraction",
+        "0.2",
+    ]
+    assert steps["Step-Train"]["Arguments"]["HyperParameters"]["csv_weights"] == "1"
+    assert "csv_weights" not in steps_by_name(build_definition())["Step-Train"]["Arguments"]["HyperParameters"]
+
+
+def test_preprocessing_publishes_the_feature_snapshot_the_lambda_points_to(build_definition):
+    steps = steps_by_name(build_definition(snapshot_keep=3))
+    lambda_step = steps["Lambda-RedShift-dl"]
+    assert lambda_step["Arguments"]["snapshot_keep"] == 3
+    assert lambda_step["Arguments"]["train_shards"] == {"Get": "Parameters.TrainingInstanceCount"}
+    assert [o["OutputName"] for o in lambda_step["OutputParameters"]] == ["manifest_digest", "snapshot_uri"]
+
+    outputs = steps["Step-PreProcess"]["Arguments"]["ProcessingOutputConfig"]["Outputs"]
+    assert [o["OutputName"] for o in outputs] == ["train", "validation", "test", "features", "snapshot"]
+    for output in outputs:
+        assert output["S3Output"]["S3Uri"]["Std:Join"]["Values"] == [
+            {"Get": "Steps.Lambda-RedShift-dl.OutputParameters['snapshot_uri']"},
+            output["OutputName"],
+        ]
+    assert steps["Step-PreProcess"]["CacheConfig"]["Enabled"] is True
+
+
+def test_gzipped_splits_are_streamed_in_pipe_mode(build_definition):
+    definition = build_definition(split_gzip_level=6)
+    steps = steps_by_name(definition)
+    assert steps["Step-PreProcess"]["Arguments"]["AppSpecification"]["ContainerArguments"][-2:] == ["--gzip-level", "6"]
+    # Any other input mode is rejected when an execution starts
+    mode = [p for p in definition["Parameters"] if p["Name"] == "TrainingInputMode"][0]
+    assert mode["DefaultValue"] == "Pipe" and mode["EnumValues"] == ["Pipe"]
+    for channel in steps["Step-Train"]["Arguments"]["InputDataConfig"]:
+        assert channel["CompressionType"] == "Gzip"
+        assert channel["InputMode"] == {"Get": "Parameters.TrainingInputMode"}
+    for channel in steps_by_name(build_definition())["Step-Train"]["Arguments"]["InputDataConfig"]:
+        assert "CompressionType" not in channel
+        assert channel["InputMode"] == {"Get": "Parameters.TrainingInputMode"}
+
+
+def test_test_arrays_are_written_on_request(build_definition):
+    arguments = steps_by_name(build_definition(test_arrays=True))["Step-PreProcess"]["Arguments"]
+    assert arguments["AppSpecification"]["ContainerArguments"][-1] == "--test-arrays"
+    arguments = steps_by_name(build_definition())["Step-PreProcess"]["Arguments"]
+    assert "--test-arrays" not in arguments["AppSpecification"]["ContainerArguments"]
@@ -0,0 +1,129 @@
+import numpy as np
+import pytest
+
+from pipelines.local_services import LocalSageMakerClient, LocalSageMakerRuntimeClient
+from pipelines.prediction_cache import PredictionCache
+from pipelines.prediction_client import PredictionClient
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def counting_predict(calls):
+    def predict(rows):
+        calls.append(len(rows))
+        return rows.sum(axis=1)
+
+    return predict
+
+
+def test_repeated_rows_are_predicted_once():
+    calls = []
+    cache = PredictionCache(max_size=10)
+    rows = np.array([[1, 2], [3, 4], [1, 2], [3, 4]], dtype=np.float32)
+
+    np.testing.assert_array_equal(cache.predict(rows, counting_predict(calls)), [3, 7, 3, 7])
+    np.testing.assert_array_equal(cache.predict(rows[:2], counting_predict(calls)), [3, 7])
+
+    assert calls == [2]
+    stats = cache.snapshot()
+    assert (stats["hits"], stats["misses"], stats["size"]) == (4, 2, 2)
+    assert stats["hit_rate"] == pytest.approx(2 / 3)
+    assert stats["lookup_us"] > 0
+
+
+def test_least_recently_used_entries_are_evicted():
+    calls = []
+    cache = PredictionCache(max_size=2)
+    predict = counting_predict(calls)
+    for value in (1, 2, 1, 3):  # 2 is the least recently used when 3 comes in
+        cache.predict(np.array([[value]], dtype=np.float32), predict)
+    cache.predict(np.array([[1], [3], [2]], dtype=np.float32), predict)
+
+    assert calls == [1, 1, 1, 1]
+    assert cache.snapshot()["evictions"] == 2
+
+
+def test_entries_expire_after_the_ttl():
+    calls = []
+    clock = Clock()
+    cache = PredictionCache(ttl=10, clock=clock)
+    row = np.array([[5]], dtype=np.float32)
+    cache.predict(row, counting_predict(calls))
+    clock.now = 5
+    cache.predict(row, counting_predict(calls))
+    clock.now = 16
+    cache.predict(row, counting_predict(calls))
+
+    assert calls == [1, 1]
+    assert cache.snapshot()["expirations"] == 1
+
+
+def test_a_new_model_empties_the_cache():
+    cache = PredictionCache()
+    row = np.array([[1, 1]], dtype=np.float32)
+    cache.set_model("a")
+    first = cache.key(row[0])
+    cache.predict(row, lambda rows: [0.5])
+    cache.set_model("a")
+    assert len(cache) == 1
+    cache.set_model("b")
+
+    assert len(cache) == 0
+    assert cache.key(row[0]) != first
+    assert cache.snapshot()["invalidations"] == 1
+
+
+def test_prediction_client_only_sends_rows_not_cached():
+    endpoint = LocalSageMakerRuntimeClient(lambda rows: [sum(row) for row in rows])
+    cache = PredictionCache()
+    client = PredictionClient("bankdm", runtime_client=endpoint, cache=cache, model_version="v1")
+    rows = np.array([[0.1, 2], [3, 4], [0.1, 2]], dtype=np.float32)
+
+    assert client.predict(rows) == pytest.approx([2.1, 7, 2.1])
+    assert client.predict(rows[::-1]) == pytest.approx([2.1, 7, 2.1])
+    assert endpoint.requests == 1
+    assert client.stats["rows"] == 2
+    assert cache.snapshot()["hit_rate"] == pytest.approx(4 / 6)
+
+
+def test_prediction_client_follows_the_config_the_endpoint_runs():
+    endpoint = LocalSageMakerRuntimeClient(lambda rows: [sum(row) for row in rows])
+    sagemaker = LocalSageMakerClient(
+        endpoints={"bankdm": {"EndpointConfigName": "bankdm-1", "EndpointStatus": "InService"}}
+    )
+    clock = Clock()
+    cache = PredictionCache()
+    client = PredictionClient(
+        "bankdm", runtime_client=endpoint, cache=cache, sagemaker_client=sagemaker, version_refresh=60, clock=clock
+    )
+    rows = np.array([[1, 2], [3, 4]], dtype=np.float32)
+
+    client.predict(rows)
+    client.predict(rows)
+    assert endpoint.requests == 1
+    assert cache.model_digest == "bankdm-1"
+
+    # While updating, either model may answer, so nothing is cached
+    sagemaker.endpoints["bankdm"] = {"EndpointConfigName": "bankdm-1", "EndpointStatus": "Updating"}
+    clock.now = 60
+    client.predict(rows)
+    client.predict(rows)
+    assert endpoint.requests == 3
+
+    sagemaker.endpoints["bankdm"] = {"EndpointConfigName": "bankdm-2", "EndpointStatus": "InService"}
+    clock.now = 90
+    client.predict(rows)
+    assert endpoint.requests == 4
+    clock.now = 120
+    client.predict(rows)
+    client.predict(rows)
+    assert endpoint.requests == 5
+    assert cache.model_digest == "bankdm-2"
+    assert cache.snapshot()["invalidations"] == 1
+    assert sagemaker.calls.count("describe_endpoint") == 3
@@ -0,0 +1,73 @@
+import time
+
+import numpy as np
+import pytest
+
+from pipelines.local_services import LocalClientError, LocalSageMakerRuntimeClient
+from pipelines.prediction_client import PredictionClient, pack_payloads, parse_predictions
+
+
+def row_sum(rows):
+    return [sum(row) for row in rows]
+
+
+def test_pack_payloads_respects_the_size_limit_and_row_boundaries():
+    lines = [f"{i},1.5\n" for i in range(10)]
+    payloads = pack_payloads(lines, max_payload=20)
+    assert all(len(payload) <= 20 for _, payload, _ in payloads)
+    assert [start for start, _, _ in payloads] == [0, 3, 6, 9]
+    assert b"".join(payload for _, payload, _ in payloads).decode() == "".join(lines)
+    with pytest.raises(ValueError, match="payload limit"):
+        pack_payloads(["x" * 30 + "\n"], max_payload=20)
+
+
+def test_parse_predictions_of_either_container_version():
+    assert parse_predictions(b"0.1,0.2,0.3") == [0.1, 0.2, 0.3]
+    assert parse_predictions(b"0.1\n0.2\n0.3\n") == [0.1, 0.2, 0.3]
+
+
+def test_predictions_come_back_in_input_order():
+    rows = np.arange(3000, dtype=np.float32).reshape(1000, 3)
+    endpoint = LocalSageMakerRuntimeClient(row_sum)
+    client = PredictionClient("bankdm", runtime_client=endpoint, max_payload=512, max_workers=8)
+
+    assert client.predict(rows) == pytest.approx(rows.sum(axis=1).tolist())
+    assert client.stats["requests"] == endpoint.requests > 1
+
+
+def test_throttled_requests_are_retried_with_backoff():
+    endpoint = LocalSageMakerRuntimeClient(row_sum, latency=0.01, max_concurrency=2)
+    sleeps = []
+    client = PredictionClient(
+        "bankdm", runtime_client=endpoint, max_payload=64, max_workers=8, max_retries=20, backoff=0.001,
+        sleep=lambda seconds: (sleeps.append(seconds), time.sleep(seconds)),
+    )
+    rows = [[i, 1] for i in range(200)]
+
+    assert client.predict(rows) == [i + 1 for i in range(200)]
+    assert endpoint.throttled == client.stats["retries"] == len(sleeps) > 0
+
+
+def test_non_retryable_errors_are_raised():
+    def failing(rows):
+        raise LocalClientError("ModelError", "bad input")
+
+    client = PredictionClient("bankdm", runtime_client=LocalSageMakerRuntimeClient(failing))
+    with pytest.raises(LocalClientError, match="ModelError"):
+        client.predict([[1, 2]])
+    assert client.stats["retries"] == 0
+
+
+def test_batched_concurrent_scoring_beats_one_request_per_row():
+    rows = np.random.default_rng(0).random((400, 20))
+    endpoint = LocalSageMakerRuntimeClient(row_sum, latency=0.002, row_latency=0.00001)
+
+    start = time.perf_counter()
+    one_by_one = [PredictionClient("bankdm", runtime_client=endpoint, max_workers=1).predict([row])[0] for row in rows]
+    per_row = time.perf_counter() - start
+    start = time.perf_counter()
+    batched = PredictionClient("bankdm", runtime_client=endpoint, max_payload=16 * 1024, max_workers=4).predict(rows)
+    micro_batched = time.perf_counter() - start
+
+    assert batched == pytest.approx(one_by_one)
+    assert micro_batched * 5 < per_row
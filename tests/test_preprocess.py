@@ -0,0 +1,93 @@
+import gzip
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from pipelines.bankdm import preprocess
+
+
+@pytest.fixture
+def model_data():
+    rng = np.random.default_rng(0)
+    labels = (rng.random(20000) < 0.1).astype(np.uint8)
+    return pd.DataFrame(
+        {
+            "age": rng.integers(18, 90, 20000),
+            "campaign": rng.integers(1, 40, 20000),
+            "y_no": 1 - labels,
+            "y_yes": labels,
+        }
+    )
+
+
+def test_downsampling_keeps_every_positive_and_reweights_the_negatives(model_data):
+    kept = preprocess.downsample_negatives(model_data, 0.25)
+
+    positives, negatives = model_data["y_yes"] == 1, model_data["y_yes"] == 0
+    assert kept["y_yes"].sum() == positives.sum()
+    assert len(kept) - positives.sum() == pytest.approx(0.25 * negatives.sum(), rel=0.05)
+    assert set(kept.loc[kept["y_yes"] == 0, preprocess.WEIGHT]) == {4.0}
+    assert set(kept.loc[kept["y_yes"] == 1, preprocess.WEIGHT]) == {1.0}
+    # The weighted label mean, the prediction of a constant model, is unbiased
+    weighted_mean = np.average(kept["y_yes"], weights=kept[preprocess.WEIGHT])
+    assert weighted_mean == pytest.approx(model_data["y_yes"].mean(), rel=0.05)
+
+
+def test_downsampling_is_deterministic_per_row(model_data):
+    kept = preprocess.downsample_negatives(model_data, 0.3)
+    shuffled = preprocess.downsample_negatives(model_data.sample(frac=1, random_state=7), 0.3)
+    assert sorted(kept.index) == sorted(shuffled.index)
+    assert preprocess.downsample_negatives(model_data, 1.0).equals(model_data.assign(**{preprocess.WEIGHT: 1.0}))
+    with pytest.raises(ValueError, match="negative fraction"):
+        preprocess.downsample_negatives(model_data, 0)
+
+
+def test_weights_are_written_after_the_label(model_data, tmp_path):
+    path = str(tmp_path / "train.csv")
+    preprocess.write_split(preprocess.downsample_negatives(model_data.head(5), 0.5), path)
+    written = pd.read_csv(path, header=None)
+    assert written.shape[1] == 4
+    assert set(written[1]) <= {1.0, 2.0}
+
+
+def test_gzip_splits_are_multi_member_files_read_back_whole(model_data, tmp_path):
+    writer = preprocess.SplitWriter(level=6, threads=4, block_rows=3000)
+    paths = [str(tmp_path / f"train_{i}{writer.suffix}") for i in range(2)]
+    writer.write(model_data, paths[0])
+    writer.write(model_data, paths[1])
+    writer.close()
+
+    with open(paths[0], "rb") as f:
+        data = f.read()
+    # One member per block of rows, each with the gzip magic and a zero mtime
+    assert data.count(b"\x1f\x8b\x08\x00\x00\x00\x00\x00") == 7
+    with open(paths[1], "rb") as f:
+        assert f.read() == data
+
+    # The same rows as the plain csv
+    preprocess.write_split(model_data, str(tmp_path / "train.csv"))
+    with open(tmp_path / "train.csv", "rb") as f:
+        assert gzip.decompress(data) == f.read()
+    assert pd.read_csv(paths[0], header=None).shape == (20000, 3)
+
+    stats = writer.stats(1.0)
+    assert stats["raw_bytes"] == 2 * len(gzip.decompress(data))
+    assert stats["ratio"] > 2
+
+
+def test_test_arrays_hold_the_csv_values_and_are_predicted_in_place(model_data, tmp_path):
+    xgboost = pytest.importorskip("xgboost")
+    from pipelines.bankdm import evaluate
+
+    preprocess.write_split(model_data, str(tmp_path / "test.csv"))
+    preprocess.write_test_arrays(model_data, str(tmp_path))
+    labels, csv_features = evaluate.read_test_data(evaluate.find_test_data(str(tmp_path)))
+    y, features = evaluate.read_test_arrays(*evaluate.find_test_arrays(str(tmp_path)))
+    assert isinstance(features, np.memmap) and features.dtype == np.float32 and features.flags.c_contiguous
+    assert (y == labels).all()
+
+    booster = xgboost.train({"max_depth": 3}, xgboost.DMatrix(features, label=y), num_boost_round=5)
+    expected = booster.predict(xgboost.DMatrix(features))
+    assert np.allclose(evaluate.predict(booster, features), expected)
+    assert np.allclose(evaluate.predict(booster, csv_features), expected)
@@ -0,0 +1,88 @@
+import gzip
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from pipelines.bankdm import profiling
+
+
+@pytest.fixture
+def shards(tmp_path):
+    rng = np.random.default_rng(0)
+    data = pd.DataFrame(
+        {
+            "age": rng.normal(40, 10, 40000).round(),
+            "balance": rng.lognormal(5, 1, 40000),
+            "job": rng.choice(["admin.", "technician", "student", "retired"], 40000, p=[0.4, 0.3, 0.2, 0.1]),
+        }
+    )
+    data.loc[::100, "balance"] = np.nan
+    paths = []
+    for i in range(4):
+        part = data.iloc[i * 10000 : (i + 1) * 10000]
+        path = str(tmp_path / f"000{i}_part_00.gz")
+        with gzip.open(path, "wt") as f:
+            part.to_csv(f, index=False)
+        paths.append(path)
+    return data, paths
+
+
+def test_merged_shard_profiles_match_the_whole_data(shards):
+    data, paths = shards
+    profile = profiling.profile_files(paths, processes=2, chunksize=3000)
+
+    assert profile["rows"] == 40000
+    balance = profile["columns"]["balance"]
+    assert balance["nulls"] == 400
+    assert balance["mean"] == pytest.approx(data["balance"].mean())
+    assert balance["std"] == pytest.approx(data["balance"].std(ddof=0))
+    assert (balance["min"], balance["max"]) == (data["balance"].min(), data["balance"].max())
+    values = np.sort(data["balance"].dropna())
+    for q in (0.1, 0.5, 0.9, 0.99):
+        rank = np.searchsorted(values, balance["quantiles"][str(q)]) / len(values)
+        assert rank == pytest.approx(q, abs=0.01)
+
+    age = profile["columns"]["age"]
+    assert age["distinct"] == pytest.approx(data["age"].nunique(), rel=0.05)
+    job = profile["columns"]["job"]
+    assert job["distinct"] == 4
+    assert job["top"] == [{"value": v, "count": int(c)} for v, c in data["job"].value_counts().items()]
+
+
+def test_sketches_stay_bounded_and_merge():
+    rng = np.random.default_rng(1)
+    sketches = [profiling.QuantileSketch(k=256, seed=i) for i in range(2)]
+    counters = [profiling.TopK(capacity=10) for _ in range(2)]
+    for sketch, topk in zip(sketches, counters):
+        for _ in range(20):
+            sketch.update(rng.random(10000))
+            topk.update(pd.Series(rng.zipf(1.5, 1000)).value_counts())
+    sketches[0].merge(sketches[1])
+    counters[0].merge(counters[1])
+
+    assert sum(len(level) for level in sketches[0].levels) < 1000
+    assert sketches[0].quantiles([0.5])[0] == pytest.approx(0.5, abs=0.02)
+    assert len(counters[0].counters) <= 10
+    assert counters[0].top(1)[0][0] == 1
+
+    hll = profiling.HyperLogLog()
+    hll.update(pd.util.hash_pandas_object(pd.Series(np.arange(100000, dtype=float)), index=False).values)
+    assert hll.estimate() == pytest.approx(100000, rel=0.05)
+
+
+def test_column_kinds_follow_all_of_the_values_not_the_first_chunk(tmp_path):
+    # job is empty in the first shard, and pdays turns to text in the second chunk of the second
+    (tmp_path / "0000_part_00").write_text("age,job,pdays\n30,,1\n31,,2\n")
+    (tmp_path / "0001_part_00").write_text("age,job,pdays\n40,admin.,3\n41,admin.,4\n42,student,unknown\n")
+    paths = sorted(str(p) for p in tmp_path.iterdir())
+
+    for processes in (1, 2):
+        columns = profiling.profile_files(paths, processes=processes, chunksize=2)["columns"]
+        assert columns["age"]["kind"] == "numeric"
+        assert columns["age"]["mean"] == pytest.approx(36.8)
+        assert columns["job"]["kind"] == "categorical"
+        assert columns["job"]["nulls"] == 2
+        assert columns["job"]["top"] == [{"value": "admin.", "count": 2}, {"value": "student", "count": 1}]
+        assert columns["pdays"]["kind"] == "categorical"
+        assert columns["pdays"]["top"][-1] == {"value": "unknown", "count": 1}
@@ -0,0 +1,99 @@
+import gzip
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from pipelines.local_services import LocalRedshiftDataClient, LocalS3
+from pipelines.redshift_writeback import StatementError, stage_files, wait_for_statement, write_back
+
+
+@pytest.fixture
+def services(tmp_path):
+    s3 = LocalS3(str(tmp_path))
+    client = LocalRedshiftDataClient(s3)
+    for sql in ("create schema if not exists dm", "create table dm.scores (row_id integer, score real)"):
+        client.execute_statement(Sql=sql)
+    return s3, client
+
+
+def query(client, sql):
+    statement = client.execute_statement(Sql=sql)
+    records = client.get_statement_result(Id=statement["Id"])["Records"]
+    return [[list(field.values())[0] for field in record] for record in records]
+
+
+def scores(start, stop, offset=0.0):
+    row_id = np.arange(start, stop)
+    return pd.DataFrame({"row_id": row_id, "score": row_id / 1000.0 + offset})
+
+
+def test_staged_files_are_evenly_split_and_listed_in_a_manifest(services):
+    s3, _ = services
+    manifest = stage_files(s3, scores(0, 1001), "s3://bucket/writeback/run-1", files=4)
+
+    with open(s3.path(manifest)) as f:
+        urls = [entry["url"] for entry in json.load(f)["entries"]]
+    assert urls == [f"s3://bucket/writeback/run-1/part_000{i}.csv.gz" for i in range(4)]
+    sizes = []
+    for url in urls:
+        with gzip.open(s3.path(url), "rt") as f:
+            sizes.append(len(f.readlines()))
+    assert sizes == [250, 250, 250, 251]
+
+
+def test_write_back_appends_with_one_copy(services):
+    s3, client = services
+    stats = write_back(client, s3, scores(0, 1000), "dm", "scores", "s3://bucket/writeback/run-1", "role")
+
+    assert stats["rows"] == 1000
+    assert query(client, "select count(*), sum(score) from dm.scores") == [[1000, pytest.approx(499.5)]]
+    statement = client.describe_statement(Id=stats["statement_id"])
+    assert statement["QueryString"].startswith("copy dm.scores (row_id, score) from 's3://bucket/writeback/run-1/")
+    assert statement["QueryString"].endswith("gzip manifest")
+    assert statement["ResultRows"] == 1000
+
+
+def test_write_back_upserts_through_a_staging_table(services):
+    s3, client = services
+    write_back(client, s3, scores(0, 10), "dm", "scores", "s3://bucket/writeback/run-1", "role")
+    write_back(
+        client, s3, scores(5, 15, offset=1.0), "dm", "scores", "s3://bucket/writeback/run-2", "role",
+        key_columns=["row_id"],
+    )
+
+    rows = query(client, "select row_id, score from dm.scores order by row_id")
+    assert [r[0] for r in rows] == list(range(15))
+    assert [r[1] for r in rows] == pytest.approx([i / 1000.0 + (1.0 if i >= 5 else 0.0) for i in range(15)])
+
+
+def test_a_failed_merge_leaves_the_table_unchanged(services):
+    s3, client = services
+    write_back(client, s3, scores(0, 10), "dm", "scores", "s3://bucket/writeback/run-1", "role")
+    with pytest.raises(StatementError, match="failed"):
+        write_back(
+            client, s3, scores(0, 10).rename(columns={"score": "missing"}), "dm", "scores",
+            "s3://bucket/writeback/run-2", "role", key_columns=["row_id"],
+        )
+    assert query(client, "select count(*) from dm.scores") == [[10]]
+
+
+class SlowStatements:
+    def __init__(self, statuses):
+        self.statuses = list(statuses)
+
+    def describe_statement(self, Id):
+        return {"Id": Id, "Status": self.statuses.pop(0), "Error": "disk full"}
+
+
+def test_wait_for_statement_backs_off_exponentially():
+    sleeps = []
+    client = SlowStatements(["SUBMITTED", "STARTED", "STARTED", "STARTED", "FINISHED"])
+    assert wait_for_statement(client, "id", delay=1, max_delay=3, sleep=sleeps.append)["Status"] == "FINISHED"
+    assert sleeps == [1, 2, 3, 3]
+
+    with pytest.raises(StatementError, match="disk full"):
+        wait_for_statement(SlowStatements(["STARTED", "FAILED"]), "id", sleep=sleeps.append)
+    with pytest.raises(StatementError, match="still STARTED"):
+        wait_for_statement(SlowStatements(["STARTED"] * 10), "id", delay=1, timeout=3, sleep=lambda s: None)
@@ -0,0 +1,96 @@
+import numpy as np
+import pandas as pd
+import pytest
+import xgboost
+
+from pipelines.bankdm import preprocess
+from pipelines.bankdm.features import FeatureSchema, RecordEncoder
+from pipelines.bankdm.local_pipeline import DEFAULT_DATA_PATH, run_local_pipeline
+from pipelines.bankdm.scoring import Scorer, load_model, score_csv
+from pipelines.local_services import redshift_column_name
+from pipelines.prediction_cache import PredictionCache
+
+
+@pytest.fixture(scope="module")
+def raw_rows():
+    return pd.read_csv(DEFAULT_DATA_PATH, nrows=1200).rename(columns=redshift_column_name)
+
+
+@pytest.fixture(scope="module")
+def local_run(tmp_path_factory, raw_rows):
+    path = tmp_path_factory.mktemp("data") / "sample.csv"
+    pd.read_csv(DEFAULT_DATA_PATH, nrows=1200).to_csv(path, index=False)
+    return run_local_pipeline(str(tmp_path_factory.mktemp("work")), data_path=str(path))
+
+
+def test_feature_schema_reproduces_the_preprocessing_encoding(local_run, raw_rows):
+    schema = FeatureSchema.load(local_run["features"])
+    expected = preprocess.engineer_features(raw_rows.copy()).drop(["y_no", "y_yes"], axis=1)
+
+    assert schema.columns == list(expected.columns)
+    np.testing.assert_array_equal(schema.transform(raw_rows), expected.to_numpy(dtype=np.float32))
+
+
+def test_unseen_levels_encode_as_zeros(local_run, raw_rows):
+    schema = FeatureSchema.load(local_run["features"])
+    rows = raw_rows.head(2).copy()
+    rows["job"] = ["astronaut", rows["job"].iloc[1]]
+
+    encoded = schema.transform(rows)
+    job_columns = [i for i, c in enumerate(schema.columns) if c.startswith("job_")]
+    assert encoded[0, job_columns].sum() == 0
+    assert encoded[1, job_columns].sum() == 1
+
+
+def test_scorer_streams_chunk_predictions(local_run, raw_rows, tmp_path):
+    scorer = Scorer.load(local_run["model"], local_run["features"], nthread=1)
+    expected = load_model(local_run["model"]).predict(xgboost.DMatrix(scorer.schema.transform(raw_rows)))
+
+    chunks = [raw_rows.iloc[i : i + 500] for i in range(0, len(raw_rows), 500)]
+    streamed = list(scorer.score(chunks))
+    assert [len(p) for p in streamed] == [500, 500, 200]
+    np.testing.assert_allclose(np.concatenate(streamed), expected, rtol=1e-6)
+
+    input_path = tmp_path / "table.csv"
+    raw_rows.to_csv(input_path, index=False)
+    stats = score_csv(scorer, str(input_path), str(tmp_path / "predictions.csv"), chunksize=300)
+    assert stats["rows"] == 1200
+    np.testing.assert_allclose(np.loadtxt(tmp_path / "predictions.csv"), expected, rtol=1e-5)
+
+
+def test_record_encoder_matches_the_dataframe_transform(local_run, raw_rows):
+    schema = FeatureSchema.load(local_run["features"])
+    encoder = RecordEncoder(schema)
+    expected = schema.transform(raw_rows)
+
+    encoded = np.stack([encoder.encode(record).copy() for record in raw_rows.to_dict("records")])
+    np.testing.assert_array_equal(encoded, expected)
+
+    record = dict(raw_rows.iloc[0], job="astronaut")
+    assert encoder.encode(record) is encoder.buffer
+    assert encoder.buffer[[i for i, c in enumerate(schema.columns) if c.startswith("job_")]].sum() == 0
+
+
+def test_scorer_predicts_single_records(local_run, raw_rows):
+    scorer = Scorer.load(local_run["model"], local_run["features"], nthread=1)
+    rows = raw_rows.head(20)
+    predictions = [scorer.predict_record(record) for record in rows.to_dict("records")]
+    np.testing.assert_allclose(predictions, scorer.predict(rows), rtol=1e-6)
+
+
+def test_scorer_cache_is_invalidated_by_a_new_booster(local_run, raw_rows):
+    cache = PredictionCache()
+    scorer = Scorer.load(local_run["model"], local_run["features"], nthread=1, cache=cache)
+    rows = raw_rows.head(200)
+    expected = Scorer.load(local_run["model"], local_run["features"], nthread=1).predict(rows)
+
+    np.testing.assert_allclose(scorer.predict(rows), expected, rtol=1e-6)
+    np.testing.assert_allclose(scorer.predict(rows), expected, rtol=1e-6)
+    assert scorer.predict_record(rows.iloc[0].to_dict()) == pytest.approx(float(expected[0]), rel=1e-6)
+    stats = cache.snapshot()
+    assert stats["hits"] >= 201
+    assert stats["size"] <= 200
+
+    retrained = scorer.booster[:1]
+    Scorer(retrained, scorer.schema, cache=cache)
+    assert len(cache) == 0
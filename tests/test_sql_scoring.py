@@ -0,0 +1,94 @@
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+import xgboost
+
+from pipelines.bankdm import preprocess
+from pipelines.bankdm.features import FeatureSchema
+from pipelines.bankdm.local_pipeline import DEFAULT_DATA_PATH
+from pipelines.bankdm.sql_scoring import compile_expression, compile_query, float32_bound, score_in_warehouse
+from pipelines.local_services import LocalRedshiftDataClient, LocalS3, redshift_column_name
+
+
+@pytest.fixture(scope="module")
+def sample_csv(tmp_path_factory):
+    path = tmp_path_factory.mktemp("data") / "sample.csv"
+    pd.read_csv(DEFAULT_DATA_PATH, nrows=2000).to_csv(path, index=False)
+    return str(path)
+
+
+@pytest.fixture(scope="module")
+def trained(sample_csv):
+    raw = pd.read_csv(sample_csv).rename(columns=redshift_column_name)
+    model_data = preprocess.engineer_features(raw.copy())
+    schema = FeatureSchema.from_dict(preprocess.feature_schema(raw, model_data))
+    features = schema.transform(raw)
+    booster = xgboost.train(
+        {"objective": "reg:squarederror", "max_depth": 6, "eta": 0.3, "subsample": 0.7, "seed": 0},
+        xgboost.DMatrix(features, label=model_data["y_yes"].to_numpy()),
+        num_boost_round=50,
+    )
+    return booster, schema, features
+
+
+def test_query_scores_the_table_as_the_booster_does(tmp_path, sample_csv, trained):
+    booster, schema, features = trained
+    client = LocalRedshiftDataClient(LocalS3(str(tmp_path / "s3")))
+    client.load_csv(sample_csv, "dm", "data")
+
+    query = compile_query(booster, schema, "dm.data", target_table="dm.scores")
+    stats = score_in_warehouse(client, query, sleep=lambda seconds: None)
+    assert client.describe_statement(Id=stats["statement_id"])["Status"] == "FINISHED"
+
+    result = client.get_statement_result(Id=client.execute_statement(Sql="SELECT prediction FROM dm.scores")["Id"])
+    predictions = [record[0]["doubleValue"] for record in result["Records"]]
+    np.testing.assert_allclose(predictions, booster.predict(xgboost.DMatrix(features)), rtol=1e-5, atol=1e-6)
+
+
+def test_missing_values_and_float32_rounding_follow_the_booster():
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=(3000, 2))
+    x[rng.random(x.shape) < 0.2] = np.nan
+    y = (np.nan_to_num(x[:, 0], nan=1.0) + x[:, 1] ** 2 > 0.5).astype(np.float32)
+    schema = FeatureSchema(["a", "b"], {}, ["a", "b"])
+    booster = xgboost.train({"objective": "binary:logistic", "max_depth": 4}, xgboost.DMatrix(x, label=y), 20)
+
+    # The doubles next to every threshold of a and to the bounds rounding to it in float32
+    splits = booster.trees_to_dataframe()
+    thresholds = splits.loc[splits["Feature"] == "f0", "Split"].astype(np.float32)
+    points = [float(t) for t in thresholds] + [float32_bound(t)[1] for t in thresholds]
+    edges = [np.nextafter(p, d) for p in points for d in (-np.inf, np.inf)]
+    rows = np.vstack([x, np.column_stack([edges, np.zeros(len(edges))])])
+
+    connection = sqlite3.connect(":memory:")
+    connection.execute('CREATE TABLE t ("a" REAL, "b" REAL)')
+    values = [[None if np.isnan(v) else float(v) for v in row] for row in rows]
+    connection.executemany("INSERT INTO t VALUES (?, ?)", values)
+    predictions = [r[0] for r in connection.execute(f"SELECT {compile_expression(booster, schema)} FROM t")]
+    np.testing.assert_allclose(predictions, booster.predict(xgboost.DMatrix(rows)), rtol=1e-5)
+
+    op, bound = float32_bound(np.float32(0.1))
+    assert np.float32(np.nextafter(bound, -np.inf)) < np.float32(0.1) <= np.float32(np.nextafter(bound, np.inf))
+    assert op in ("<", "<=")
+
+
+def test_deep_ensembles_stay_within_the_expression_depth_and_other_boosters_are_rejected():
+    rng = np.random.default_rng(1)
+    x = rng.normal(size=(500, 1))
+    schema = FeatureSchema(["a"], {}, ["a"])
+    booster = xgboost.train({"max_depth": 1}, xgboost.DMatrix(x, label=x[:, 0]), 1500)
+
+    connection = sqlite3.connect(":memory:")
+    connection.execute('CREATE TABLE t ("a" REAL)')
+    connection.executemany("INSERT INTO t VALUES (?)", x.tolist())
+    predictions = [r[0] for r in connection.execute(f"SELECT {compile_expression(booster, schema)} FROM t")]
+    np.testing.assert_allclose(predictions, booster.predict(xgboost.DMatrix(x)), rtol=1e-4, atol=1e-5)
+
+    linear = xgboost.train({"booster": "gblinear"}, xgboost.DMatrix(x, label=x[:, 0]), 2)
+    with pytest.raises(ValueError, match="gbtree"):
+        compile_expression(linear, schema)
+    poisson = xgboost.train({"objective": "count:poisson"}, xgboost.DMatrix(x, label=np.abs(x[:, 0])), 2)
+    with pytest.raises(ValueError, match="count:poisson"):
+        compile_expression(poisson, schema)
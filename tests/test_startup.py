@@ -0,0 +1,78 @@
+"""Guards the startup time of the pipelines CLIs.
+
+Each check runs in a fresh interpreter so that modules imported by other tests do not
+hide a slow import. The budget can be raised on slow machines with
+PIPELINES_STARTUP_BUDGET (seconds).
+"""
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUDGET = float(os.environ.get("PIPELINES_STARTUP_BUDGET", "0.5"))
+HEAVY = ("sagemaker", "boto3", "botocore", "pandas", "xgboost")
+
+CLI_MODULES = [
+    "pipelines.get_pipeline_definition",
+    "pipelines.run_pipeline",
+    "pipelines.run_local_pipeline",
+]
+
+_PROBE = """
+import json, runpy, sys, time
+start = time.perf_counter()
+{body}
+elapsed = time.perf_counter() - start
+heavy = sorted({{m.split(".")[0] for m in sys.modules}} & set({heavy!r}))
+print(json.dumps({{"elapsed": elapsed, "heavy": heavy}}))
+"""
+
+
+def _probe(body):
+    result = subprocess.run(
+        [sys.executable, "-c", _PROBE.format(body=body, heavy=HEAVY)],
+        cwd=REPO_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+@pytest.mark.parametrize("module", CLI_MODULES + ["pipelines.bankdm.pipeline"])
+def test_import_is_within_startup_budget(module):
+    result = _probe(f"import {module}")
+    assert result["heavy"] == []
+    assert result["elapsed"] < BUDGET
+
+
+@pytest.mark.parametrize("module", CLI_MODULES)
+def test_help_does_not_import_the_sdk(module):
+    body = (
+        f"sys.argv = ['cli', '--help']\n"
+        f"try:\n"
+        f"    runpy.run_module({module!r}, run_name='__main__')\n"
+        f"except SystemExit:\n"
+        f"    pass"
+    )
+    result = _probe(body)
+    assert result["heavy"] == []
+    assert result["elapsed"] < BUDGET
+
+
+def test_argument_validation_and_tag_conversion_do_not_import_the_sdk():
+    body = (
+        "from pipelines._utils import convert_struct\n"
+        "tags = convert_struct('[{\"Key\": \"sagemaker:project-name\", \"Value\": \"bankdm\"}]')\n"
+        "assert tags[0]['Value'] == 'bankdm'\n"
+        "sys.argv = ['run-pipeline', '--module-name', 'pipelines.bankdm.pipeline']\n"
+        "try:\n"
+        "    runpy.run_module('pipelines.run_pipeline', run_name='__main__')\n"
+        "except SystemExit as e:\n"
+        "    assert e.code == 2"
+    )
+    result = _probe(body)
+    assert result["heavy"] == []
@@ -0,0 +1,224 @@
+import json
+import sys
+import threading
+import types
+
+import pytest
+
+from pipelines import run_pipeline
+
+from pipelines._utils import (
+    convert_struct,
+    definition_digest,
+    expand_kwargs,
+    failed_steps,
+    format_step_summary,
+    format_variant_summary,
+    get_pipeline_drivers,
+    monitor_execution,
+    run_variants,
+    upsert_if_changed,
+)
+from pipelines.fingerprint import step_fingerprint
+from pipelines.local_services import LocalSageMakerClient
+
+STEPS = ["Lambda-RedShift-dl", "Step-PreProcess", "Step-Train", "Step-Eval"]
+
+
+class FakePipeline:
+    """The part of sagemaker.workflow.pipeline.Pipeline used by upsert_if_changed."""
+
+    def __init__(self, client, definition, name="BankDM-Pipeline"):
+        self.name = name
+        self.client = client
+        self.sagemaker_session = types.SimpleNamespace(sagemaker_client=client)
+        self._definition = definition
+
+    def definition(self):
+        return json.dumps(self._definition)
+
+    def upsert(self, role_arn, description=None, tags=None):
+        try:
+            return self.client.create_pipeline(
+                PipelineName=self.name, PipelineDefinition=self.definition(), RoleArn=role_arn
+            )
+        except Exception:
+            return self.client.update_pipeline(PipelineName=self.name, PipelineDefinition=self.definition())
+
+    def start(self):
+        arn = self.client.start_pipeline_execution(PipelineName=self.name)["PipelineExecutionArn"]
+        return types.SimpleNamespace(arn=arn)
+
+
+def test_convert_struct():
+    assert convert_struct(None) == {}
+    assert convert_struct('{"region": "us-east-1"}') == {"region": "us-east-1"}
+
+
+def test_expand_kwargs_into_variants():
+    assert expand_kwargs(None) == [{}]
+    assert expand_kwargs('[{"region": "us-east-1"}, {"region": "eu-west-1"}]') == [
+        {"region": "us-east-1"},
+        {"region": "eu-west-1"},
+    ]
+    grid = expand_kwargs(
+        {"role": "r", "grid": {"region": ["us-east-1", "eu-west-1"], "pipeline_name": ["A", "B"]}}
+    )
+    assert len(grid) == 4
+    assert {"role": "r", "region": "eu-west-1", "pipeline_name": "B"} in grid
+
+
+def test_format_step_summary_marks_cache_hits():
+    steps = [
+        {"StepName": "Step-Eval", "StepStatus": "Succeeded"},
+        {
+            "StepName": "Step-PreProcess",
+            "StepStatus": "Succeeded",
+            "CacheHitResult": {"SourcePipelineExecutionArn": "arn:aws:sagemaker:execution/abc123"},
+        },
+    ]
+    lines = format_step_summary(steps).splitlines()
+    assert lines[1].split() == ["Step-PreProcess", "Succeeded", "hit", "(abc123)"]
+    assert lines[2].split() == ["Step-Eval", "Succeeded", "miss"]
+
+
+def test_step_fingerprint_changes_with_any_input():
+    base = step_fingerprint("code", {"eta": 0.3}, ["manifest"])
+    assert base == step_fingerprint("code", {"eta": 0.3}, ["manifest"])
+    assert base != step_fingerprint("code2", {"eta": 0.3}, ["manifest"])
+    assert base != step_fingerprint("code", {"eta": 0.2}, ["manifest"])
+    assert base != step_fingerprint("code", {"eta": 0.3}, ["manifest2"])
+
+
+def test_upsert_is_skipped_when_the_deployed_definition_is_the_same():
+    client = LocalSageMakerClient()
+    definition = {"Version": "2020-12-01", "Steps": [{"Name": "Step-Train"}]}
+
+    response, digest = upsert_if_changed(FakePipeline(client, definition), "role", sagemaker_client=client)
+    assert response is not None
+    assert digest == definition_digest(client.pipelines["BankDM-Pipeline"])
+
+    response, _ = upsert_if_changed(FakePipeline(client, dict(reversed(definition.items()))), "role",
+                                    sagemaker_client=client)
+    assert response is None
+    assert client.calls.count("create_pipeline") == 1
+
+    changed = dict(definition, Steps=[{"Name": "Step-Tune"}])
+    response, _ = upsert_if_changed(FakePipeline(client, changed), "role", sagemaker_client=client)
+    assert response is not None
+    assert client.calls[-1] == "update_pipeline"
+
+
+def test_monitor_streams_step_transitions_until_the_execution_ends():
+    client = LocalSageMakerClient(STEPS, cache_hits=["Step-PreProcess"])
+    client.pipelines["BankDM-Pipeline"] = "{}"
+    arn = client.start_pipeline_execution(PipelineName="BankDM-Pipeline")["PipelineExecutionArn"]
+    lines, sleeps = [], []
+
+    status, steps = monitor_execution(client, arn, poll_interval=5, out=lines.append, sleep=sleeps.append)
+
+    assert status == "Succeeded"
+    assert [line.split("] ")[1] for line in lines] == [
+        "Lambda-RedShift-dl: Executing",
+        "Lambda-RedShift-dl: Succeeded in 60.0s",
+        "Step-PreProcess: Executing",
+        "Step-PreProcess: Succeeded in 60.0s (cache hit)",
+        "Step-Train: Executing",
+        "Step-Train: Succeeded in 60.0s",
+        "Step-Eval: Executing",
+        "Step-Eval: Succeeded in 60.0s",
+    ]
+    assert sleeps == [5] * 4
+    assert [step["StepName"] for step in steps] == list(reversed(STEPS))
+
+
+def test_monitor_reports_the_failing_step():
+    client = LocalSageMakerClient(STEPS, failures={"Step-Train": "ClientError: out of memory"})
+    client.pipelines["BankDM-Pipeline"] = "{}"
+    arn = client.start_pipeline_execution(PipelineName="BankDM-Pipeline")["PipelineExecutionArn"]
+    lines = []
+
+    status, steps = monitor_execution(client, arn, out=lines.append, sleep=lambda _: None)
+
+    assert status == "Failed"
+    assert lines[-1].endswith("Step-Train: Failed in 60.0s - ClientError: out of memory")
+    assert [step["StepName"] for step in failed_steps(steps)] == ["Step-Train"]
+    assert "Step-Eval" not in {step["StepName"] for step in steps}
+
+
+def test_variants_run_concurrently_behind_one_summary():
+    client = LocalSageMakerClient(STEPS, failures={"Step-Eval": "mse above threshold"})
+    pipelines = [FakePipeline(client, {"Steps": []}, name=f"BankDM-{region}") for region in ("us", "eu", "ap")]
+    client.pipelines["BankDM-eu"] = json.dumps({"Steps": []})
+    lines = []
+
+    results = run_variants(pipelines, "role", max_concurrency=2, poll_interval=0, out=lines.append,
+                           sleep=lambda _: None)
+
+    assert [r["name"] for r in results] == ["BankDM-us", "BankDM-eu", "BankDM-ap"]
+    assert {r["status"] for r in results} == {"Failed"}
+    assert "[BankDM-eu] skipped upsert, definition unchanged" in " ".join(lines)
+    assert sum("Step-Train: Succeeded" in line for line in lines) == 3
+    summary = format_variant_summary(results).splitlines()
+    assert summary[1].split()[:2] == ["BankDM-us", "Failed"]
+    assert summary[1].endswith("Step-Eval")
+
+
+def test_variants_are_built_one_after_the_other_on_the_calling_thread(monkeypatch):
+    module = types.ModuleType("fake_pipeline")
+    built = []
+
+    def get_pipeline(pipeline_name):
+        built.append((pipeline_name, threading.get_ident()))
+        return types.SimpleNamespace(name=pipeline_name)
+
+    module.get_pipeline = get_pipeline
+    monkeypatch.setitem(sys.modules, "fake_pipeline", module)
+
+    variants = [{"pipeline_name": f"BankDM-{i}"} for i in range(3)]
+    pipelines = get_pipeline_drivers("fake_pipeline", variants)
+    assert [p.name for p in pipelines] == ["BankDM-0", "BankDM-1", "BankDM-2"]
+    assert built == [(f"BankDM-{i}", threading.get_ident()) for i in range(3)]
+
+
+@pytest.fixture
+def fake_pipeline_module(monkeypatch):
+    module = types.ModuleType("fake_pipeline")
+    module.calls = []
+
+    def get_pipeline(**kwargs):
+        module.calls.append(kwargs)
+        return types.SimpleNamespace(
+            name="BankDM",
+            definition=lambda: "{}",
+            start=lambda: types.SimpleNamespace(arn="arn:execution"),
+            sagemaker_session=types.SimpleNamespace(sagemaker_client=None),
+        )
+
+    module.get_pipeline = get_pipeline
+    monkeypatch.setitem(sys.modules, "fake_pipeline", module)
+    monkeypatch.setattr(run_pipeline, "upsert_if_changed", lambda pipeline, **kwargs: (None, "0" * 64))
+    monkeypatch.setattr(run_pipeline, "monitor_execution", lambda *args, **kwargs: ("Succeeded", []))
+    return module
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    ['[{"pipeline_name": "BankDM"}]', '{"grid": {"pipeline_name": ["BankDM"]}}'],
+)
+def test_a_single_variant_runs_with_its_expanded_kwargs(monkeypatch, fake_pipeline_module, kwargs):
+    monkeypatch.setattr(sys, "argv", ["run-pipeline", "-n", "fake_pipeline", "-role-arn", "role", "-kwargs", kwargs])
+    run_pipeline.main()
+    assert fake_pipeline_module.calls == [{"pipeline_name": "BankDM"}]
+
+
+def test_kwargs_expanding_into_no_variant_are_rejected(monkeypatch, capsys, fake_pipeline_module):
+    with pytest.raises(ValueError, match="no pipeline variant"):
+        expand_kwargs({"grid": {"pipeline_name": []}})
+
+    monkeypatch.setattr(sys, "argv", ["run-pipeline", "-n", "fake_pipeline", "-role-arn", "role", "-kwargs", "[]"])
+    with pytest.raises(SystemExit) as exit_info:
+        run_pipeline.main()
+    assert exit_info.value.code == 1
+    assert "expands into no pipeline variant" in capsys.readouterr().out
+    assert fake_pipeline_module.calls == []